@@ -0,0 +1,375 @@
+'''
+Servidor HTTP local que imita los endpoints de la API de datos de Planet que usan los scripts.
+
+Atiende quick-search (con filtros de geometría, fechas, nubes y visibilidad, paginación
+_links._next y _sort), el diccionario de assets de cada escena, la activación con un
+retraso configurable y la descarga de un GeoTIFF sintético de 8 bandas con soporte de
+Range. Se pueden inyectar latencia por petición, límite de peticiones por segundo (429
+con Retry-After), errores 503 aleatorios y un ancho de banda máximo por conexión, para
+medir el rendimiento de los scripts sin gastar cuota de la API real.
+
+Uso directo (el servidor queda escuchando hasta Ctrl+C):
+    python benchmark/mock_planet.py --puerto 8765 --activacion 2 --latencia 0.05
+'''
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box, mapping, shape
+from shapely.strtree import STRtree
+
+# Extensión del catálogo sintético (aproximadamente la República Mexicana) y tamaño de cada huella en grados
+CATALOG_BOUNDS = (-118.0, 14.0, -86.0, 33.0)
+FOOTPRINT_SIZE = (0.25, 0.1)
+# Escenas del catálogo y años de adquisición
+CATALOG_SCENES = 20000
+CATALOG_YEARS = (2020, 2024)
+# Lado en píxeles del GeoTIFF sintético (8 bandas uint16: 2048 px ~ 64 MB)
+IMAGE_SIZE = 2048
+# Bloque de bytes enviado en cada escritura de la descarga
+SEND_BLOCK = 256 * 1024
+
+ASSET_TYPES = ('ortho_analytic_8b_sr', 'ortho_analytic_4b_sr')
+
+
+def make_geotiff(path, size=IMAGE_SIZE, bands=8, seed=0, block_rows=256):
+    """Escribe un GeoTIFF sintético (uint16, sin compresión, UTM) de size × size píxeles.
+
+    Los valores son un gradiente con ruido y un margen de ceros, como el área sin datos de
+    una escena real; se escribe por bloques de filas para no ocupar toda la imagen en memoria."""
+    rng = np.random.default_rng(seed)
+    margin = size // 20
+    profile = dict(driver='GTiff', width=size, height=size, count=bands, dtype='uint16',
+                   crs='EPSG:32614', transform=from_origin(500000, 2500000, 3, 3), tiled=False)
+    with rasterio.open(path, 'w', **profile) as dst:
+        for row in range(0, size, block_rows):
+            rows = min(block_rows, size - row)
+            base = np.linspace(500, 6000, size, dtype=np.float32)[None, :] + row
+            for band in range(1, bands + 1):
+                data = (base + rng.normal(0, 300, (rows, size))).clip(1, 65535).astype(np.uint16)
+                data[:, :margin] = 0
+                data[:, size - margin:] = 0
+                if row < margin:
+                    data[:max(0, margin - row)] = 0
+                if row + rows > size - margin:
+                    data[max(0, size - margin - row):] = 0
+                dst.write(data, band, window=((row, row + rows), (0, size)))
+    return path
+
+
+class MockPlanet:
+    """Servidor local con el catálogo, los estados de activación y las fallas inyectadas."""
+
+    def __init__(self, data_dir=None, host='127.0.0.1', port=0, scenes=CATALOG_SCENES, image_size=IMAGE_SIZE,
+                 latency=0.0, activation_delay=2.0, error_rate=0.0, rate_limit=None, bandwidth=None, seed=0):
+        self.data_dir = data_dir or tempfile.mkdtemp(prefix='mock_planet_')
+        self.latency = latency
+        self.activation_delay = activation_delay
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.bandwidth = bandwidth
+        self.random = random.Random(seed)
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._searches = {}
+        self._activations = {}
+
+        self.image_path = os.path.join(self.data_dir, f'escena_{image_size}.tif')
+        if not os.path.exists(self.image_path):
+            print(f"Generando el GeoTIFF sintético de {image_size} px...")
+            make_geotiff(self.image_path, image_size, seed=seed)
+        self.image_size = os.path.getsize(self.image_path)
+        digest = hashlib.md5()
+        with open(self.image_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        self.image_md5 = digest.hexdigest()
+
+        self.catalog = self._make_catalog(scenes, seed)
+        self.tree = STRtree([item['shape'] for item in self.catalog])
+
+        handler = type('Handler', (_Handler,), {'mock': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.base_url = f'http://{host}:{self.server.server_port}'
+        self.api_url = self.base_url + '/data/v1'
+        self._thread = None
+
+    def _make_catalog(self, scenes, seed):
+        rng = random.Random(seed)
+        min_x, min_y, max_x, max_y = CATALOG_BOUNDS
+        first = datetime(CATALOG_YEARS[0], 1, 1)
+        days = (datetime(CATALOG_YEARS[1], 12, 31) - first).days
+        catalog = []
+        for i in range(scenes):
+            x = rng.uniform(min_x, max_x - FOOTPRINT_SIZE[0])
+            y = rng.uniform(min_y, max_y - FOOTPRINT_SIZE[1])
+            acquired = first + timedelta(days=rng.randrange(days), seconds=rng.randrange(86400))
+            footprint = box(x, y, x + FOOTPRINT_SIZE[0], y + FOOTPRINT_SIZE[1])
+            catalog.append({
+                'id': f"{acquired:%Y%m%d_%H%M%S}_{i:05d}",
+                'shape': footprint,
+                'geometry': mapping(footprint),
+                'properties': {
+                    'acquired': acquired.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                    'cloud_cover': round(rng.random() ** 3, 3),
+                    'clear_percent': rng.randint(50, 100),
+                },
+            })
+        return catalog
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # --- Lógica de la API -------------------------------------------------------------
+
+    def admit(self):
+        """Aplica latencia, límite de peticiones y errores inyectados. Devuelve (código, encabezados) o None."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.stats['peticiones'] += 1
+            if self.rate_limit:
+                now = time.monotonic()
+                while self._recent and now - self._recent[0] >= 1.0:
+                    self._recent.popleft()
+                if len(self._recent) >= self.rate_limit:
+                    self.stats['429'] += 1
+                    return 429, {'Retry-After': '1'}
+                self._recent.append(now)
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.stats['503'] += 1
+                return 503, {}
+        return None
+
+    def feature(self, item):
+        return {
+            'id': item['id'],
+            'type': 'Feature',
+            'geometry': item['geometry'],
+            'properties': dict(item['properties'], item_type='PSScene'),
+            '_links': {'assets': f"{self.api_url}/item-types/PSScene/items/{item['id']}/assets/"},
+        }
+
+    def matches(self, item, search_filter):
+        kind = search_filter['type']
+        config = search_filter['config']
+        if kind == 'AndFilter':
+            return all(self.matches(item, f) for f in config)
+        if kind == 'OrFilter':
+            return any(self.matches(item, f) for f in config)
+        if kind == 'GeometryFilter':
+            return True  # ya se filtró con el índice espacial
+        value = item['properties'].get(search_filter['field_name'])
+        if value is None:
+            return False
+        if kind == 'DateRangeFilter':
+            value = value[:19]
+            return (('gte' not in config or value >= config['gte'][:19]) and
+                    ('lte' not in config or value <= config['lte'][:19]))
+        if kind == 'RangeFilter':
+            return (('gte' not in config or value >= config['gte']) and
+                    ('lte' not in config or value <= config['lte']))
+        return True
+
+    def search(self, request, page_size, sort):
+        geometry = None
+        pending = [request['filter']]
+        while pending:
+            f = pending.pop()
+            if f['type'] in ('AndFilter', 'OrFilter'):
+                pending.extend(f['config'])
+            elif f['type'] == 'GeometryFilter':
+                geometry = shape(f['config'])
+        if geometry is None:
+            candidates = self.catalog
+        else:
+            candidates = [self.catalog[i] for i in sorted(self.tree.query(geometry, predicate='intersects'))]
+        results = [self.feature(item) for item in candidates if self.matches(item, request['filter'])]
+        if sort:
+            field, _, order = sort.partition(' ')
+            results.sort(key=lambda f: f['properties'].get(field, ''), reverse=order == 'desc')
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._searches[token] = (results, page_size)
+            self.stats['busquedas'] += 1
+        return self.page(token, 0)
+
+    def page(self, token, number):
+        results, page_size = self._searches[token]
+        start = number * page_size
+        body = {'type': 'FeatureCollection', 'features': results[start:start + page_size], '_links': {}}
+        if start + page_size < len(results):
+            body['_links']['_next'] = f"{self.api_url}/searches/{token}/results?_page={number + 1}"
+        return body
+
+    def asset(self, item_id, asset_type):
+        base = f"{self.api_url}/assets/{item_id}/{asset_type}"
+        asset = {
+            'type': asset_type,
+            'status': 'inactive',
+            '_links': {'_self': base, 'activate': base + '/activate', 'type': asset_type},
+        }
+        with self._lock:
+            requested = self._activations.get((item_id, asset_type))
+        if requested is not None:
+            if time.monotonic() - requested >= self.activation_delay:
+                asset['status'] = 'active'
+                asset['location'] = f"{self.api_url}/download?item={item_id}&asset={asset_type}"
+                asset['md5_digest'] = self.image_md5
+            else:
+                asset['status'] = 'activating'
+        return asset
+
+    def activate(self, item_id, asset_type):
+        with self._lock:
+            self._activations.setdefault((item_id, asset_type), time.monotonic())
+            self.stats['activaciones'] += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    mock = None
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, body, status=200, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def rejected(self):
+        result = self.mock.admit()
+        if result is None:
+            return False
+        status, headers = result
+        self.send_json({'message': 'simulado'}, status, headers)
+        return True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.rejected():
+            return
+        url = urlparse(self.path)
+        if url.path.endswith('/quick-search'):
+            query = parse_qs(url.query)
+            page_size = int(query.get('_page_size', ['250'])[0])
+            sort = query.get('_sort', [None])[0]
+            self.send_json(self.mock.search(json.loads(body), page_size, sort))
+        else:
+            self.send_json({'message': 'no encontrado'}, 404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.endswith('/download'):
+            return self.download(parse_qs(url.query))
+        if self.rejected():
+            return
+        match = re.search(r'/searches/(\w+)/results$', url.path)
+        if match:
+            number = int(parse_qs(url.query).get('_page', ['0'])[0])
+            return self.send_json(self.mock.page(match.group(1), number))
+        match = re.search(r'/items/([^/]+)/assets/?$', url.path)
+        if match:
+            return self.send_json({t: self.mock.asset(match.group(1), t) for t in ASSET_TYPES})
+        match = re.search(r'/assets/([^/]+)/([^/]+)/activate$', url.path)
+        if match:
+            self.mock.activate(match.group(1), match.group(2))
+            return self.send_json({}, 202)
+        match = re.search(r'/assets/([^/]+)/([^/]+)$', url.path)
+        if match:
+            return self.send_json(self.mock.asset(match.group(1), match.group(2)))
+        self.send_json({'message': 'no encontrado'}, 404)
+
+    def download(self, query):
+        if self.rejected():
+            return
+        total = self.mock.image_size
+        start, end = 0, total - 1
+        status = 200
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else total - 1, total - 1)
+            status = 206
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'image/tiff')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{total}')
+        self.end_headers()
+
+        began = time.monotonic()
+        sent = 0
+        try:
+            with open(self.mock.image_path, 'rb') as f:
+                f.seek(start)
+                while sent < length:
+                    block = f.read(min(SEND_BLOCK, length - sent))
+                    self.wfile.write(block)
+                    sent += len(block)
+                    if self.mock.bandwidth:
+                        # Ancho de banda máximo por conexión (bytes/s)
+                        ahead = sent / self.mock.bandwidth - (time.monotonic() - began)
+                        if ahead > 0:
+                            time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            # El cliente cerró la conexión (p. ej. la consulta del primer byte)
+            self.close_connection = True
+        with self.mock._lock:
+            self.mock.stats['bytes_enviados'] += sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description='API de Planet simulada para pruebas de rendimiento.')
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--datos', default=None, help='directorio del GeoTIFF sintético')
+    parser.add_argument('--escenas', type=int, default=CATALOG_SCENES)
+    parser.add_argument('--tamano', type=int, default=IMAGE_SIZE, help='lado del GeoTIFF sintético en píxeles')
+    parser.add_argument('--latencia', type=float, default=0.0, help='segundos añadidos a cada petición')
+    parser.add_argument('--activacion', type=float, default=2.0, help='segundos hasta que un asset queda activo')
+    parser.add_argument('--errores', type=float, default=0.0, help='fracción de peticiones que responden 503')
+    parser.add_argument('--limite', type=float, default=None, help='peticiones por segundo antes de responder 429')
+    parser.add_argument('--ancho-banda', type=float, default=None, help='MB/s máximos por conexión de descarga')
+    args = parser.parse_args()
+
+    mock = MockPlanet(args.datos, port=args.puerto, scenes=args.escenas, image_size=args.tamano,
+                      latency=args.latencia, activation_delay=args.activacion, error_rate=args.errores,
+                      rate_limit=args.limite, bandwidth=args.ancho_banda * 1e6 if args.ancho_banda else None)
+    print(f"API simulada en {mock.api_url} (GeoTIFF de {mock.image_size / 1e6:.0f} MB). Ctrl+C para terminar.")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == '__main__':
+    main()
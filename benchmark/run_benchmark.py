@@ -0,0 +1,227 @@
+'''
+Pruebas de rendimiento sin conexión contra la API de Planet simulada (mock_planet.py).
+
+Escenarios:
+    busqueda   search_quadrants y search_quadrants_batched sobre la malla de 400 km
+    descarga   activación y descarga de extremo a extremo (activate_and_download_images)
+    png        create_png sobre el GeoTIFF sintético
+    pipeline   descarga -> PNG -> transferencia local con run_pipeline, como download_ids_pg
+
+Cada escenario reporta imágenes (o cuadrantes) por minuto, MB/s, peticiones a la API y los
+p50/p95 de las métricas por etapa de metrics.py. El resultado se guarda en
+benchmark/resultados/ para comparar antes y después de cada cambio de rendimiento.
+
+Ejemplo:
+    python benchmark/run_benchmark.py --escenarios descarga png --imagenes 8 --activacion 1
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from glob import glob
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import metrics
+import planet_search
+import planet_session
+import profiling
+from mock_planet import IMAGE_SIZE, MockPlanet
+from planet_download import DOWNLOAD_PARTS, download_file
+from planet_activation import wait_for_activation
+
+GRID = os.path.join(ROOT, 'malla_400km_terrestre', 'malla_400km_terrestre.shp')
+RESULTS_DIR = os.path.join(ROOT, 'benchmark', 'resultados')
+SCENARIOS = ('busqueda', 'descarga', 'png', 'pipeline')
+
+
+def use_mock(mock, workers, rate_limit=True):
+    """Dirige a la API simulada los módulos que construyen URL a partir de PLANET_API_URL."""
+    planet_session.PLANET_API_URL = mock.api_url
+    planet_search.PLANET_API_URL = mock.api_url
+    # Igual que los scripts: el pool alcanza para los rangos de todas las descargas en paralelo
+    planet_session.configure_session(planet_session.session_size(workers, workers, DOWNLOAD_PARTS), api_key='benchmark',
+                                     rate_limit=rate_limit)
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """Oculta los mensajes de los scripts durante la medición."""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def stage_summary():
+    """p50/p95 de cada métrica por etapa registrada durante el escenario."""
+    summary = metrics.get_metrics().summary()
+    return {name: {'n': s['n'], 'p50': s['p50'], 'p95': s['p95']} for name, s in summary['metricas'].items()}
+
+
+def scenario_busqueda(mock, args, workdir):
+    import download_planet_region as region
+    region.USE_SEARCH_CACHE = False
+    quadrants = region.shapefile_to_geojson(GRID, use_cache=False)
+    years = args.anio_fin - args.anio_inicio + 1
+    result = {}
+    for mode, search in (('por_cuadrante', region.search_quadrants), ('por_lotes', region.search_quadrants_batched)):
+        metrics.reset_metrics()
+        before = mock.stats['peticiones']
+        start = time.perf_counter()
+        with quiet(not args.detalle):
+            selected = search(quadrants, 90.0, 10.0, args.anio_inicio, args.anio_fin, False, args.hilos, args.politica)
+        elapsed = time.perf_counter() - start
+        result[mode] = {
+            'segundos': round(elapsed, 3),
+            'peticiones': mock.stats['peticiones'] - before,
+            'cuadrantes_por_minuto': round(len(quadrants) * years / elapsed * 60, 1),
+            'seleccionadas': len(selected),
+            'etapas': stage_summary(),
+        }
+    return result
+
+
+def scenario_descarga(mock, args, workdir):
+    import download_planet_region as region
+    output_dir = os.path.join(workdir, 'descarga')
+    selected = [(mock.feature(item), 2022, 'completo') for item in mock.catalog[:args.imagenes]]
+    start = time.perf_counter()
+    with quiet(not args.detalle):
+        region.activate_and_download_images(selected, output_dir)
+    elapsed = time.perf_counter() - start
+    files = glob(os.path.join(output_dir, '*', '*', '*.tif'))
+    nbytes = sum(os.path.getsize(f) for f in files)
+    return {
+        'imagenes': len(files),
+        'segundos': round(elapsed, 3),
+        'imagenes_por_minuto': round(len(files) / elapsed * 60, 2),
+        'mb_por_segundo': round(nbytes / elapsed / 1e6, 2),
+        'etapas': stage_summary(),
+    }
+
+
+def scenario_png(mock, args, workdir):
+    import download_ids_pg as ids
+    base = os.path.join(workdir, 'png_escena')
+    shutil.copy(mock.image_path, base + '.tif')
+    start = time.perf_counter()
+    for _ in range(args.imagenes):
+        ids.create_png(base, max_size=args.png_max)
+    elapsed = time.perf_counter() - start
+    return {
+        'imagenes': args.imagenes,
+        'max_size': args.png_max,
+        'segundos': round(elapsed, 3),
+        'imagenes_por_minuto': round(args.imagenes / elapsed * 60, 2),
+        'mb_por_segundo': round(args.imagenes * mock.image_size / elapsed / 1e6, 2),
+    }
+
+
+def scenario_pipeline(mock, args, workdir):
+    import download_ids_pg as ids
+    from pipeline import run_pipeline
+    ids.PLANET_API_URL = mock.api_url
+    tmp = os.path.join(workdir, 'pipeline')
+    os.makedirs(tmp, exist_ok=True)
+    transferred = []
+
+    # Escenas distintas a las del escenario de descarga, para medir también su activación
+    items = mock.catalog[args.imagenes:2 * args.imagenes]
+    start = time.perf_counter()
+    with quiet(not args.detalle):
+        jobs = [(item['id'], ids.obtain_asset(item['id'], 'PSScene', 'ortho_analytic_8b_sr')) for item in items]
+
+        def download(job):
+            image_id, asset = job
+            path = os.path.join(tmp, image_id)
+            download_file(asset['location'], path + '.tif', parts=DOWNLOAD_PARTS, expected_md5=asset.get('md5_digest'))
+            return image_id, path
+
+        def transfer(item):
+            # Equivale a la transferencia local: se cuentan los bytes y se liberan los archivos
+            for file in glob(item[1] + '*'):
+                transferred.append(os.path.getsize(file))
+                os.remove(file)
+
+        count = run_pipeline(wait_for_activation([job for job in jobs if job[1] is not None]), download, ids.render_image,
+                             transfer, download_workers=args.hilos, render_workers=args.procesos)
+    elapsed = time.perf_counter() - start
+    return {
+        'imagenes': count,
+        'segundos': round(elapsed, 3),
+        'imagenes_por_minuto': round(count / elapsed * 60, 2),
+        'mb_por_segundo': round(count * mock.image_size / elapsed / 1e6, 2),
+        'etapas': stage_summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pruebas de rendimiento contra la API de Planet simulada.')
+    parser.add_argument('--escenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--imagenes', type=int, default=6, help='imágenes por escenario de descarga, png y pipeline')
+    parser.add_argument('--tamano', type=int, default=IMAGE_SIZE, help='lado del GeoTIFF sintético en píxeles')
+    parser.add_argument('--hilos', type=int, default=4, help='hilos de búsqueda y de descarga')
+    parser.add_argument('--procesos', type=int, default=2, help='procesos para generar los PNG en el pipeline')
+    parser.add_argument('--politica', default='primera', choices=list(planet_search.POLICIES))
+    parser.add_argument('--anio-inicio', type=int, default=2021)
+    parser.add_argument('--anio-fin', type=int, default=2022)
+    parser.add_argument('--png-max', type=int, default=None, help='lado mayor del PNG (None: resolución completa)')
+    parser.add_argument('--latencia', type=float, default=0.02, help='segundos añadidos a cada petición de la API')
+    parser.add_argument('--activacion', type=float, default=2.0, help='segundos hasta que un asset queda activo')
+    parser.add_argument('--errores', type=float, default=0.0, help='fracción de peticiones que responden 503')
+    parser.add_argument('--limite', type=float, default=None, help='peticiones por segundo antes de responder 429')
+    parser.add_argument('--ancho-banda', type=float, default=None, help='MB/s máximos por conexión de descarga')
+    parser.add_argument('--sin-limitador', action='store_true', help='desactiva el limitador de peticiones del cliente')
+    parser.add_argument('--datos', default=os.path.join(tempfile.gettempdir(), 'mock_planet'),
+                        help='directorio donde se guarda (y reutiliza) el GeoTIFF sintético')
+    parser.add_argument('--detalle', action='store_true', help='muestra los mensajes de los scripts')
+    parser.add_argument('--profile', nargs='?', const=profiling.PROFILE_DIR, default=None,
+                        help='guarda perfiles de CPU y memoria por imagen en el directorio indicado')
+    args = parser.parse_args()
+    if args.profile:
+        profiling.enable(args.profile)
+
+    os.makedirs(args.datos, exist_ok=True)
+    mock = MockPlanet(args.datos, image_size=args.tamano, latency=args.latencia, activation_delay=args.activacion,
+                      error_rate=args.errores, rate_limit=args.limite,
+                      bandwidth=args.ancho_banda * 1e6 if args.ancho_banda else None).start()
+    use_mock(mock, args.hilos, rate_limit=not args.sin_limitador)
+    workdir = tempfile.mkdtemp(prefix='benchmark_')
+    print(f"API simulada en {mock.api_url}, GeoTIFF de {mock.image_size / 1e6:.1f} MB, trabajo en {workdir}")
+
+    report = {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'parametros': vars(args),
+        'escenarios': {},
+    }
+    try:
+        for name in args.escenarios:
+            metrics.reset_metrics()
+            before = dict(mock.stats)
+            print(f"Escenario {name}...")
+            result = globals()['scenario_' + name](mock, args, workdir)
+            result['api'] = {key: value - before.get(key, 0) for key, value in mock.stats.items()}
+            report['escenarios'][name] = result
+            print(json.dumps(result, indent=2, ensure_ascii=False))
+    finally:
+        mock.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"benchmark_{datetime.now():%Y%m%dT%H%M%S}.json")
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Resultados guardados en {path}")
+
+
+if __name__ == '__main__':
+    main()
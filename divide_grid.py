@@ -1,22 +1,65 @@
 '''
 Script para dividir la malla de 400 km en cuadrantes de 100 km.
+
+Cada celda de la malla se divide en 4×4 cuadrantes en la proyección original de la
+malla (EPSG:3857), generando todas las esquinas a la vez con NumPy. Los cuadrantes
+conservan el pathrow de su celda y su índice dentro de ella, y se guardan en un
+solo GeoPackage con índice espacial que download_planet_region.py puede leer
+directamente.
+
 @autor: UrielMendoza
 @date: 2023-06-01
 '''
-
+import sys
+import numpy as np
+import shapely
 import geopandas as gpd
 
 shp_path = r"layers/malla_400km_terrestre/malla_400km_terrestre.shp"
-shp_data = gpd.read_file(shp_path)
+output_file = r"layers/malla_100km_terrestre.gpkg"
+# Proyección en la que se definió la malla (celdas cuadradas de 400 km)
+GRID_CRS = "EPSG:3857"
+# Cuadrantes por lado de cada celda (400 km / 4 = 100 km)
+DIVISIONS = 4
+
+def subdivide(grid, divisions=DIVISIONS, crs=GRID_CRS):
+    """Divide cada celda de la malla en divisions × divisions cuadrantes.
+
+    Los cuadrantes se numeran de 1 a divisions² por filas, de noroeste a sureste. Devuelve un
+    GeoDataFrame en el CRS original de la malla con las columnas pathrow, hijo, fila, columna e id."""
+    bounds = grid.to_crs(crs).bounds.to_numpy()
+    n = len(bounds)
+    steps = np.arange(divisions)
+    # Índices (celda, fila, columna) de todos los cuadrantes, aplanados
+    cell = np.repeat(np.arange(n), divisions * divisions)
+    row = np.tile(np.repeat(steps, divisions), n)
+    col = np.tile(np.tile(steps, divisions), n)
+
+    width = (bounds[:, 2] - bounds[:, 0]) / divisions
+    height = (bounds[:, 3] - bounds[:, 1]) / divisions
+    left = bounds[cell, 0] + col * width[cell]
+    top = bounds[cell, 3] - row * height[cell]
+    boxes = shapely.box(left, top - height[cell], left + width[cell], top)
 
-for index, row in shp_data.iterrows():
-    print(row)
-    output_file = f"layers/malla_400km_terrestre/malla_400km_terrestre_{row['pathrow']}.geojson"
-    row_geojson = gpd.GeoSeries(row['geometry']).to_json()
-    # Añade el pathrow al geojson
-    row_geojson = row_geojson[:-1] + f',"pathrow":"{row["pathrow"]}"}}'
-    
-    with open(output_file, 'w') as f:
-        f.write(row_geojson)
+    pathrow = grid['pathrow'].to_numpy()[cell]
+    hijo = row * divisions + col + 1
+    quadrants = gpd.GeoDataFrame({
+        'pathrow': pathrow,
+        'hijo': hijo,
+        'fila': row + 1,
+        'columna': col + 1,
+        'id': [f"{p}_{h:02d}" for p, h in zip(pathrow, hijo)],
+    }, geometry=boxes, crs=crs)
+    return quadrants.to_crs(grid.crs)
 
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        shp_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        output_file = sys.argv[2]
 
+    shp_data = gpd.read_file(shp_path)
+    quadrants = subdivide(shp_data)
+    # Un solo archivo con índice espacial (rtree del GeoPackage) en lugar de un GeoJSON por celda
+    quadrants.to_file(output_file, layer='cuadrantes', driver='GPKG', SPATIAL_INDEX='YES')
+    print(f"{len(shp_data)} celdas divididas en {len(quadrants)} cuadrantes de 100 km: {output_file}")
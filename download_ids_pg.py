@@ -7,103 +7,224 @@ Script para descargar las imágenes satelitales de Planet via su Id y una base d
 
 from glob import glob
 import os
+import sys
 import json
 import shutil
-from matplotlib import pyplot as plt
-import numpy as np
-import rasterio
-import requests
-from requests.auth import HTTPBasicAuth
+import socket
+import threading
+from contextlib import contextmanager
+from functools import partial
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 import csv
-import paramiko
-from PIL import Image
 import warnings
-
-# Ignora los warnings de rasterio
-warnings.filterwarnings("ignore", category=UserWarning, module="PIL")
-
-# Si la variable API esta en el sistema operativo, se usa, de lo contrario se usa la API_KEY
-if os.environ.get('PL_API_KEY', ''):
-    API_KEY = os.environ.get('PL_API_KEY', '')
-else:
-    API_KEY = ''
-
-# Si la variable API esta en el sistema operativo, se usa, de lo contrario se usa la API_KEY
-if os.environ.get('PL_API_KEY', ''):
-    API_KEY = os.environ.get('PL_API_KEY', '')
-else:
-    API_KEY = ''
+from requests.exceptions import RequestException
+from planet_session import PLANET_API_URL, call_with_retries, configure_session, session_size
+from planet_download import CHUNK_SIZE, DOWNLOAD_PARTS, DownloadError, download_file, tee_download
+from planet_activation import get_assets, wait_for_activation
+from pipeline import DOWNLOAD_WORKERS, RENDER_WORKERS, TRANSFER_WORKERS, run_pipeline
+from metrics import get_metrics
+from profiling import enable_from_argv, profile_dir, profiled
+
+# Lado mayor en píxeles de los PNG de vista previa (None para generarlos a resolución completa);
+# se cambia sin editar el script con PL_PNG_MAX_SIZE (menú y planet_cli.py) o con --max-size en planet_cli.py download
+PNG_MAX_SIZE = int(os.getenv('PL_PNG_MAX_SIZE', 0)) or None
+# Filas que se procesan a la vez al generar el PNG
+PNG_BLOCK_ROWS = 512
+
+# Parametros de conexion a la base de datos
+DB_PARAMS = {
+    'database': "",
+    'user': "",
+    'password': "",
+    'host': "",
+    'port': "",
+}
+# Identificador de este worker en la cola de trabajo, duracion (segundos) y tamaño de los lotes arrendados
+WORKER_ID = '{}-{}'.format(socket.gethostname(), os.getpid())
+LEASE_SECONDS = 900
+LEASE_BATCH = 20
+# Numero maximo de conexiones abiertas por el pool (compartido por todos los workers)
+DB_MIN_CONN = 1
+DB_MAX_CONN = 8
+
+# Parametros del servidor de almacenamiento (ver sftp_pool.SFTPPool)
+# Con 'size' se cambia el numero de conexiones simultaneas (por defecto sftp_pool.SFTP_CONNECTIONS)
+SFTP_PARAMS = {
+    'host': '',
+    'username': '',
+    'password': '',
+}
+# Pathrows asignados a cada usuario para la descarga por usuario
+USER_PATHROWS = {
+    'Akemi': ['B27', 'B28', 'B29', 'C313', 'C315', 'C316', 'E526'],
+    'Fernando': ['A11', 'A12', 'D419', 'D420', 'D421', 'D422', 'D423'],
+    'Paty': ['C314', 'E527', 'E528', 'E529', 'F632', 'F633', 'F634'],
+    'Uriel': ['F635', 'F636', 'G741', 'G742', 'H846', 'H847', 'H848', 'I952', 'I953'],
+}
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+# Limita los prestamos simultaneos: el pool de psycopg2 falla en lugar de esperar si se agota
+_db_slots = threading.BoundedSemaphore(DB_MAX_CONN)
+
+_sftp_pool = None
+_sftp_pool_lock = threading.Lock()
+
+class TimedCursor(psycopg2.extensions.cursor):
+    '''Cursor que registra en db_segundos solo el tiempo de cada sentencia en el servidor
+    (execute_values tambien pasa por execute); no cuenta lo que el llamador hace con las filas'''
+
+    def execute(self, query, vars=None):
+        with get_metrics().timer('db_segundos'):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with get_metrics().timer('db_segundos'):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        with get_metrics().timer('db_segundos'):
+            return super().copy_expert(sql, file, size)
 
 def conect_db():
     '''Funcion que conecta a la base de datos'''
     print('Conectando a la base de datos')
     print('\n')
     # Crea una conexión a la base de datos
-    conn = psycopg2.connect(database="", \
-                            user="", \
-                            password="", \
-                            host="", \
-                            port="")
+    conn = psycopg2.connect(**DB_PARAMS)
     
     return conn
 
+def get_db_pool():
+    '''Funcion que devuelve el pool de conexiones compartido, creandolo la primera vez'''
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            print('Creando pool de conexiones a la base de datos')
+            _db_pool = psycopg2.pool.ThreadedConnectionPool(DB_MIN_CONN, DB_MAX_CONN, cursor_factory=TimedCursor, **DB_PARAMS)
+        return _db_pool
+
+def close_db_pool():
+    '''Funcion que cierra todas las conexiones del pool'''
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None:
+            _db_pool.closeall()
+            _db_pool = None
+
+@contextmanager
+def db_connection():
+    '''Funcion que presta una conexion del pool; hace commit al salir o rollback si hubo error.
+    Es segura para usarse desde varios hilos a la vez'''
+    with _db_slots:
+        pool = get_db_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+            # Las sentencias se miden en TimedCursor; aqui solo el commit
+            with get_metrics().timer('db_segundos'):
+                conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            # Si la conexion se cerro (p. ej. se reinicio el servidor) se descarta del pool
+            pool.putconn(conn, close=bool(conn.closed))
+
+# Migraciones del esquema de imagenes_planet, se aplican en orden y una sola vez
+MIGRATIONS = [
+    (1, 'Indice unico en id_planet para la carga masiva con ON CONFLICT', [
+        # Falla si ya hay ids duplicados en la tabla; deben depurarse antes de migrar
+        'CREATE UNIQUE INDEX IF NOT EXISTS imagenes_planet_id_planet_key ON imagenes_planet (id_planet)',
+    ]),
+    (2, 'Indices para las consultas por pathrow, fecha y estado de descarga', [
+        'CREATE INDEX IF NOT EXISTS imagenes_planet_pathrow_idx ON imagenes_planet (pathrow)',
+        'CREATE INDEX IF NOT EXISTS imagenes_planet_fecha_idx ON imagenes_planet (fecha)',
+        # Indice parcial: solo contiene las imagenes pendientes, que son las que se consultan al descargar
+        'CREATE INDEX IF NOT EXISTS imagenes_planet_pendientes_idx ON imagenes_planet (pathrow) WHERE descargada = false',
+        'ANALYZE imagenes_planet',
+    ]),
+    (3, 'Columnas de arrendamiento para repartir las descargas entre varios equipos', [
+        'ALTER TABLE imagenes_planet ADD COLUMN IF NOT EXISTS lease_owner TEXT',
+        'ALTER TABLE imagenes_planet ADD COLUMN IF NOT EXISTS lease_expira TIMESTAMPTZ',
+        'CREATE INDEX IF NOT EXISTS imagenes_planet_lease_owner_idx ON imagenes_planet (lease_owner) WHERE descargada = false',
+    ]),
+]
+
+def migrate_db():
+    '''Funcion que aplica las migraciones pendientes del esquema'''
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Evita que dos equipos apliquen las migraciones al mismo tiempo
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('imagenes_planet_migraciones'))")
+        cursor.execute('''CREATE TABLE IF NOT EXISTS imagenes_planet_esquema
+                    (version INTEGER PRIMARY KEY,
+                    descripcion TEXT,
+                    aplicada TIMESTAMP DEFAULT now());''')
+        cursor.execute('SELECT COALESCE(MAX(version), 0) FROM imagenes_planet_esquema')
+        actual = cursor.fetchone()[0]
+        for version, descripcion, sentencias in MIGRATIONS:
+            if version <= actual:
+                continue
+            print('Aplicando migracion {}: {}'.format(version, descripcion))
+            for sentencia in sentencias:
+                cursor.execute(sentencia)
+            cursor.execute('INSERT INTO imagenes_planet_esquema (version, descripcion) VALUES (%s, %s)', (version, descripcion))
+
 def create_db():
     '''Funcion que crea la base de datos'''
     print('Creando base de datos')
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-    cursor = conn.cursor()
-    
-    # Crea una tabla para almacenar los datos del CSV con el id secuencial, el id de planet, el pathrow, la fecha, la nubosidad, la visibilidad, el tipo y si ha sido descargada
-    cursor.execute('''CREATE TABLE imagenes_planet
-                (id SERIAL PRIMARY KEY,
-                id_planet TEXT,
-                linea_numero TEXT,
-                pathrow TEXT,
-                id_mex INTEGER,
-                fecha DATE,
-                nubosidad FLOAT,
-                visibilidad FLOAT,
-                tipo TEXT,
-                temporada TEXT,
-                descargada BOOLEAN);''')
-    
-    # Guarda los cambios en la base de datos
-    conn.commit()
-
-    # Cierra la conexión
-    conn.close()
+    # Toma una conexión del pool
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Crea una tabla para almacenar los datos del CSV con el id secuencial, el id de planet, el pathrow, la fecha, la nubosidad, la visibilidad, el tipo y si ha sido descargada
+        cursor.execute('''CREATE TABLE imagenes_planet
+                    (id SERIAL PRIMARY KEY,
+                    id_planet TEXT,
+                    linea_numero TEXT,
+                    pathrow TEXT,
+                    id_mex INTEGER,
+                    fecha DATE,
+                    nubosidad FLOAT,
+                    visibilidad FLOAT,
+                    tipo TEXT,
+                    temporada TEXT,
+                    descargada BOOLEAN);''')
+        # Los cambios se guardan al devolver la conexión al pool
+
+    # Crea los indices y columnas de las migraciones
+    migrate_db()
+
+def prepare_db():
+    '''Funcion que crea la tabla si no existe o aplica las migraciones pendientes a una existente'''
+    # Comprueba si la base de datos existe
+    if check_db() == False:
+        # Crea la base de datos
+        create_db()
+    else:
+        # Aplica las migraciones pendientes a una base de datos existente
+        migrate_db()
 
 def check_db():
     '''Funcion que verifica si la base de datos existe'''
     print('Verificando si la base de datos existe')
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-
-    # Verifica si la tabla existe
-    cursor = conn.cursor()
-    cursor.execute("SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name=%s)", ('imagenes_planet',))
-    exists = cursor.fetchone()[0]
-
-    # Cierra la conexión
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Verifica si la tabla existe
+        cursor.execute("SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name=%s)", ('imagenes_planet',))
+        exists = cursor.fetchone()[0]
 
     return exists
 
 def check_pathrow(pathrow):
     '''Funcion que verifica si el pathrow existe'''
     print('Verificando si el pathrow existe')
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-
-    # Verifica si la tabla existe
-    cursor = conn.cursor()
-    cursor.execute("SELECT EXISTS(SELECT * FROM imagenes_planet WHERE pathrow=%s)", (pathrow,))
-    exists = cursor.fetchone()[0]
-
-    # Cierra la conexión
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Verifica si la tabla existe
+        cursor.execute("SELECT EXISTS(SELECT * FROM imagenes_planet WHERE pathrow=%s)", (pathrow,))
+        exists = cursor.fetchone()[0]
 
     return exists
 
@@ -111,112 +232,176 @@ def check_pathrow(pathrow):
 def check_pathrow_not_download(pathrows):
     '''Funcion que verifica si el pathrow existe'''
     print('Verificando si el pathrow tiene imagenes no descargadas')
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-
-    # Verifica los pathrows que ya no tienen imagenes no descargadas
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT pathrow FROM imagenes_planet WHERE descargada = false")
-    pathrows_download = cursor.fetchall()
-
-    # Paso la lista de tuplas a una lista de strings
-    pathrows_download = [pathrow[0] for pathrow in pathrows_download]
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Solo se consultan los pathrows de la lista que aun tienen imagenes no descargadas
+        cursor.execute("SELECT DISTINCT pathrow FROM imagenes_planet WHERE descargada = false AND pathrow = ANY(%s)", (list(pathrows),))
+        pathrows_download = {pathrow[0] for pathrow in cursor.fetchall()}
     
-    # Elimina de la lista de pathrows los que ya no tienen imagenes no descargadas
-    pathrows_not_download = []
-    for pathrow in pathrows:
-        if pathrow in pathrows_download:
-            pathrows_not_download.append(pathrow)
-
-    # Cierra la conexión
-    conn.close()
+    # Conserva el orden de la lista original
+    pathrows_not_download = [pathrow for pathrow in pathrows if pathrow in pathrows_download]
 
     return pathrows_not_download
 
 def update_db(csv_file):
-    '''Funcion que actualiza la base de datos con los datos del CSV'''
+    '''Funcion que actualiza la base de datos con los datos del CSV
+    El CSV se copia con COPY a una tabla temporal y se une a imagenes_planet con un solo
+    INSERT ... ON CONFLICT (id_planet) DO NOTHING. Devuelve (insertadas, omitidas)'''
     print('Actualizando base de datos')
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-    cursor = conn.cursor()
-    
-    # Lee los datos del CSV y los inserta en la tabla
     with open(csv_file, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        data = [(row['id_planet'], row['linea_numero'], row['pathrow'], row['id_mex'], row['fecha'], row['nubosidad'], row['visibilidad'], row['tipo'], row['temporada'], row['descargada'].lower() == 'true') for row in reader]
-
-        # Verifica si los datos ya existen en la base de datos
-        for row in data:
-            cursor.execute("SELECT * FROM imagenes_planet WHERE id_planet = %s", (row[0],))
-            if cursor.fetchone() is None:
-                # Si no existen, los inserta
-                cursor.execute("INSERT INTO imagenes_planet (id_planet, linea_numero, pathrow, id_mex, fecha, nubosidad, visibilidad, tipo, temporada, descargada) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", row)
-
-    # Guarda los cambios en la base de datos
-    conn.commit()
-
-    # Cierra la conexión
-    conn.close()
+        # Las columnas de la tabla temporal son las del encabezado del CSV
+        columnas = next(csv.reader(csvfile))
+        csvfile.seek(0)
+
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute(sql.SQL('CREATE TEMP TABLE imagenes_planet_staging ({}) ON COMMIT DROP').format(
+                sql.SQL(', ').join(sql.SQL('{} TEXT').format(sql.Identifier(c)) for c in columnas)))
+            # El CSV se envia al servidor por bloques, sin cargarlo completo en memoria
+            cursor.copy_expert(sql.SQL('COPY imagenes_planet_staging ({}) FROM STDIN WITH (FORMAT csv, HEADER true)').format(
+                sql.SQL(', ').join(sql.Identifier(c) for c in columnas)), csvfile)
+            total = cursor.rowcount
+
+            # Inserta solo los ids que aun no existen
+            cursor.execute('''INSERT INTO imagenes_planet (id_planet, linea_numero, pathrow, id_mex, fecha, nubosidad, visibilidad, tipo, temporada, descargada)
+                              SELECT id_planet, linea_numero, pathrow, NULLIF(id_mex, '')::INTEGER, NULLIF(fecha, '')::DATE,
+                                     NULLIF(nubosidad, '')::FLOAT, NULLIF(visibilidad, '')::FLOAT, tipo, temporada,
+                                     COALESCE(lower(descargada) = 'true', false)
+                              FROM imagenes_planet_staging
+                              ON CONFLICT (id_planet) DO NOTHING''')
+            insertadas = cursor.rowcount
+
+    omitidas = total - insertadas
+    print('Filas en el CSV: {}, insertadas: {}, omitidas (ya existian): {}'.format(total, insertadas, omitidas))
+    return insertadas, omitidas
 
 
 def select_db(query,value):
     '''Funcion que selecciona los datos de la base de datos'''
     print('Consulatando ids de acuerdo a la variable de consulta')
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-    # Selecciona los ids de las imágenes
-    cursor = conn.cursor()
-    # Si es una consulta de tipo fecha, se usa el operador >=
-    if query == 'fecha':
-        cursor.execute('SELECT * FROM imagenes_planet WHERE '+query+' >= %s', (value,))
-    else:
-        cursor.execute('SELECT * FROM imagenes_planet WHERE '+query+' = %s', (value,))
-    # Obtiene los ids de las imágenes
-    ids_planet = []
-    for row in cursor:
-        ids_planet.append(row)
-    # Cierra la conexión
-    cursor.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Selecciona los ids de las imágenes
+        # Si es una consulta de tipo fecha, se usa el operador >=
+        if query == 'fecha':
+            cursor.execute(sql.SQL('SELECT * FROM imagenes_planet WHERE {} >= %s').format(sql.Identifier(query)), (value,))
+        else:
+            cursor.execute(sql.SQL('SELECT * FROM imagenes_planet WHERE {} = %s').format(sql.Identifier(query)), (value,))
+        # Obtiene los ids de las imágenes
+        ids_planet = []
+        for row in cursor:
+            ids_planet.append(row)
     return ids_planet
 
 def select_db_not_download(query,values):
     '''Funcion que selecciona los datos de la base de datos que no han sido descargadas'''
     print('Consulatando ids de acuerdo a la variable de consulta')
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-    # Selecciona los ids de las imágenes que no han sido descargadas
-    cursor = conn.cursor()
-    # Define la lista de ids de las imágenes
-    ids_planet = []
-    # Intera sobre los pathrows
-    for value in values:
-        cursor.execute('SELECT * FROM imagenes_planet WHERE '+query+' = %s AND descargada = %s', (value, False))
-        # Obtiene los ids de las imágenes    
-        for row in cursor:
-            ids_planet.append(row)
-    # Cierra la conexión
-    cursor.close()
-    conn.close()
+    # Un solo valor (p. ej. un pathrow) se trata como lista de un elemento
+    if isinstance(values, str):
+        values = [values]
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Selecciona en una sola consulta los ids de las imágenes que no han sido descargadas,
+        # en el orden de la lista de valores
+        cursor.execute(sql.SQL('SELECT * FROM imagenes_planet WHERE {0} = ANY(%s) AND descargada = false '
+                               'ORDER BY array_position(%s::text[], {0}::text), id').format(sql.Identifier(query)),
+                       (list(values), [str(value) for value in values]))
+        # Obtiene los ids de las imágenes
+        ids_planet = cursor.fetchall()
     return ids_planet
 
 def update_db_downloaded(ids_planet):
     '''Funcion que actualiza la base de datos con los ids de las imagenes que han sido descargadas'''
     print('Actualizando base de datos')
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-    cursor = conn.cursor()
-    
-    # Actualiza la base de datos con los ids de las imagenes que han sido descargadas
-    for row in ids_planet:
-        cursor.execute("UPDATE imagenes_planet SET descargada = %s WHERE id_planet = %s", (True, row[0]))
-
-    # Guarda los cambios en la base de datos
-    conn.commit()
-
-    # Cierra la conexión
-    cursor.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Actualiza la base de datos con los ids de las imagenes que han sido descargadas, por lotes
+        # Tambien libera el arrendamiento de la imagen
+        execute_values(cursor, '''UPDATE imagenes_planet AS t SET descargada = true, lease_owner = NULL, lease_expira = NULL
+                                  FROM (VALUES %s) AS v(id_planet)
+                                  WHERE t.id_planet = v.id_planet''', [(row[0],) for row in ids_planet], page_size=1000)
+
+def claim_batch(limit = LEASE_BATCH, pathrows = None, owner = WORKER_ID, lease_seconds = LEASE_SECONDS):
+    '''Funcion que arrienda un lote de imagenes no descargadas para este worker
+    Las filas bloqueadas por otro worker se saltan (SKIP LOCKED) y los arrendamientos vencidos se reclaman'''
+    print('Arrendando hasta {} imagenes para {}'.format(limit, owner))
+    filtro = sql.SQL('')
+    params = [owner, lease_seconds]
+    if pathrows:
+        filtro = sql.SQL('AND pathrow = ANY(%s)')
+        params.append(list(pathrows))
+    params.append(limit)
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute(sql.SQL('''UPDATE imagenes_planet SET lease_owner = %s, lease_expira = now() + make_interval(secs => %s)
+                                  WHERE id IN (SELECT id FROM imagenes_planet
+                                               WHERE descargada = false
+                                               AND (lease_expira IS NULL OR lease_expira < now()) {}
+                                               ORDER BY id LIMIT %s
+                                               FOR UPDATE SKIP LOCKED)
+                                  RETURNING *''').format(filtro), params)
+        rows = sorted(cursor.fetchall())
+    return rows
+
+def heartbeat_leases(ids_planet, owner = WORKER_ID, lease_seconds = LEASE_SECONDS):
+    '''Funcion que extiende los arrendamientos de este worker sobre las imagenes ids_planet (el lote en curso)
+    Los arrendamientos de lotes anteriores que fallaron no se extienden, asi vencen y otro worker los reintenta.
+    Devuelve el numero de filas extendidas'''
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''UPDATE imagenes_planet SET lease_expira = now() + make_interval(secs => %s)
+                          WHERE lease_owner = %s AND descargada = false AND id_planet = ANY(%s)''',
+                       (lease_seconds, owner, list(ids_planet)))
+        return cursor.rowcount
+
+def release_leases(owner = WORKER_ID):
+    '''Funcion que libera los arrendamientos de este worker que no se descargaron'''
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute('''UPDATE imagenes_planet SET lease_owner = NULL, lease_expira = NULL
+                          WHERE lease_owner = %s AND descargada = false''', (owner,))
+        return cursor.rowcount
+
+def download_leased(descarga, pathrows = None, batch = LEASE_BATCH, owner = WORKER_ID, lease_seconds = LEASE_SECONDS, png_max_size = PNG_MAX_SIZE,
+                    download_workers = DOWNLOAD_WORKERS, render_workers = RENDER_WORKERS, transfer_workers = TRANSFER_WORKERS):
+    '''Funcion que descarga imagenes de la cola de trabajo compartida hasta que no quedan pendientes
+    Varios equipos pueden ejecutarla contra la misma base de datos sin descargar la misma imagen
+    Los workers de cada etapa se pasan a download_images
+    Devuelve (procesadas, fallidas) de todos los lotes'''
+    detener = threading.Event()
+    # Ids del lote que se esta procesando; el hilo de latido solo extiende esos arrendamientos
+    en_curso = []
+
+    def latido():
+        # Extiende los arrendamientos mientras el lote se procesa
+        while not detener.wait(lease_seconds / 3):
+            lote = list(en_curso)
+            if not lote:
+                continue
+            try:
+                heartbeat_leases(lote, owner, lease_seconds)
+            except psycopg2.Error as e:
+                print('Error al extender los arrendamientos: {}'.format(e))
+
+    hilo = threading.Thread(target=latido, daemon=True)
+    hilo.start()
+    procesadas = fallidas = 0
+    try:
+        while True:
+            ids_planet = claim_batch(batch, pathrows, owner, lease_seconds)
+            if not ids_planet:
+                print('No quedan imagenes pendientes sin arrendar')
+                break
+            en_curso[:] = [row[1] for row in ids_planet]
+            # Solo transfer_image marca una imagen como descargada y libera su arrendamiento. Las que fallan en
+            # cualquier etapa (descarga, png o transferencia) siguen con descargada = false y conservan el
+            # arrendamiento hasta que vence (el latido solo extiende el lote en curso); entonces este u otro
+            # worker las vuelve a arrendar, sin ciclar sobre el mismo error
+            ok, errores = download_images(descarga, pathrows, ids_planet, png_max_size=png_max_size,
+                                          download_workers=download_workers, render_workers=render_workers,
+                                          transfer_workers=transfer_workers)
+            procesadas += ok
+            fallidas += errores
+    except KeyboardInterrupt:
+        # Si se interrumpe, las imagenes pendientes quedan disponibles de inmediato para otros workers
+        print('Liberando {} arrendamientos'.format(release_leases(owner)))
+        raise
+    finally:
+        detener.set()
+        hilo.join()
+    return procesadas, fallidas
 
 def print_data(ids_planet):
     '''Funcion que imprime los datos de las imagenes'''
@@ -228,174 +413,295 @@ def print_data(ids_planet):
 
 def get_pathrow(image_id):
     '''Funcion que obtiene el pathrow de acuerdo al id de la imagen'''
-    # Crea una conexión a la base de datos
-    conn = conect_db()
-    # Selecciona los ids de las imágenes
-    cursor = conn.cursor()
-    cursor.execute('SELECT pathrow FROM imagenes_planet WHERE id_planet = %s', (image_id,))
-    # Obtiene el pathrow de la imagen
-    pathrow = cursor.fetchone()[0]
-    # Cierra la conexión
-    cursor.close()
-    conn.close()
+    with db_connection() as conn, conn.cursor() as cursor:
+        # Selecciona los ids de las imágenes
+        cursor.execute('SELECT pathrow FROM imagenes_planet WHERE id_planet = %s', (image_id,))
+        # Obtiene el pathrow de la imagen
+        pathrow = cursor.fetchone()[0]
     return pathrow
 
-def obtain_url(image_id, item_type, product_type):
-    '''Funcion que obtiene la URL de descarga de la imagen satelital usando el id de la imagen y el item_type
+def obtain_asset(image_id, item_type, product_type):
+    '''Funcion que obtiene el asset de la imagen satelital usando el id de la imagen y el item_type
     item_type = "PSScene"
     product_type = "ortho_analytic_8b_sr"'''
 
-    # Obtiene la URL de descarga de la imagen    
-    url = "https://api.planet.com/data/v1/item-types/{}/items/{}/assets/".format(item_type, image_id)
-    response = requests.get(url, auth=HTTPBasicAuth(API_KEY, ''))
-
-    print(response.json()[product_type]['status'])
-
-    link = response.json()[product_type]["_links"]
-    self_link = link["_self"]
-    activation_link = link["activate"]
-
-    # Activar la imagen
-    activate_result = \
-        requests.get(
-            activation_link,
-            auth=HTTPBasicAuth(API_KEY, '')
-        )    
-    activation_status_result = \
-        requests.get(
-            self_link,
-            auth=HTTPBasicAuth(API_KEY, '')
-        )
-    
-    activation_status = activation_status_result.json()[u"status"]    
-    print(activation_status)
-    # Hasta que se active la imagen, se espera
-    """ while activation_status != u"active":
-        activation_status_result = \
-            requests.get(
-                self_link,
-                auth=HTTPBasicAuth(API_KEY, '')
-            )
-        activation_status = activation_status_result.json()[u"status"]
-        print(activation_status) """
-
-    # Activar todas las imagenes
-    activation_status_result = \
-    requests.get(
-        self_link,
-        auth=HTTPBasicAuth(API_KEY, '')
-    )
-    activation_status = activation_status_result.json()[u"status"]
-
-    # Si esta activa, se obtiene la URL de descarga
-    if activation_status == u"active":        
-        print(activation_status)
-        download_link = activation_status_result.json()["location"]
-        print(download_link)
-        return download_link
-    else:
-        print('La imagen {} se esta activando'.format(image_id))
+    url = "{}/item-types/{}/items/{}/assets/".format(PLANET_API_URL, item_type, image_id)
+    assets = get_assets(url)
+    if assets is None:
+        return None
+    if product_type not in assets:
+        print('El producto {} no esta disponible para la imagen {}'.format(product_type, image_id))
+        return None
+
+    print(assets[product_type]['status'])
+    return assets[product_type]
+
+def obtain_active_asset(image_id, item_type, product_type):
+    '''Funcion que activa el asset de la imagen y espera hasta que este activo
+    Devuelve el asset con la URL de descarga (location) y el md5 (md5_digest), o None si falla'''
+    asset = obtain_asset(image_id, item_type, product_type)
+    if asset is None:
         return None
 
+    # Activa la imagen y espera hasta que este activa, consultando con espera exponencial
+    for _, active_asset in wait_for_activation([(image_id, asset)]):
+        print(active_asset["location"])
+        return active_asset
+
+    print('La imagen {} no se activo a tiempo'.format(image_id))
+    return None
+
+def obtain_url(image_id, item_type, product_type):
+    '''Funcion que obtiene la URL de descarga de la imagen satelital usando el id de la imagen y el item_type
+    item_type = "PSScene"
+    product_type = "ortho_analytic_8b_sr"'''
+    asset = obtain_active_asset(image_id, item_type, product_type)
+    return None if asset is None else asset["location"]
+
+def get_sftp_pool():
+    '''Funcion que devuelve el pool de conexiones SFTP compartido, creandolo la primera vez'''
+    global _sftp_pool
+    with _sftp_pool_lock:
+        if _sftp_pool is None:
+            # paramiko se importa solo cuando se usa el servidor
+            from sftp_pool import SFTPPool
+            _sftp_pool = SFTPPool(**SFTP_PARAMS)
+        return _sftp_pool
+
+def close_sftp_pool():
+    '''Funcion que cierra las conexiones SFTP abiertas'''
+    global _sftp_pool
+    with _sftp_pool_lock:
+        if _sftp_pool is not None:
+            _sftp_pool.close()
+            _sftp_pool = None
+
 def move_image_server(files, pathrow):
+    '''Funcion que envia los archivos de una imagen al servidor por SFTP usando el pool de conexiones
+    Los archivos se suben en paralelo y cada uno se elimina localmente solo si su tamaño remoto coincide'''
     # Ruta donde se guardan las imagenes
     path = './planet_images/'
-    pathTmp = './tmp/'
-    # Crea una instancia del cliente SSH
-    ssh = paramiko.SSHClient()
-    # Configura el cliente SSH para que acepte la clave del host automáticamente
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    # Conéctate al servidor remoto
-    ssh.connect('', username='', password='')
-    # Crea una instancia del objeto SFTP
-    sftp = ssh.open_sftp()
-
-    # Si no existe el directorio de planet_image mas el pathrow, se crea
-    try:
-        sftp.chdir(path + pathrow)
-    except IOError:
-        sftp.mkdir(path + pathrow)
-        sftp.chdir(path + pathrow)
-    #try:
-        #sftp_destino.chdir(path + pathrow)
-        #sftp.chdir(path + pathrow)
-    #except IOError:
-        #sftp_destino.mkdir(path + pathrow)
-        #sftp_destino.chdir(path + pathrow)
-        #sftp.mkdir(path + pathrow)
-        #sftp.chdir(path + pathrow)
-    # Transfiere los archivos al servidor remoto
-    for file in files:
-        #sftp.put(file, file)
-    # Mueve las imagenes al almacenamiento de imagenes de planet de mas capacidad
-        #sftp.get(file, sftp_destino.put)
-        sftp.put(file, file.split('\\')[-1])
-        # Elimina las imagenes del servidor local
-        os.remove(file)
-    # Cierra la conexión SFTP y SSH
-    sftp.close()
-    #sftp_destino.close()
-    ssh.close()
-    #ssh_destino.close()
-
-def extract_rgb(pathImg):
-    '''Función que extrae las bandas 6, 4 y 2 de una imagen satelital y las guarda en una lista'''
+    # Transfiere los archivos al servidor remoto y elimina las imagenes del servidor local
+    get_sftp_pool().put_many(files, path + pathrow, remove=True)
+
+def import_rasterio():
+    '''Función que importa rasterio e ignora sus warnings de imágenes sin georreferencia
+    Se llama al generar los PNG, así las consultas a la base de datos no pagan el tiempo de importarlo'''
+    import rasterio
+    warnings.filterwarnings("ignore", category=rasterio.errors.NotGeoreferencedWarning)
+    return rasterio
+
+def preview_shape(src, max_size=None):
+    '''Función que calcula el tamaño de salida (alto, ancho) y la transformada para que el lado mayor no pase de max_size'''
+    from rasterio.transform import Affine
+    if max_size is None or max(src.height, src.width) <= max_size:
+        return src.height, src.width, src.transform
+    factor = max(src.height, src.width) / max_size
+    alto = max(1, int(round(src.height / factor)))
+    ancho = max(1, int(round(src.width / factor)))
+    # La transformada se escala para que el PNG reducido conserve la misma extensión
+    transformada = src.transform * Affine.scale(src.width / ancho, src.height / alto)
+    return alto, ancho, transformada
+
+def extract_rgb(pathImg, max_size=None):
+    '''Función que extrae las bandas 6, 4 y 2 de una imagen satelital y las guarda en una lista
+    max_size: si se indica, las bandas se leen reducidas (usando las vistas generales si existen) para que el lado mayor no pase de max_size'''
+    rasterio = import_rasterio()
+    from rasterio.enums import Resampling
     # Crear nueva lista para rgb -> numpy
     lista_bandas = []
     # Se abre la imagen, se leen y guardan las bandas en lista, el crs y la transformada
     with rasterio.open(pathImg + '.tif') as src:
-        lista_bandas = [src.read(band) for band in [6, 4, 2]]
+        alto, ancho, transformada = preview_shape(src, max_size)
+        # Vecino más cercano para que los píxeles sin datos sigan siendo 0 y queden transparentes
+        lista_bandas = [src.read(band, out_shape=(alto, ancho), resampling=Resampling.nearest) for band in [6, 4, 2]]
         cord_system = src.crs
-        transformada = src.transform
 
     # La función devuelve la lista con los numpy, la crs y transformada
     return lista_bandas, cord_system, transformada
 
-def create_png(filename):
-    '''Función que crea un archivo png georreferenciado a partir de un archivo tif'''
-    lista_bandas, cord_system, transformada = extract_rgb(filename)
+def create_png(filename, max_size=PNG_MAX_SIZE, block_rows=PNG_BLOCK_ROWS):
+    '''Función que crea un archivo png georreferenciado a partir de un archivo tif
+    max_size: lado mayor del PNG en píxeles (None para la resolución completa)
+    block_rows: número de filas que se reescalan a la vez, limita el tamaño de los arreglos temporales'''
+    import numpy as np
+    rasterio = import_rasterio()
+    # Con --profile se mide aparte la memoria de la lectura de las bandas
+    with profiled('extract_rgb', os.path.basename(filename), cpu=False):
+        lista_bandas, cord_system, transformada = extract_rgb(filename, max_size)
     # Obtener los valores mínimos y máximos de todas las bandas
     min_value = min([band.min() for band in lista_bandas])
-    max_value = max([band.max() for band in lista_bandas])   
-    # Reescalar cada banda de 0 a 255
-    rescaled_bandas = [(band - min_value) * (255 / (max_value - min_value)) for band in lista_bandas]
-    # Convertir las bandas a tipo de datos uint8
-    rescaled_bandas = [band.astype('uint8') for band in rescaled_bandas]
-    # Combinar las bandas en una imagen RGB
-    rgb_image = np.dstack(rescaled_bandas)
-    # Guardar la imagen PNG 
+    max_value = max([band.max() for band in lista_bandas])
+    escala = 255 / (max_value - min_value) if max_value > min_value else 0
+    alto, ancho = lista_bandas[0].shape
+    # Arreglo RGBA en el orden de bandas de rasterio (banda, fila, columna)
+    rgba = np.empty((4, alto, ancho), dtype=np.uint8)
+    # Reescalar cada banda de 0 a 255 y convertirla a uint8 por bloques de filas
+    for fila in range(0, alto, block_rows):
+        bloque = slice(fila, fila + block_rows)
+        for i, band in enumerate(lista_bandas):
+            rgba[i, bloque] = (band[bloque] - min_value) * escala
+        # Transparencia: los píxeles negros (0, 0, 0) quedan con alfa 0, el resto con 255
+        np.multiply(rgba[:3, bloque].any(axis=0), 255, out=rgba[3, bloque], casting='unsafe')
+    # Las bandas originales ya no se necesitan
+    del lista_bandas
+    # Guardar el PNG una sola vez con el crs y la transformada
     output_file = filename + '.png'
-    plt.imsave(output_file, rgb_image, origin='upper', vmin=1)
-    # Abre el archivo PNG y baja su resolución al 25% pero mantiene el tamaño
-    img = Image.open(output_file)
-    # Agrega lo trasparencia al PNG
-    # Obtener la matriz de píxeles de la imagen
-    pixels = img.load()
-    # Iterar sobre los píxeles de la imagen
-    for y in range(img.height):
-        for x in range(img.width):
-            # Verificar si el valor del píxel es 0, 0, 0, 255
-            if pixels[x, y] == (0, 0, 0, 255):
-                # Establecer el valor del píxel como transparente (0, 0, 0, 0)
-                pixels[x, y] = (0, 0, 0, 0)
-    # Guarda la imagen con la transparencia
-    img.save(output_file, format="PNG", compress_level=5)
-    # Abrir el archivo PNG y agregar los metadatos
-    with rasterio.open(output_file, 'r+') as dst:
-        dst.crs = cord_system
-        dst.transform = transformada
-
-def download_image(descarga, pathrow, image_id, mex_id, item_type = 'PSScene', product_type = 'ortho_analytic_8b_sr'):
+    with rasterio.open(output_file, 'w', driver='PNG', width=ancho, height=alto, count=4, dtype='uint8',
+                       crs=cord_system, transform=transformada, ZLEVEL=5) as dst:
+        dst.write(rgba)
+
+def fetch_image(image_id, mex_id, download_link, expected_md5 = None, parts = DOWNLOAD_PARTS, chunk_size = CHUNK_SIZE):
+    '''Funcion que descarga la imagen en ./tmp y devuelve la ruta sin extension (None si falla)
+    La imagen se marca como descargada hasta que transfer_image la deja en su destino'''
+    # Guarda la imagen en el disco local
+    pathTmp = './tmp/'
+    name = "{}_{}".format(image_id, mex_id)
+    # Verifica si el directorio existe, si no existe lo crea
+    if not os.path.exists(pathTmp):
+        os.makedirs(pathTmp, exist_ok=True)
+    # Descarga la imagen en un .part reanudable que solo se renombra a .tif si el tamaño y el md5 coinciden
+    try:
+        with profiled('descarga', name) as info:
+            download_file(download_link, pathTmp + name + '.tif', parts=parts, expected_md5=expected_md5, chunk_size=chunk_size)
+            info.update(bytes=os.path.getsize(pathTmp + name + '.tif'), partes=parts, chunk_size=chunk_size)
+    except (RequestException, DownloadError) as e:
+        print('Error al descargar la imagen {}: {}'.format(image_id, e))
+        return None
+    # Verifica si la imagen se descargo correctamente
+    if os.path.exists(pathTmp + name + '.tif'):
+        print('Imagen {} descargada correctamente'.format(image_id))
+
+        # Comprime la imagen descargada en un archivo .tar
+        #tar_name = "{}.tar".format(image_id)
+        #with tarfile.open(tar_name, "w") as tar:
+        #    tar.add(name)
+        
+        # Borra la imagen .tif
+        #os.remove(name)
+        #print('Imagen {} comprimida y eliminada'.format(image_id))
+    else:
+        print('Error al descargar la imagen {}'.format(image_id))
+        return None
+
+    return pathTmp + name
+
+def stream_image_server(image_id, mex_id, download_link, expected_md5 = None, chunk_size = CHUNK_SIZE):
+    '''Funcion que envia la imagen directo de Planet al servidor por SFTP, sin descargarla primero a ./tmp
+    El flujo HTTP se escribe a la vez en el archivo remoto y en la copia local que solo usa create_png
+    para la vista previa, con colas acotadas entre ambos. El md5 se calcula sobre el flujo, asi el tif
+    no se vuelve a leer del disco. Devuelve la ruta local sin extension (None si falla)'''
+    # paramiko solo se necesita para las descargas que van al servidor
+    import paramiko
+    pathTmp = './tmp/'
+    name = "{}_{}".format(image_id, mex_id)
+    os.makedirs(pathTmp, exist_ok=True)
+    pathrow = get_pathrow(image_id)
+    remote_path = './planet_images/{}/{}.tif'.format(pathrow, name)
+
+    def transferir():
+        with get_sftp_pool().writer(remote_path) as remote, open(pathTmp + name + '.tif', 'wb') as local:
+            size, md5 = tee_download(download_link, [remote, local], chunk_size)
+            # Si el md5 no coincide se lanza el error dentro del writer para que no se renombre el archivo remoto
+            if expected_md5 and md5 != expected_md5:
+                raise DownloadError('md5 de la imagen {} distinto al reportado por Planet'.format(image_id))
+        return size
+
+    try:
+        with profiled('descarga_directa', name) as info:
+            size = call_with_retries(transferir)
+            info.update(bytes=size, chunk_size=chunk_size)
+    except (RequestException, DownloadError, IOError, paramiko.SSHException) as e:
+        print('Error al enviar la imagen {} al servidor: {}'.format(image_id, e))
+        for file in glob(pathTmp + name + '*'):
+            os.remove(file)
+        return None
+
+    print('Imagen {} enviada al servidor ({} bytes)'.format(image_id, size))
+    # La imagen se marca como descargada en transfer_image, cuando el png tambien esta en el servidor
+    return pathTmp + name
+
+def raster_info(pathImg):
+    '''Funcion que devuelve el tamaño, numero de bandas, tipo de dato y bytes de una imagen (para los perfiles)'''
+    rasterio = import_rasterio()
+    with rasterio.open(pathImg) as src:
+        return {'alto': src.height, 'ancho': src.width, 'bandas': src.count, 'tipo': src.dtypes[0],
+                'bytes': os.path.getsize(pathImg)}
+
+def render_image(item, max_size = PNG_MAX_SIZE):
+    '''Funcion que crea el png georreferenciado de una imagen descargada, item = (image_id, ruta sin extension)
+    Se ejecuta en un proceso aparte dentro del pipeline, por eso max_size se pasa como argumento'''
+    with profiled('png', os.path.basename(item[1])) as info:
+        if profile_dir():
+            info.update(raster_info(item[1] + '.tif'), max_size=max_size)
+        create_png(item[1], max_size)
+
+def transfer_image(descarga, item, pathrow = None):
+    '''Funcion que mueve los archivos de la imagen a planet_images o al servidor, item = (image_id, ruta sin extension)
+    y solo entonces marca la imagen como descargada en la base de datos
+    pathrow: si no se indica se consulta en la base de datos con el id de la imagen'''
+    image_id, path = item
+    # Obtiene el pathrow de la imagen con el id
+    if pathrow is None:
+        pathrow = get_pathrow(image_id)
+
+    print('Pathrow: {}'.format(pathrow))
+
+    # Enlista los archivos .tif, .png y .xml
+    files = glob(path + '*')
+    
+    # Si la descarga es en local la deja en la carpeta planet_images
+    if descarga == 'local':
+        # Si no existe la carpeta planet_images mas el pathrow, la crea
+        if not os.path.exists('planet_images/{}'.format(pathrow)):
+            os.makedirs('planet_images/{}'.format(pathrow), exist_ok=True)
+        # Mueve la imagen de la carpeta actual a la carpeta planet_images mas el pathrow
+        for file in files:
+            shutil.move(file, 'planet_images/{}/'.format(pathrow))
+    # Si la descarga es en servidor la mueve de la carpeta planet_images al servidor
+    elif descarga == 'servidor':
+        move_image_server(files, pathrow)
+    # Si la descarga fue directa al servidor el tif ya esta ahi, solo se envia el png y se borra la copia local
+    elif descarga == 'directo':
+        move_image_server([file for file in files if not file.endswith('.tif')], pathrow)
+        os.remove(path + '.tif')
+
+    # Actualiza la base de datos con el id de la imagen que ha sido descargada
+    update_db_downloaded([(image_id,)])
+
+def discard_image(item, stage, error = None):
+    '''Funcion que elimina de ./tmp los archivos de una imagen cuyo png no se pudo generar
+    Si fallo la transferencia los archivos se conservan en ./tmp: la imagen no se marco como descargada
+    y se vuelve a intentar, pero la copia local no se pierde'''
+    image_id, path = item
+    if stage == 'transferencia':
+        print('No se pudo transferir la imagen {}, sus archivos quedan en ./tmp: {}'.format(image_id, error))
+        return
+    print('No se pudo procesar la imagen {}: {}'.format(image_id, error))
+    for file in glob(path + '*'):
+        os.remove(file)
+
+def download_image(descarga, pathrow, image_id, mex_id, item_type = 'PSScene', product_type = 'ortho_analytic_8b_sr', download_link = None, expected_md5 = None, parts = DOWNLOAD_PARTS, chunk_size = CHUNK_SIZE, png_max_size = PNG_MAX_SIZE):
     # Funcion que descarga la imagen satelital
     # item_type = "PSScene"
     # product_type = "ortho_analytic_8b_sr"
+    # download_link: URL de descarga si la imagen ya fue activada (ver download_images)
+    # expected_md5: md5 reportado por Planet para verificar la descarga
+    # parts: numero de rangos en paralelo para archivos grandes
+    # chunk_size: tamaño en bytes de los bloques escritos a disco, la memoria por descarga no depende del tamaño de la escena
+    # png_max_size: lado mayor del PNG de vista previa (None para la resolución completa)
 
     # Imprime el id de la imagen que se esta descargando
     print('Descargando imagen {}'.format(image_id))
 
     # Obtiene la URL de descarga
     #try:
-    download_link = obtain_url(image_id, item_type, product_type)
+    if download_link is None:
+        # Se usa el asset activo completo para verificar la descarga con su md5
+        asset = obtain_active_asset(image_id, item_type, product_type)
+        if asset is not None:
+            download_link = asset["location"]
+            expected_md5 = expected_md5 or asset.get("md5_digest")
     #except KeyError as e:
     #    print('No se pudo obtener la URL de descarga de la imagen {}'.format(image_id))
     #    return
@@ -403,60 +709,53 @@ def download_image(descarga, pathrow, image_id, mex_id, item_type = 'PSScene', p
     # Si no se obtuvo la URL de descarga, se sale de la funcion
     if download_link is None:
         return
-    
+
+    if descarga == 'directo':
+        path = stream_image_server(image_id, mex_id, download_link, expected_md5, chunk_size)
     else:
-        # Descarga la imagen
-        r = requests.get(download_link, auth=HTTPBasicAuth(API_KEY, ''))
-
-        # Guarda la imagen en el disco local
-        pathTmp = './tmp/'
-        name = "{}_{}".format(image_id, mex_id)
-        # Verifica si el directorio existe, si no existe lo crea
-        if not os.path.exists(pathTmp):
-            os.makedirs(pathTmp)
-        # Guarda la imagen en el directorio
-        with open(pathTmp + name + '.tif', 'wb') as f:
-            f.write(r.content)
-            # Verifica si la imagen se descargo correctamente
-            if os.path.exists(pathTmp + name + '.tif'):
-                print('Imagen {} descargada correctamente'.format(image_id))
-                # Actualiza la base de datos con el id de la imagen que ha sido descargada
-                update_db_downloaded([(image_id,)])
-
-                # Comprime la imagen descargada en un archivo .tar
-                #tar_name = "{}.tar".format(image_id)
-                #with tarfile.open(tar_name, "w") as tar:
-                #    tar.add(name)
-                
-                # Borra la imagen .tif
-                #os.remove(name)
-                #print('Imagen {} comprimida y eliminada'.format(image_id))
-            else:
-                print('Error al descargar la imagen {}'.format(image_id))
-                return
-        
-        # Obtiene el pathrow de la imagen con el id
-        pathrow = get_pathrow(image_id)
+        path = fetch_image(image_id, mex_id, download_link, expected_md5, parts, chunk_size)
+    if path is None:
+        return
 
-        print('Pathrow: {}'.format(pathrow))
+    # Crea un archivo png georreferenciado a partir de la imagen tif
+    with get_metrics().timer('procesamiento_segundos'):
+        render_image((image_id, path), png_max_size)
+
+    transfer_image(descarga, (image_id, path))
+
+def download_images(descarga, pathrow, ids_planet, item_type = 'PSScene', product_type = 'ortho_analytic_8b_sr', chunk_size = CHUNK_SIZE,
+                    download_workers = DOWNLOAD_WORKERS, render_workers = RENDER_WORKERS, transfer_workers = TRANSFER_WORKERS,
+                    png_max_size = PNG_MAX_SIZE):
+    '''Funcion que activa por lotes las imagenes y las pasa por el pipeline descarga -> png -> transferencia
+    en cuanto cada una esta activa. Cada etapa tiene su propio numero de workers
+    png_max_size: lado mayor de los PNG de vista previa (None para la resolución completa)
+    Devuelve (procesadas, fallidas); las fallidas incluyen las que no se pudieron activar'''
+    # Solicita la activacion de todas las imagenes al inicio
+    jobs = []
+    for row in ids_planet:
+        image_id = row[1]
+        mex_id = row[4]
+        asset = obtain_asset(image_id, item_type, product_type)
+        if asset is not None:
+            jobs.append(((image_id, mex_id), asset))
+    print('Esperando la activacion de {} imagenes'.format(len(jobs)))
+
+    def download(job):
+        (image_id, mex_id), asset = job
+        print('Descargando imagen {}'.format(image_id))
+        if descarga == 'directo':
+            path = stream_image_server(image_id, mex_id, asset['location'], asset.get('md5_digest'), chunk_size)
+        else:
+            path = fetch_image(image_id, mex_id, asset['location'], asset.get('md5_digest'), chunk_size=chunk_size)
+        return None if path is None else (image_id, path)
 
-        # Crea un archivo png georreferenciado a partir de la imagen tif
-        create_png(pathTmp + name)
-        
-        # Enlista los archivos .tif, .png y .xml
-        files = glob(pathTmp + name + '*')
-        
-        # Si la descarga es en local la deja en la carpeta planet_images
-        if descarga == 'local':
-            # Si no existe la carpeta planet_images mas el pathrow, la crea
-            if not os.path.exists('planet_images/{}'.format(pathrow)):
-                os.makedirs('planet_images/{}'.format(pathrow))
-            # Mueve la imagen de la carpeta actual a la carpeta planet_images mas el pathrow
-            for file in files:
-                shutil.move(file, 'planet_images/{}/'.format(pathrow))
-        # Si la descarga es en servidor la mueve de la carpeta planet_images al servidor
-        elif descarga == 'servidor':
-            move_image_server(files, pathrow)
+    # Cada imagen entra al pipeline en cuanto queda activa
+    transferred = run_pipeline(wait_for_activation(jobs), download, partial(render_image, max_size=png_max_size),
+                               partial(transfer_image, descarga),
+                               download_workers=download_workers, render_workers=render_workers,
+                               transfer_workers=transfer_workers, on_error=discard_image)
+    print('Se procesaron {} de {} imagenes del pathrow {}'.format(transferred, len(ids_planet), pathrow))
+    return transferred, len(ids_planet) - transferred
 
 def menu():
     '''Funcion que muestra el menu de opciones'''
@@ -475,6 +774,7 @@ def menu():
         # Solicita la opcion si se quiere decaragr por id o por usuario
         print('1. Descargar por pathrow')
         print('2. Descargar por usuario')
+        print('3. Descargar con cola de trabajo (varios equipos)')
         opcion = input('Ingrese la opcion: ')
         print('\n')
 
@@ -492,19 +792,17 @@ def menu():
             # Menu de ruta de descarga
             print('1. Descargar en local')
             print('2. Descargar en servidor')
+            print('3. Descargar directo al servidor (el tif no se vuelve a leer de ./tmp para enviarlo)')
             opcion = input('Ingrese la opcion: ')
             if opcion == '1':
                 # Descarga en local
-                for row in ids_planet:
-                    image_id = row[1]
-                    mex_id = row[4]
-                    download_image('local', pathrow, image_id, mex_id)
+                download_images('local', pathrow, ids_planet)
             elif opcion == '2':
                 # Descarga en servidor
-                for row in ids_planet:
-                    image_id = row[1]
-                    mex_id = row[4]
-                    download_image('servidor', pathrow, image_id, mex_id)
+                download_images('servidor', pathrow, ids_planet)
+            elif opcion == '3':
+                # Descarga directa al servidor
+                download_images('directo', pathrow, ids_planet)
 
         # Option 2: Descarga por usuario
         elif opcion == '2':
@@ -514,26 +812,12 @@ def menu():
             print('3.Paty')
             print('4.Uriel')
             opcion = input('Ingrese la opcion: ')
-            if opcion == '1':
-                user = 'Akemi'
-                pathrow = ['B27', 'B28', 'B29', 'C313', 'C315', 'C316', 'E526']
-                #pathrow = ['F635', 'H846']
-                pathrow = check_pathrow_not_download(pathrow)
-            elif opcion == '2':
-                user = 'Fernando'
-                pathrow = ['A11', 'A12', 'D419', 'D420', 'D421', 'D422', 'D423']
-                #pathrow = ['I952', 'E528']
-                pathrow = check_pathrow_not_download(pathrow)
-            elif opcion == '3':
-                user = 'Paty'
-                pathrow = ['C314', 'E527', 'E528', 'E529', 'F632', 'F633', 'F634']
-                #pathrow = ['E529', 'E527']
-                pathrow = check_pathrow_not_download(pathrow)
-            elif opcion == '4':
-                user = 'Uriel'
-                pathrow = ['F635', 'F636', 'G741', 'G742', 'H846', 'H847', 'H848', 'I952', 'I953']
-                #pathrow = ['F634', 'D419', 'A11']
-                pathrow = check_pathrow_not_download(pathrow)     
+            usuarios = {'1': 'Akemi', '2': 'Fernando', '3': 'Paty', '4': 'Uriel'}
+            if opcion not in usuarios:
+                print('Opcion incorrecta')
+                return
+            user = usuarios[opcion]
+            pathrow = check_pathrow_not_download(USER_PATHROWS[user])
             # Obtiene los ids de las imagenes deacuerdo al pathrow y no descargadas      
             ids_planet = select_db_not_download('pathrow', pathrow)
             # Imprime el numero de imagenes a descargar por usuario y el pathrow
@@ -543,32 +827,34 @@ def menu():
             # Menu de ruta de descarga
             print('1. Descargar en local')
             print('2. Descargar en servidor')
+            print('3. Descargar directo al servidor (el tif no se vuelve a leer de ./tmp para enviarlo)')
             opcion = input('Ingrese la opcion: ')
             if opcion == '1':
                 # Descarga en local
-                for row in ids_planet:
-                    image_id = row[1]
-                    mex_id = row[4]
-                    try:
-                        download_image('local', pathrow, image_id, mex_id)
-                    except rasterio.errors.RasterioIOError as rioe:
-                        print('Error: {}'.format(rioe))
-                        print('No se pudo descargar la imagen {} del pathrow {}'.format(image_id, pathrow))
-                        os.remove('./tmp/*')
-                        continue
+                download_images('local', pathrow, ids_planet)
                          
             elif opcion == '2':
                 # Descarga en servidor
-                for row in ids_planet:
-                    image_id = row[1]
-                    mex_id = row[4]
-                    try:
-                        download_image('servidor', pathrow, image_id, mex_id)
-                    except rasterio.errors.RasterioIOError as rioe:
-                        print('Error: {}'.format(rioe))
-                        print('No se pudo descargar la imagen {} del pathrow {}'.format(image_id, pathrow))
-                        os.remove('./tmp/*')
-                        continue
+                download_images('servidor', pathrow, ids_planet)
+            elif opcion == '3':
+                # Descarga directa al servidor
+                download_images('directo', pathrow, ids_planet)
+
+        # Option 3: Descarga con la cola de trabajo compartida
+        elif opcion == '3':
+            pathrow = input('Ingrese los pathrows separados por coma (vacio para todos): ')
+            pathrow = [p.strip() for p in pathrow.split(',') if p.strip()] or None
+            print('1. Descargar en local')
+            print('2. Descargar en servidor')
+            print('3. Descargar directo al servidor (el tif no se vuelve a leer de ./tmp para enviarlo)')
+            opcion = input('Ingrese la opcion: ')
+            if opcion == '1':
+                download_leased('local', pathrow)
+            elif opcion == '2':
+                download_leased('servidor', pathrow)
+            elif opcion == '3':
+                # Descarga directa al servidor
+                download_leased('directo', pathrow)
 
     # OPTION 2: Actualizar base de datos
     elif opcion == '2':    
@@ -622,10 +908,19 @@ def menu():
 if __name__ == '__main__':
     # Funcion principal de descarga de imagenes satelitales de Planet
 
-    # Comprueba si la base de datos existe
-    if check_db() == False:
-        # Crea la base de datos
-        create_db()
-    # Muestra el menu de opciones
-    menu()
-
+    # Crea la tabla o aplica las migraciones pendientes
+    prepare_db()
+    # El pool de conexiones a Planet alcanza para los rangos de todas las descargas en paralelo
+    configure_session(session_size(download_workers=DOWNLOAD_WORKERS, parts=DOWNLOAD_PARTS))
+    # Sin menu: python planet_cli.py download|query|... (ver planet_cli.py)
+    # python download_ids_pg.py --profile[=DIR] guarda perfiles de CPU y memoria por imagen (ver profiling.py)
+    if enable_from_argv(sys.argv[1:]):
+        print('Perfilado activado, los perfiles se guardan en {}'.format(profile_dir()))
+    try:
+        # Muestra el menu de opciones
+        menu()
+    finally:
+        # Cierra las conexiones de los pools (tambien si se sale con la opcion 4) y guarda el reporte
+        close_db_pool()
+        close_sftp_pool()
+        get_metrics().write_report('ids_pg')
@@ -5,18 +5,32 @@ Script para obtener los ids de las imágenes satelitales de Planet, y su posteri
 @date: 2024-09-01
 '''
 import os
-import requests
-from requests.auth import HTTPBasicAuth
+import sys
+import json
+import hashlib
+import numpy as np
+import shapely
 from shapely.geometry import Point, Polygon, mapping, shape
-import time
 import fiona
-from pyproj import Transformer
-from shapely.ops import transform
+from pyproj import CRS, Transformer
+from shapely.ops import unary_union
 from datetime import datetime
-from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import RequestException
+from concurrent.futures import ThreadPoolExecutor
+from planet_session import configure_session, session_size
+from planet_download import CHUNK_SIZE, DOWNLOAD_PARTS, DownloadError, download_file
+from planet_activation import PRODUCT_TYPES, get_assets, select_product, wait_for_activation
+from search_cache import get_cache, period_ttl
+from metrics import get_metrics
+from profiling import enable_from_argv, profile_dir, profiled
+from planet_search import BATCH_SIDE, POLICIES, assign_features, group_quadrants, iter_search, select_features
 
-# Si la variable API está en el sistema operativo, se usa, de lo contrario, se usa la API_KEY
-API_KEY = os.getenv('PL_API_KEY', '')
+# Guarda las respuestas de quick-search en la caché local (ver search_cache.py)
+USE_SEARCH_CACHE = True
+# Malla reproyectada y simplificada guardada entre ejecuciones
+GRID_CACHE_DIR = './cache/mallas'
+# Vértices máximos de cada cuadrante enviado como geometría de búsqueda (0 o None para no simplificar)
+MAX_VERTICES = 500
 
 def latlon_to_geojson(lat, lon):
     """Convierte una coordenada de latitud y longitud a un GeoJSON compatible con la API de Planet."""
@@ -27,27 +41,93 @@ def latlon_to_geojson(lat, lon):
         "coordinates": [list(buffer.exterior.coords)]
     }
 
-def shapefile_to_geojson(shapefile_path):
-    """Convierte cada cuadrante del shapefile a GeoJSON en EPSG:4326."""
+def file_sha256(paths):
+    """Calcula el sha256 del contenido de los archivos dados (los que no existen se omiten)."""
+    digest = hashlib.sha256()
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+    return digest.hexdigest()
+
+def reproject_geometries(geoms, src_crs):
+    """Reproyecta un arreglo de geometrías de Shapely a EPSG:4326 transformando todas sus coordenadas a la vez."""
+    if src_crs.equals(CRS.from_epsg(4326)):
+        return geoms  # No hace falta transformar si ya está en EPSG:4326
+    transformer = Transformer.from_crs(src_crs, "EPSG:4326", always_xy=True)
+    # shapely.transform entrega las coordenadas de todas las geometrías en un solo arreglo (N, 2)
+    return shapely.transform(geoms, lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+
+def simplify_to_budget(geoms, max_vertices=MAX_VERTICES):
+    """Simplifica (preservando la topología) las geometrías con más de max_vertices vértices.
+
+    La tolerancia empieza en una fracción pequeña del tamaño de cada geometría y se duplica solo
+    para las que aún exceden el límite, hasta llegar al tamaño de la geometría. Con preserve_topology
+    se conservan todos los anillos (partes de un MultiPolygon, huecos), así que una geometría con
+    muchas partes puede seguir excediendo el límite; esas se dejan con la mayor simplificación
+    alcanzada y se avisa."""
+    geoms = np.array(geoms, dtype=object)
+    over = shapely.get_num_coordinates(geoms) > max_vertices
+    if not over.any():
+        return geoms
+    bounds = shapely.bounds(geoms)
+    extent = np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1])
+    tolerance = extent * 1e-4
+    original = geoms.copy()
+    pending = over
+    while pending.any():
+        geoms[pending] = shapely.simplify(original[pending], tolerance[pending], preserve_topology=True)
+        tolerance[pending] *= 2
+        over = shapely.get_num_coordinates(geoms) > max_vertices
+        # Con una tolerancia mayor que el tamaño de la geometría ya no se eliminan más vértices
+        pending = over & (tolerance < 2 * extent)
+    if over.any():
+        print(f"Aviso: {over.sum()} geometrías siguen con más de {max_vertices} vértices después de simplificarlas "
+              f"(máximo {shapely.get_num_coordinates(geoms[over]).max()}).")
+    return geoms
+
+def shapefile_to_geojson(shapefile_path, max_vertices=MAX_VERTICES, use_cache=True):
+    """Convierte cada cuadrante del shapefile a GeoJSON en EPSG:4326, simplificado a max_vertices vértices.
+
+    El resultado se guarda en GRID_CACHE_DIR junto con la fecha de modificación y el sha256 del
+    shapefile; mientras el shapefile no cambie, las siguientes ejecuciones leen la malla de ahí."""
+    base = os.path.splitext(shapefile_path)[0]
+    sources = [shapefile_path, base + '.prj']
+    mtime = os.path.getmtime(shapefile_path)
+    cache_path = os.path.join(GRID_CACHE_DIR, hashlib.sha256(os.path.abspath(shapefile_path).encode('utf-8')).hexdigest()[:16] + '.json')
+
+    cached = None
+    if use_cache and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached.get('max_vertices') != max_vertices:
+            cached = None
+        elif cached.get('mtime') != mtime:
+            # La fecha cambió (p. ej. una copia): solo se recalcula si el contenido también cambió
+            if cached.get('sha256') == file_sha256(sources):
+                cached['mtime'] = mtime
+            else:
+                cached = None
+    if cached is not None:
+        return cached['quadrants']
+
     with fiona.open(shapefile_path, 'r') as shapefile:
-        crs = shapefile.crs
-        # Verifica si el shapefile no está en EPSG:4326 y aplica la transformación
-        if crs['init'] != 'epsg:4326':
-            transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
-        else:
-            transformer = None  # No hace falta transformar si ya está en EPSG:4326
-
-        geojson_quadrants = []
-        
-        for feature in shapefile:
-            geom = shape(feature['geometry'])  # Geometría original
-            if transformer:
-                # Transformar la geometría completa de Shapely usando shapely.ops.transform
-                geom = transform(transformer.transform, geom)
-            geojson_quadrant = mapping(geom)  # mapping convierte la geometría de Shapely de nuevo a GeoJSON
-            geojson_quadrants.append(geojson_quadrant)
-            
-        return geojson_quadrants
+        src_crs = CRS.from_wkt(shapefile.crs_wkt) if shapefile.crs_wkt else CRS.from_epsg(4326)
+        geoms = np.array([shape(feature['geometry']) for feature in shapefile], dtype=object)
+
+    geoms = reproject_geometries(geoms, src_crs)
+    if max_vertices:
+        geoms = simplify_to_budget(geoms, max_vertices)
+    geojson_quadrants = [mapping(geom) for geom in geoms]  # mapping convierte la geometría de Shapely de nuevo a GeoJSON
+
+    if use_cache:
+        os.makedirs(GRID_CACHE_DIR, exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump({'mtime': mtime, 'sha256': file_sha256(sources), 'max_vertices': max_vertices,
+                       'quadrants': geojson_quadrants}, f)
+        os.replace(cache_path + '.tmp', cache_path)
+    return geojson_quadrants
 
 def input_coordinates():
     """Solicita al usuario ingresar una coordenada geográfica (latitud y longitud)."""
@@ -60,89 +140,248 @@ def create_default_dir():
     if not os.path.exists("./output"):
         os.makedirs("./output")
 
-def search_and_download_images(output_dir, geojson_quadrants, visibility=90.0, cloud_cover=10.0, start_year=2020, end_year=2023, seasons=False):
-    """Busca y descarga solo la primera imagen de cada cuadrante que cumpla con los parámetros dados."""
+def build_periods(year, seasons=False):
+    """Devuelve los periodos (inicio, fin, temporada) a buscar para un año."""
+    if seasons:
+        return [
+            (f"{year}-06-01T00:00:00.000Z", f"{year}-10-31T23:59:59.999Z", "lluvias"),
+            (f"{year}-01-01T00:00:00.000Z", f"{year}-05-31T23:59:59.999Z", "secas"),
+            (f"{year}-11-01T00:00:00.000Z", f"{year}-12-31T23:59:59.999Z", "secas"),
+        ]
+    return [(f"{year}-01-01T00:00:00.000Z", f"{year}-12-31T23:59:59.999Z", "completo")]
+
+def build_search_request(quadrant, start_date, end_date, visibility=90.0, cloud_cover=10.0):
+    """Construye el cuerpo de la petición quick-search para un cuadrante y un periodo."""
+    geometry_filter = {
+        "type": "GeometryFilter",
+        "field_name": "geometry",
+        "config": quadrant
+    }
+
+    date_range_filter = {
+        "type": "DateRangeFilter",
+        "field_name": "acquired",
+        "config": {
+            "gte": start_date,
+            "lte": end_date
+        }
+    }
+
+    cloud_cover_filter = {
+        "type": "RangeFilter",
+        "field_name": "cloud_cover",
+        "config": {
+            "lte": cloud_cover / 100.0
+        }
+    }
+
+    visibility_filter = {
+        "type": "RangeFilter",
+        "field_name": "clear_percent",
+        "config": {
+            "gte": visibility / 100.0
+        }
+    }
+
+    combined_filter = {
+        "type": "AndFilter",
+        "config": [geometry_filter, date_range_filter, cloud_cover_filter, visibility_filter]
+    }
+
+    return {
+        "item_types": ["PSScene"],
+        "filter": combined_filter
+    }
+
+def search_period(idx, quadrant, year, period, visibility=90.0, cloud_cover=10.0, policy='primera'):
+    """Busca las imágenes de un cuadrante en un periodo y las elige según la política (ver planet_search.POLICIES).
+
+    Devuelve una lista con las escenas elegidas (vacía si no hubo resultados) o None si hubo error."""
+    start_date, end_date, season = period
+    search_request = build_search_request(quadrant, start_date, end_date, visibility, cloud_cover)
+    # La política forma parte de la llave porque cambia la escena guardada
+    cache_key = dict(search_request, _policy=policy)
+
+    # Si la misma búsqueda ya se hizo (y sigue vigente) no se consulta la API
+    result = get_cache().get(cache_key) if USE_SEARCH_CACHE else None
+    if result is None:
+        try:
+            # La selección consume las páginas de la búsqueda solo mientras las necesita
+            features, seen = select_features(iter_search(search_request, POLICIES[policy]['sort']), quadrant, policy)
+        except RequestException as e:
+            print(f"Error al buscar imágenes para el cuadrante {idx}, año {year}, temporada {season}: {e}.")
+            return None
+
+        result = {'features': features, 'revisadas': seen}
+        if USE_SEARCH_CACHE:
+            # Los periodos cerrados no expiran, el periodo actual se vuelve a consultar después de CURRENT_TTL
+            get_cache().put(cache_key, result, period_ttl(end_date))
+
+    features = result['features']
+    if not features:
+        print(f"No se encontraron imágenes para el cuadrante {idx} y el año {year}, temporada {season}.")
+    else:
+        print(f"Cuadrante {idx}, año {year}, temporada {season}: se eligió {features[0]['id'] if len(features) == 1 else f'{len(features)} imágenes'} ({policy}) entre {result['revisadas']} imágenes revisadas.")
+    return features
+
+def search_first_period(idx, quadrant, year, visibility=90.0, cloud_cover=10.0, seasons=False, policy='primera'):
+    """Busca los periodos de un cuadrante y año en orden y se detiene en el primero con imágenes.
+
+    Devuelve (season, features) o None si ningún periodo tiene imágenes. Un periodo solo se consulta
+    si el anterior no tuvo imágenes, así se hacen las mismas búsquedas que en el recorrido secuencial."""
+    for period in build_periods(year, seasons):
+        features = search_period(idx, quadrant, year, period, visibility, cloud_cover, policy)
+        if features:
+            return period[2], features
+    return None
+
+def search_quadrants(geojson_quadrants, visibility=90.0, cloud_cover=10.0, start_year=2020, end_year=2023, seasons=False, workers=4, policy='primera'):
+    """Ejecuta en paralelo las búsquedas de cada cuadrante y año.
+
+    Devuelve una lista ordenada por cuadrante y año con tuplas (idx, year, season, features), donde el
+    periodo seleccionado es el primero (en el orden de build_periods) que tiene imágenes, igual que en
+    la búsqueda secuencial. Los periodos de un mismo cuadrante y año se consultan encadenados (ver
+    search_first_period), por lo que el paralelismo es entre cuadrantes y años y no aumenta el número
+    de búsquedas."""
+    years = range(start_year, end_year + 1)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for idx, quadrant in enumerate(geojson_quadrants, start=1):
+            for year in years:
+                futures[(idx, year)] = executor.submit(search_first_period, idx, quadrant, year, visibility,
+                                                       cloud_cover, seasons, policy)
+
+        # Se recorren los resultados en el orden original para que la salida sea determinista
+        selected = []
+        for (idx, year), future in futures.items():
+            result = future.result()
+            if result is not None:
+                season, features = result
+                selected.append((idx, year, season, features))
+
+    return selected
+
+def compact_feature(feature):
+    """Conserva solo los campos de la escena que se usan después (para la caché de los lotes)."""
+    return {
+        'id': feature['id'],
+        'geometry': feature['geometry'],
+        'properties': feature.get('properties', {}),
+        '_links': {'assets': feature['_links']['assets']},
+    }
+
+def search_group(group, quadrants, year, period, visibility=90.0, cloud_cover=10.0, policy='primera'):
+    """Busca un lote de cuadrantes vecinos con una sola geometría y reparte las escenas entre ellos.
+
+    Devuelve una lista con las escenas de cada cuadrante del lote o None si hubo error."""
+    start_date, end_date, season = period
+    geometry = mapping(unary_union([shape(quadrant) for quadrant in quadrants]))
+    search_request = build_search_request(geometry, start_date, end_date, visibility, cloud_cover)
+    sort = POLICIES[policy]['sort']
+    # Se guardan todas las escenas del lote; solo el orden pedido a la API cambia la respuesta
+    cache_key = dict(search_request, _sort=sort)
+
+    result = get_cache().get(cache_key) if USE_SEARCH_CACHE else None
+    if result is None:
+        try:
+            # Todas las páginas son necesarias para repartir las escenas entre los cuadrantes
+            features = [compact_feature(feature) for feature in iter_search(search_request, sort)]
+        except RequestException as e:
+            print(f"Error al buscar imágenes para el lote {group}, año {year}, temporada {season}: {e}.")
+            return None
+        result = {'features': features}
+        if USE_SEARCH_CACHE:
+            get_cache().put(cache_key, result, period_ttl(end_date))
+
+    print(f"Lote {group}, año {year}, temporada {season}: {len(result['features'])} imágenes para {len(quadrants)} cuadrantes.")
+    return assign_features(result['features'], quadrants)
+
+def search_group_periods(group, quadrants, year, visibility=90.0, cloud_cover=10.0, seasons=False, policy='primera'):
+    """Busca los periodos de un lote y año en orden hasta que todos sus cuadrantes tienen imágenes.
+
+    Devuelve un diccionario {posición del cuadrante en el lote: (season, features)}; un periodo solo se
+    consulta si algún cuadrante del lote sigue sin imágenes."""
+    found = {}
+    for period in build_periods(year, seasons):
+        assigned = search_group(group, quadrants, year, period, visibility, cloud_cover, policy)
+        if assigned is None:
+            continue
+        for i, quadrant in enumerate(quadrants):
+            if i in found:
+                continue
+            features, _ = select_features(assigned[i], quadrant, policy)
+            if features:
+                found[i] = (period[2], features)
+        if len(found) == len(quadrants):
+            # Todos los cuadrantes del lote ya tienen imagen para este año
+            break
+    return found
+
+def search_quadrants_batched(geojson_quadrants, visibility=90.0, cloud_cover=10.0, start_year=2020, end_year=2023, seasons=False, workers=4, policy='primera', side=BATCH_SIDE):
+    """Igual que search_quadrants, pero con una búsqueda por lote de cuadrantes vecinos en lugar de una por cuadrante.
+
+    Los cuadrantes se agrupan con group_quadrants y las escenas de cada lote se asignan a sus
+    cuadrantes con un índice STRtree. Para cada cuadrante y año gana el primer periodo con imágenes;
+    los periodos de un lote se consultan encadenados (ver search_group_periods)."""
+    years = range(start_year, end_year + 1)
+    groups = group_quadrants(geojson_quadrants, side)
+    print(f"{len(geojson_quadrants)} cuadrantes agrupados en {len(groups)} lotes de búsqueda.")
+    selected = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for g, members in enumerate(groups, start=1):
+            quadrants = [geojson_quadrants[i] for i in members]
+            for year in years:
+                futures[(g, year)] = executor.submit(search_group_periods, g, quadrants, year, visibility,
+                                                     cloud_cover, seasons, policy)
+
+        for (g, year), future in futures.items():
+            members = groups[g - 1]
+            found = future.result()
+            for i, member in enumerate(members):
+                if i in found:
+                    selected[(member + 1, year)] = found[i]
+                else:
+                    print(f"No se encontraron imágenes para el cuadrante {member + 1} y el año {year}.")
+
+    # Mismo orden que la búsqueda por cuadrante
+    return [(idx, year, season, features) for (idx, year), (season, features) in sorted(selected.items())]
+
+def search_and_download_images(output_dir, geojson_quadrants, visibility=90.0, cloud_cover=10.0, start_year=2020, end_year=2023, seasons=False, workers=1, policy='primera', batch=False):
+    """Busca y descarga una imagen por cuadrante y periodo que cumpla con los parámetros dados, elegida según policy.
+
+    Con workers > 1 las búsquedas cuadrante×periodo se ejecutan en paralelo. Con batch=True se hace una
+    búsqueda por lote de cuadrantes vecinos (ver search_quadrants_batched). En todos los casos las
+    imágenes se descargan después de la búsqueda, en el mismo orden que la búsqueda secuencial, y todas
+    las activaciones se solicitan al inicio para que la espera de activación se traslape.
+    Devuelve (descargadas, fallidas); las que ya existían no cuentan en ninguna."""
     total_quadrants = len(geojson_quadrants)
     print(f"Total de cuadrantes: {total_quadrants}")
-    
-    for idx, quadrant in enumerate(geojson_quadrants, start=1):
-        print(f"Procesando cuadrante {idx}/{total_quadrants}...")
-        for year in range(start_year, end_year + 1):
-            if seasons:
-                periods = [
-                    (f"{year}-06-01T00:00:00.000Z", f"{year}-10-31T23:59:59.999Z", "lluvias"),
-                    (f"{year}-01-01T00:00:00.000Z", f"{year}-05-31T23:59:59.999Z", "secas"),
-                    (f"{year}-11-01T00:00:00.000Z", f"{year}-12-31T23:59:59.999Z", "secas"),
-                ]
+
+    if workers > 1 or batch:
+        print(f"Buscando en paralelo con {workers} hilos...")
+        search = search_quadrants_batched if batch else search_quadrants
+        found = search(geojson_quadrants, visibility, cloud_cover, start_year, end_year, seasons, workers, policy)
+    else:
+        found = []
+        for idx, quadrant in enumerate(geojson_quadrants, start=1):
+            print(f"Procesando cuadrante {idx}/{total_quadrants}...")
+            for year in range(start_year, end_year + 1):
+                result = search_first_period(idx, quadrant, year, visibility, cloud_cover, seasons, policy)
+                if result is not None:
+                    found.append((idx, year) + result)
+
+    selected = []
+    for idx, year, season, features in found:
+        for feature in features:
+            if check_image_exists(output_dir, feature['id'], year, season):
+                print(f"La imagen {feature['id']} ya existe. No se descargará nuevamente.")
             else:
-                periods = [(f"{year}-01-01T00:00:00.000Z", f"{year}-12-31T23:59:59.999Z", "completo")]
-            
-            for start_date, end_date, season in periods:
-                geometry_filter = {
-                    "type": "GeometryFilter",
-                    "field_name": "geometry",
-                    "config": quadrant
-                }
-
-                date_range_filter = {
-                    "type": "DateRangeFilter",
-                    "field_name": "acquired",
-                    "config": {
-                        "gte": start_date,
-                        "lte": end_date
-                    }
-                }
-
-                cloud_cover_filter = {
-                    "type": "RangeFilter",
-                    "field_name": "cloud_cover",
-                    "config": {
-                        "lte": cloud_cover / 100.0
-                    }
-                }
-
-                visibility_filter = {
-                    "type": "RangeFilter",
-                    "field_name": "clear_percent",
-                    "config": {
-                        "gte": visibility / 100.0
-                    }
-                }
-
-                combined_filter = {
-                    "type": "AndFilter",
-                    "config": [geometry_filter, date_range_filter, cloud_cover_filter, visibility_filter]
-                }
-
-                search_request = {
-                    "item_types": ["PSScene"],
-                    "filter": combined_filter
-                }
-
-                try:
-                    response = requests.post(
-                        'https://api.planet.com/data/v1/quick-search',
-                        auth=HTTPBasicAuth(API_KEY, ''),
-                        json=search_request
-                    )
-
-                    if response.status_code == 200:
-                        features = response.json().get('features', [])
-                        if features:
-                            print(f"Se encontraron {len(features)} imágenes para el año {year}, temporada {season}. Activando y descargando la primera imagen para el cuadrante {idx}.")
-                            # Descarga solo la primera imagen encontrada
-                            image_id = features[0]['id']
-                            if check_image_exists(output_dir, image_id, year, season):
-                                print(f"La imagen {image_id} ya existe. No se descargará nuevamente.")
-                            else:
-                                activate_and_download_image(features[0], output_dir, year, season)
-                            break  # Se descarga la primera imagen que cumple para este cuadrante y se pasa al siguiente cuadrante
-                        else:
-                            print(f"No se encontraron imágenes para el cuadrante {idx} y el año {year}, temporada {season}.")
-                    else:
-                        print(f"Error al buscar imágenes para el cuadrante {idx}: {response.status_code} - {response.text}")
-                except ChunkedEncodingError as e:
-                    print(f"Error de conexión durante la búsqueda o descarga: {e}. Saltando a la siguiente imagen.")
+                selected.append((feature, year, season))
+    # Todas las activaciones se solicitan al inicio y cada imagen se descarga en cuanto está lista
+    return activate_and_download_images(selected, output_dir)
 
 def check_image_exists(output_dir, image_id, year, season):
     """Verifica si la imagen ya existe en el directorio de salida."""
@@ -150,48 +389,73 @@ def check_image_exists(output_dir, image_id, year, season):
     image_path = os.path.join(year_season_dir, f"{image_id}.tif")
     return os.path.exists(image_path)
 
+def get_product_asset(feature):
+    """Obtiene el asset a descargar de una imagen (8 bandas o, si no existe, 4 bandas). Devuelve None si no hay ninguno."""
+    image_id = feature['id']
+    assets = get_assets(feature['_links']['assets'])
+    if assets is None:
+        return None
+
+    product_type = select_product(assets)
+    if product_type is None:
+        print(f"Ninguno de los productos requeridos está disponible para la imagen {image_id}.")
+        return None
+    if product_type != PRODUCT_TYPES[0]:
+        print(f"El tipo de producto {PRODUCT_TYPES[0]} no está disponible para la imagen {image_id}. Usando {product_type}...")
+
+    if assets[product_type]['status'] != 'active':
+        print(f"Activando {product_type} para {image_id}...")
+    return assets[product_type]
+
 def activate_and_download_image(feature, output_dir, year, season):
-    """Activa y descarga la imagen especificada."""
+    """Activa y descarga la imagen especificada, esperando a que el asset quede activo. Devuelve True si se descargó."""
     image_id = feature['id']
-    assets_url = feature['_links']['assets']
 
     try:
-        assets_response = requests.get(assets_url, auth=HTTPBasicAuth(API_KEY, ''))
-    
-        if assets_response.status_code == 200:
-            assets = assets_response.json()
-            
-            product_type = 'ortho_analytic_8b_sr'
-            
-            if product_type not in assets:
-                print(f"El tipo de producto {product_type} no está disponible para la imagen {image_id}. Intentando con ortho_analytic_4b_sr...")
-                product_type = 'ortho_analytic_4b_sr'
-            
-            if product_type not in assets:
-                print(f"Ninguno de los productos requeridos está disponible para la imagen {image_id}.")
-                return
-            
-            activation_url = assets[product_type]['_links']['activate']
-            status = assets[product_type]['status']
-            
-            if status != 'active':
-                print(f"Activando {product_type} para {image_id}...")
-                requests.get(activation_url, auth=HTTPBasicAuth(API_KEY, ''))
-                print(f"{product_type} para {image_id} activado, esperando 10 segundos...")
-                time.sleep(5)
-            
-            download_image(assets, product_type, image_id, output_dir, year, season)
-        else:
-            print(f"Error al obtener assets de la imagen {image_id}: {assets_response.status_code}")
-    except ChunkedEncodingError as e:
+        asset = get_product_asset(feature)
+        if asset is None:
+            return False
+        for _, active_asset in wait_for_activation([(image_id, asset)]):
+            return download_image(active_asset, image_id, output_dir, year, season)
+    except RequestException as e:
         print(f"Error de conexión durante la activación o descarga: {e}. Saltando a la siguiente imagen.")
+    return False
+
+def activate_and_download_images(selected, output_dir):
+    """Activa por lotes las imágenes seleccionadas y descarga cada una en cuanto queda activa.
 
-def download_image(assets, product_type, image_id, output_dir, year, season):
-    """Descarga la imagen especificada y la guarda en el directorio dado."""
-    status = assets[product_type]['status']
+    selected es una lista de tuplas (feature, year, season). Devuelve (descargadas, fallidas), donde las
+    fallidas incluyen las que no tienen producto o no se activaron a tiempo."""
+    jobs = []
+    seen = set()
+    for feature, year, season in selected:
+        # Cuadrantes vecinos pueden seleccionar la misma escena en el mismo periodo
+        if (feature['id'], year, season) in seen:
+            continue
+        seen.add((feature['id'], year, season))
+        asset = get_product_asset(feature)
+        if asset is not None:
+            jobs.append(((feature['id'], year, season), asset))
+
+    print(f"Esperando la activación de {len(jobs)} imágenes...")
+    downloaded = 0
+    for (image_id, year, season), asset in wait_for_activation(jobs):
+        try:
+            downloaded += download_image(asset, image_id, output_dir, year, season)
+        except RequestException as e:
+            print(f"Error de conexión durante la descarga de la imagen {image_id}: {e}. Saltando a la siguiente imagen.")
+    return downloaded, len(seen) - downloaded
+
+def download_image(asset, image_id, output_dir, year, season, parts=DOWNLOAD_PARTS, chunk_size=CHUNK_SIZE):
+    """Descarga la imagen especificada y la guarda en el directorio dado.
+
+    La descarga se escribe en un archivo .part reanudable y solo se renombra a .tif cuando el
+    tamaño y el md5 coinciden, por lo que check_image_exists nunca ve archivos truncados.
+    Devuelve True si la imagen se descargó."""
+    status = asset['status']
     
     if status == 'active':
-        download_url = assets[product_type]['location']
+        download_url = asset['location']
         
         year_season_dir = os.path.join(output_dir, str(year), season)
         if not os.path.exists(year_season_dir):
@@ -201,23 +465,25 @@ def download_image(assets, product_type, image_id, output_dir, year, season):
         
         try:
             print(f"Descargando imagen {image_id} en la carpeta {year}/{season}...")
-            image_data = requests.get(download_url, stream=True)
-            
-            with open(image_path, 'wb') as file:
-                for chunk in image_data.iter_content(chunk_size=8192):
-                    file.write(chunk)
+            with profiled('descarga', image_id) as info:
+                download_file(download_url, image_path, parts=parts, expected_md5=asset.get('md5_digest'), chunk_size=chunk_size)
+                info.update(bytes=os.path.getsize(image_path), partes=parts, chunk_size=chunk_size)
             
             print(f"Imagen {image_id} descargada y guardada en {image_path}.")
-        except ChunkedEncodingError as e:
-            print(f"Error de conexión durante la descarga de la imagen {image_id}: {e}. Saltando a la siguiente imagen.")
+            return True
+        except RequestException as e:
+            print(f"Error de conexión durante la descarga de la imagen {image_id}: {e}. Se reanudará en la siguiente ejecución.")
+        except DownloadError as e:
+            print(f"{e}. Saltando a la siguiente imagen.")
     else:
         print(f"La imagen {image_id} aún no está activa. Se omitirá la descarga.")
+    return False
 
 def main():
     """Función principal del script con un menú para elegir opciones."""
     print("Seleccione el método de búsqueda:")
     print("1. Búsqueda por coordenadas geográficas (lat, lon)")
-    print("2. Búsqueda por shapefile (por cuadrantes)")
+    print("2. Búsqueda por shapefile o GeoPackage (por cuadrantes, p. ej. la malla de 100 km de divide_grid.py)")
     
     option = int(input("Ingrese la opción (1 o 2): "))
     
@@ -225,7 +491,7 @@ def main():
         geojson_geometry = input_coordinates()
         geojson_quadrants = [geojson_geometry]  # Convertir a lista para tratarlo igual que los cuadrantes del shapefile
     elif option == 2:
-        shapefile_path = input("Ingrese la ruta del archivo shapefile: ")
+        shapefile_path = input("Ingrese la ruta del archivo shapefile o GeoPackage: ")
         geojson_quadrants = shapefile_to_geojson(shapefile_path)
     else:
         print("Opción no válida. Terminando.")
@@ -240,8 +506,25 @@ def main():
     create_default_dir()
 
     seasons = input("¿Desea realizar la búsqueda por temporadas (lluvias/secas)? (s/n): ").lower() == 's'
+    workers = int(input("Ingrese el número de búsquedas en paralelo (déjelo vacío para 1): ") or 1)
+    # El pool de conexiones de la sesión compartida se ajusta a las búsquedas en paralelo y a los
+    # rangos de cada descarga (las imágenes se descargan de una en una)
+    configure_session(session_size(workers, 1, DOWNLOAD_PARTS))
+    
+    policy = input(f"Criterio para elegir la imagen de cada periodo ({'/'.join(POLICIES)}; déjelo vacío para 'primera'): ") or 'primera'
+    if policy not in POLICIES:
+        print("Criterio no válido. Terminando.")
+        return
+    
+    # Con muchos cuadrantes conviene buscar por lotes de cuadrantes vecinos (menos peticiones a la API)
+    batch = len(geojson_quadrants) > 1 and input("¿Desea buscar por lotes de cuadrantes vecinos? (s/n): ").lower() == 's'
     
-    search_and_download_images(output_dir, geojson_quadrants, visibility, cloud_cover, start_year, end_year, seasons)
+    search_and_download_images(output_dir, geojson_quadrants, visibility, cloud_cover, start_year, end_year, seasons, workers, policy, batch)
+    # Tiempos de búsqueda, activación y descarga de la ejecución (ver metrics.py)
+    get_metrics().write_report('region')
 
 if __name__ == '__main__':
+    # python download_planet_region.py --profile[=DIR] guarda perfiles de CPU y memoria por imagen (ver profiling.py)
+    if enable_from_argv(sys.argv[1:]):
+        print(f"Perfilado activado, los perfiles se guardan en {profile_dir()}")
     main()
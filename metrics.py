@@ -0,0 +1,166 @@
+'''
+Métricas por etapa de la búsqueda, activación, descarga, procesamiento y transferencia.
+
+Cada módulo registra tiempos (timer/observe) y contadores (count) en un registro
+compartido y seguro para hilos. Al terminar una ejecución, write_report guarda un
+resumen JSON con n, total, media, p50, p95 y máximo de cada métrica y, si se indica
+PL_PROMETHEUS_TEXTFILE, un archivo .prom para el textfile collector de node_exporter.
+Así se puede comparar entre ejecuciones y equipos cuál etapa es el cuello de botella.
+
+Métricas registradas:
+    busqueda_segundos         cada petición de página a quick-search
+    activacion_segundos       espera desde la solicitud de activación hasta que el asset está activo
+    descarga_segundos         descarga completa de un archivo (verificación incluida)
+    descarga_mb_por_segundo   velocidad de cada descarga (bytes recibidos en esa sesión; sin lo ya descargado al reanudar)
+    procesamiento_segundos    generación del PNG de una imagen
+    sftp_segundos             envío de un archivo al servidor
+    db_segundos               cada sentencia y cada commit en PostgreSQL
+    contadores: descarga_bytes (recibidos), sftp_bytes, errores_<etapa>, ...
+'''
+import json
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+# Directorio de los reportes JSON y archivo .prom opcional (p. ej. /var/lib/node_exporter/planet.prom)
+METRICS_DIR = os.getenv('PL_METRICS_DIR', './metricas')
+PROMETHEUS_TEXTFILE = os.getenv('PL_PROMETHEUS_TEXTFILE')
+# Prefijo de las métricas exportadas a Prometheus
+PROMETHEUS_PREFIX = 'planet_'
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def percentile(values, q):
+    """Percentil q (0-100) de una lista ordenada, con interpolación lineal."""
+    if not values:
+        return None
+    pos = (len(values) - 1) * q / 100.0
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+class Metrics:
+    """Registro de muestras y contadores de una ejecución."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.counters = defaultdict(float)
+        self.started = time.time()
+
+    def observe(self, name, value):
+        """Agrega una muestra (segundos, MB/s...) a la métrica name."""
+        with self._lock:
+            self.samples[name].append(value)
+
+    def count(self, name, value=1):
+        """Incrementa el contador name."""
+        with self._lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def timer(self, name):
+        """Mide la duración del bloque y la registra en name, aunque el bloque falle."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self):
+        """Devuelve el resumen de la ejecución como diccionario."""
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self.samples.items()}
+            counters = dict(self.counters)
+        metricas = {}
+        for name, values in sorted(samples.items()):
+            total = sum(values)
+            metricas[name] = {
+                'n': len(values),
+                'total': round(total, 6),
+                'media': round(total / len(values), 6),
+                'p50': round(percentile(values, 50), 6),
+                'p95': round(percentile(values, 95), 6),
+                'max': round(values[-1], 6),
+            }
+        return {
+            'equipo': socket.gethostname(),
+            'pid': os.getpid(),
+            'inicio': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'duracion_segundos': round(time.time() - self.started, 3),
+            'metricas': metricas,
+            'contadores': dict(sorted(counters.items())),
+        }
+
+    def prometheus(self, summary=None):
+        """Devuelve el resumen en el formato de texto de Prometheus (un summary por métrica)."""
+        summary = summary or self.summary()
+        labels = 'equipo="{}"'.format(summary['equipo'])
+        lines = []
+        for name, stats in summary['metricas'].items():
+            metric = PROMETHEUS_PREFIX + name
+            lines.append(f'# TYPE {metric} summary')
+            lines.append(f'{metric}{{{labels},quantile="0.5"}} {stats["p50"]}')
+            lines.append(f'{metric}{{{labels},quantile="0.95"}} {stats["p95"]}')
+            lines.append(f'{metric}_sum{{{labels}}} {stats["total"]}')
+            lines.append(f'{metric}_count{{{labels}}} {stats["n"]}')
+        for name, value in summary['contadores'].items():
+            metric = PROMETHEUS_PREFIX + name + '_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric}{{{labels}}} {value}')
+        metric = PROMETHEUS_PREFIX + 'ejecucion_segundos'
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric}{{{labels}}} {summary["duracion_segundos"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, name='ejecucion', metrics_dir=METRICS_DIR, prometheus_file=PROMETHEUS_TEXTFILE):
+        """Guarda el resumen JSON (y el .prom si se indicó) e imprime p50/p95 de cada métrica.
+
+        Devuelve la ruta del reporte JSON, o None si no se registró ninguna métrica."""
+        summary = self.summary()
+        if not summary['metricas'] and not summary['contadores']:
+            return None
+        os.makedirs(metrics_dir, exist_ok=True)
+        stamp = datetime.fromtimestamp(self.started).strftime('%Y%m%dT%H%M%S')
+        path = os.path.join(metrics_dir, f"{name}_{summary['equipo']}_{stamp}_{summary['pid']}.json")
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+        if prometheus_file:
+            # El textfile collector puede leer el archivo en cualquier momento: se escribe y se renombra
+            tmp = prometheus_file + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(self.prometheus(summary))
+            os.replace(tmp, prometheus_file)
+
+        print(f"Resumen de la ejecución ({summary['duracion_segundos']:.0f} s):")
+        for metric, stats in summary['metricas'].items():
+            print(f"  {metric}: n={stats['n']} p50={stats['p50']:.3f} p95={stats['p95']:.3f} total={stats['total']:.1f}")
+        for counter, value in summary['contadores'].items():
+            print(f"  {counter}: {value:.0f}")
+        print(f"Reporte guardado en {path}")
+        return path
+
+
+def reset_metrics():
+    """Reemplaza el registro compartido por uno vacío (p. ej. entre escenarios de benchmark/)."""
+    global _metrics
+    with _metrics_lock:
+        _metrics = Metrics()
+        return _metrics
+
+
+def get_metrics():
+    """Devuelve el registro de métricas compartido del proceso, creándolo la primera vez."""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
@@ -0,0 +1,175 @@
+'''
+Pipeline por etapas para el flujo descarga -> procesamiento -> transferencia.
+
+Cada imagen pasa por tres etapas con su propia concurrencia: hilos para la descarga
+(red), un pool de procesos para generar el PNG (CPU) y hilos para mover o enviar por
+SFTP los archivos. Las etapas se comunican con colas acotadas, de modo que la red y
+los núcleos del CPU trabajan al mismo tiempo sin llenar el disco de trabajo.
+
+Los procesos del pool no se crean con fork: el proceso principal ya tiene hilos vivos
+(descargas, latido de la cola, limitador...) y un fork puede heredar un candado tomado
+(requests/urllib3, pool de psycopg2, caché sqlite) y bloquear al proceso hijo. Se usa
+forkserver (o spawn donde no existe), así que la función de render y sus argumentos deben
+poder importarse y serializarse, y los cambios en variables de módulo hechos en tiempo de
+ejecución no llegan a los procesos (se pasan como argumentos, p. ej. con partial).
+'''
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from metrics import get_metrics
+
+# Concurrencia por defecto de cada etapa
+DOWNLOAD_WORKERS = 2
+RENDER_WORKERS = 2
+TRANSFER_WORKERS = 1
+# Máximo de imágenes descargadas que aún no se han transferido
+MAX_IN_FLIGHT = 4
+# Forma de crear los procesos de render (ver la descripción del módulo)
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Marca de fin de trabajo para los hilos de cada etapa
+_FIN = object()
+
+
+def _timed(func, item):
+    """Ejecuta func(item) y devuelve su duración; se usa en el pool de procesos, donde las métricas
+    registradas no llegarían al proceso principal."""
+    start = time.perf_counter()
+    func(item)
+    return time.perf_counter() - start
+
+
+def process_pool(max_workers):
+    """Pool de procesos que no hereda los hilos ni los candados del proceso principal."""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(START_METHOD))
+
+
+def _drain(cola):
+    """Descarta los elementos que quedan en la cola."""
+    while True:
+        try:
+            cola.get_nowait()
+        except queue.Empty:
+            return
+
+
+def run_pipeline(jobs, download, render, transfer, download_workers=DOWNLOAD_WORKERS, render_workers=RENDER_WORKERS,
+                 transfer_workers=TRANSFER_WORKERS, max_in_flight=MAX_IN_FLIGHT, on_error=None):
+    """Ejecuta download, render y transfer sobre cada trabajo con etapas concurrentes.
+
+    download(job) se ejecuta en hilos y devuelve el elemento a procesar (o None para omitirlo);
+    render(elemento) se ejecuta en un pool de procesos, por lo que debe ser una función de nivel
+    de módulo y el elemento debe poder serializarse; transfer(elemento) se ejecuta en hilos.
+    on_error(elemento, etapa, excepción) se llama si falla render ('procesamiento') o transfer
+    ('transferencia'). Devuelve el número de
+    elementos transferidos. Si jobs lanza una excepción, los trabajos en cola se descartan, se
+    terminan los que ya empezaron, se detienen los hilos y la excepción se propaga. Lo mismo ocurre
+    si un proceso de render muere (p. ej. por falta de memoria): el pool queda inservible, los
+    elementos pendientes se reportan con on_error y se lanza BrokenProcessPool."""
+    download_queue = queue.Queue(maxsize=download_workers * 2)
+    transfer_queue = queue.Queue()
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    transferred = []
+    # Excepción con la que se rompió el pool de procesos, si ocurrió
+    broken = []
+    metrics = get_metrics()
+
+    def fail(item, stage, exc):
+        print('Error en la etapa de {} de {}: {}'.format(stage, item, exc))
+        metrics.count('errores_' + stage)
+        if on_error is not None:
+            try:
+                on_error(item, stage, exc)
+            except Exception as e:
+                print('Error al limpiar {}: {}'.format(item, e))
+        in_flight.release()
+
+    def rendered(item, future):
+        exc = future.exception()
+        if isinstance(exc, BrokenProcessPool):
+            broken.append(exc)
+        if exc is not None:
+            fail(item, 'procesamiento', exc)
+        else:
+            metrics.observe('procesamiento_segundos', future.result())
+            transfer_queue.put(item)
+
+    def download_worker(pool):
+        while True:
+            job = download_queue.get()
+            if job is _FIN:
+                return
+            if broken:
+                # El pool ya no acepta trabajos; se consumen los que quedan para no bloquear al productor
+                continue
+            # Se limita el número de imágenes en el disco de trabajo
+            in_flight.acquire()
+            try:
+                item = download(job)
+            except Exception as e:
+                print('Error en la etapa de descarga de {}: {}'.format(job, e))
+                metrics.count('errores_descarga')
+                in_flight.release()
+                continue
+            if item is None:
+                in_flight.release()
+                continue
+            try:
+                future = pool.submit(_timed, render, item)
+            except Exception as e:
+                # BrokenProcessPool si murió un proceso del pool; después de eso no acepta más trabajos
+                broken.append(e)
+                fail(item, 'procesamiento', e)
+                continue
+            future.add_done_callback(partial(rendered, item))
+
+    def transfer_worker():
+        while True:
+            item = transfer_queue.get()
+            if item is _FIN:
+                return
+            try:
+                transfer(item)
+            except Exception as e:
+                fail(item, 'transferencia', e)
+                continue
+            transferred.append(item)
+            in_flight.release()
+
+    transfer_threads = [threading.Thread(target=transfer_worker, daemon=True) for _ in range(transfer_workers)]
+    for thread in transfer_threads:
+        thread.start()
+
+    try:
+        with process_pool(render_workers) as pool:
+            download_threads = [threading.Thread(target=download_worker, args=(pool,), daemon=True) for _ in range(download_workers)]
+            for thread in download_threads:
+                thread.start()
+            try:
+                # Los trabajos pueden venir de un generador (p. ej. la espera de activación)
+                for job in jobs:
+                    if broken:
+                        break
+                    download_queue.put(job)
+            except BaseException:
+                _drain(download_queue)
+                raise
+            finally:
+                for _ in download_threads:
+                    download_queue.put(_FIN)
+                for thread in download_threads:
+                    thread.join()
+        # Al salir del pool todos los PNG terminaron y sus elementos ya están en la cola de transferencia
+        if broken:
+            raise BrokenProcessPool('El pool de procesos de render dejó de funcionar: {}'.format(broken[0]))
+    finally:
+        for _ in transfer_threads:
+            transfer_queue.put(_FIN)
+        for thread in transfer_threads:
+            thread.join()
+
+    return len(transferred)
@@ -0,0 +1,116 @@
+'''
+Activación por lotes de los assets de Planet y sondeo de su estado.
+
+En lugar de activar una imagen, esperar un tiempo fijo y rendirse si no está lista,
+se activan todos los assets seleccionados al inicio y se consultan sus enlaces _self
+con espera exponencial. Cada asset se entrega a la etapa de descarga en cuanto queda
+activo, de modo que el tiempo de activación de cientos de escenas se traslapa.
+'''
+import heapq
+import time
+from requests.exceptions import RequestException
+from planet_session import get_session
+from metrics import get_metrics
+
+# Productos preferidos en orden: 8 bandas y, si no existe, 4 bandas
+PRODUCT_TYPES = ('ortho_analytic_8b_sr', 'ortho_analytic_4b_sr')
+
+# Primer intervalo de sondeo, intervalo máximo (segundos) y tiempo máximo de espera por asset
+POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 60
+ACTIVATION_TIMEOUT = 3600
+
+
+def get_assets(assets_url):
+    """Obtiene el diccionario de assets de una imagen. Devuelve None si la petición falla."""
+    try:
+        response = get_session().get(assets_url)
+    except RequestException as e:
+        print(f"Error de conexión al obtener los assets {assets_url}: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Error al obtener los assets {assets_url}: {response.status_code}")
+        return None
+    return response.json()
+
+
+def select_product(assets, product_types=PRODUCT_TYPES):
+    """Devuelve el primer tipo de producto disponible en los assets, o None si no hay ninguno."""
+    for product_type in product_types:
+        if product_type in assets:
+            return product_type
+    return None
+
+
+def activate_asset(asset):
+    """Solicita la activación de un asset si aún no está activo."""
+    if asset.get('status') == 'active':
+        return
+    try:
+        get_session().get(asset['_links']['activate'])
+    except RequestException as e:
+        # Si falla la solicitud, el sondeo la detecta como inactiva y se vuelve a solicitar
+        print(f"Error al solicitar la activación de {asset['_links']['_self']}: {e}")
+
+
+def poll_asset(asset):
+    """Consulta el estado actual de un asset mediante su enlace _self. Devuelve None si falla."""
+    try:
+        response = get_session().get(asset['_links']['_self'])
+    except RequestException as e:
+        print(f"Error al consultar el estado de {asset['_links']['_self']}: {e}")
+        return None
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+
+def wait_for_activation(jobs, poll_interval=POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL, timeout=ACTIVATION_TIMEOUT):
+    """Activa todos los assets y produce (clave, asset) conforme cada uno queda activo.
+
+    jobs es un iterable de tuplas (clave, asset) donde asset es la entrada del diccionario de assets
+    de Planet. El asset entregado incluye 'location' con la URL de descarga. Los assets que no se
+    activan antes de timeout segundos se omiten con un aviso."""
+    start = time.monotonic()
+    pending = []
+    # Momento en que se solicitó la activación de cada asset, para medir la espera
+    requested = {}
+    metrics = get_metrics()
+
+    # Primero se solicita la activación de todo el lote. Los assets ya activos se entregan después:
+    # el consumidor puede tardar en pedir el siguiente (p. ej. descargando la escena) y la activación
+    # del resto del lote no debe esperar a eso
+    ready = []
+    for order, (key, asset) in enumerate(jobs):
+        if asset.get('status') == 'active' and 'location' in asset:
+            ready.append((key, asset))
+            continue
+        activate_asset(asset)
+        requested[order] = time.monotonic()
+        heapq.heappush(pending, (start + poll_interval, order, poll_interval, key, asset))
+    yield from ready
+
+    # Después se sondea cada asset cuando le toca, duplicando su intervalo hasta max_interval
+    while pending:
+        due, order, interval, key, asset = heapq.heappop(pending)
+        wait = due - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        status = poll_asset(asset)
+        if status is not None and status.get('status') == 'active':
+            metrics.observe('activacion_segundos', time.monotonic() - requested.pop(order))
+            yield key, status
+            continue
+
+        if time.monotonic() - start > timeout:
+            print(f"El asset {key} no se activó después de {timeout} segundos. Se omitirá la descarga.")
+            metrics.count('errores_activacion')
+            continue
+
+        if status is not None and status.get('status') == 'inactive':
+            # La activación no se registró, se vuelve a solicitar
+            activate_asset(status)
+
+        interval = min(interval * 2, max_interval)
+        heapq.heappush(pending, (time.monotonic() + interval, order, interval, key, asset))
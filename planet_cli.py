@@ -0,0 +1,311 @@
+'''
+Línea de comandos no interactiva para buscar, registrar, consultar, descargar, generar los PNG
+y transferir las imágenes de Planet, sin los menús de download_ids_pg.py y download_planet_region.py.
+
+Cada subcomando importa solo las bibliotecas que usa: query e ingest cargan psycopg2 y requests,
+pero no numpy, rasterio ni paramiko; search carga shapely/fiona/pyproj y render rasterio. Así las
+consultas arrancan rápido y se pueden lanzar muchos trabajos desde cron.
+
+Subcomandos:
+    search     busca (y con --descargar descarga) las imágenes de una malla o coordenada
+    ingest     carga uno o más CSV de ids en la base de datos
+    query      consulta la base de datos por pathrow, fecha o estado de descarga
+    download   descarga las imágenes pendientes por pathrow, usuario o cola de trabajo
+    render     genera los PNG georreferenciados de GeoTIFF ya descargados
+    transfer   mueve imágenes de ./tmp a planet_images o al servidor
+    jobs       ejecuta un archivo de trabajos, un comando por línea
+
+Ejemplos:
+    python planet_cli.py query --pathrow A11
+    python planet_cli.py download --usuario Uriel --destino servidor
+    python planet_cli.py --profile download --cola --pathrow A11 A12
+    python planet_cli.py jobs trabajos.txt
+'''
+import argparse
+import csv
+import os
+import shlex
+import sys
+import time
+from concurrent.futures import as_completed
+
+from metrics import get_metrics
+from pipeline import DOWNLOAD_WORKERS, RENDER_WORKERS, TRANSFER_WORKERS, process_pool
+from profiling import enable_from_argv, profile_dir, profiled
+
+# Destinos de las imágenes descargadas (ver download_ids_pg.transfer_image) y directorio de search --descargar
+DESTINATIONS = ('local', 'servidor', 'directo')
+OUTPUT_DIR = './output'
+
+
+def command_search(args):
+    """Busca las imágenes de cada cuadrante y periodo; con --descargar también las activa y descarga."""
+    import json
+    import download_planet_region as region
+    from planet_search import POLICIES
+    from planet_download import DOWNLOAD_PARTS
+    from planet_session import configure_session, session_size
+
+    if args.politica not in POLICIES:
+        print(f"Criterio no válido: {args.politica} ({'/'.join(POLICIES)})")
+        return 1
+    if args.malla:
+        quadrants = region.shapefile_to_geojson(args.malla)
+    else:
+        quadrants = [region.latlon_to_geojson(*args.coordenadas)]
+    # Con --descargar las imágenes se descargan de una en una, cada una con DOWNLOAD_PARTS rangos
+    configure_session(session_size(args.hilos, 1 if args.descargar else 0, DOWNLOAD_PARTS))
+    batch = args.lotes and len(quadrants) > 1
+
+    if args.descargar:
+        os.makedirs(args.salida, exist_ok=True)
+        downloaded, failed = region.search_and_download_images(args.salida, quadrants, args.visibilidad, args.nubosidad,
+                                                               args.anio_inicio, args.anio_fin, args.temporadas,
+                                                               args.hilos, args.politica, batch)
+        print(f"Imágenes descargadas: {downloaded}, con error: {failed}")
+        return 1 if failed else 0
+
+    search = region.search_quadrants_batched if batch else region.search_quadrants
+    output = open(args.lista, 'w') if args.lista else sys.stdout
+    try:
+        for idx, year, season, features in search(quadrants, args.visibilidad, args.nubosidad, args.anio_inicio,
+                                                  args.anio_fin, args.temporadas, args.hilos, args.politica):
+            for feature in features:
+                output.write(json.dumps({'cuadrante': idx, 'anio': year, 'temporada': season, 'id': feature['id'],
+                                         'adquirida': feature['properties'].get('acquired')}) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+def command_ingest(args):
+    """Carga los CSV en imagenes_planet (los ids que ya existen se omiten)."""
+    import download_ids_pg as ids
+    ids.prepare_db()
+    for path in args.csv:
+        ids.update_db(path)
+    return 0
+
+
+def command_query(args):
+    """Imprime (o guarda como CSV) las filas de imagenes_planet que cumplen la consulta."""
+    import download_ids_pg as ids
+    if args.pathrow is not None:
+        if not ids.check_pathrow(args.pathrow):
+            print('El pathrow {} no existe'.format(args.pathrow))
+            return 1
+        rows = ids.select_db('pathrow', args.pathrow)
+    elif args.fecha is not None:
+        rows = ids.select_db('fecha', args.fecha)
+    else:
+        rows = ids.select_db('descargada', args.descargada)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+        print('Se guardaron {} filas en {}'.format(len(rows), args.csv))
+    else:
+        ids.print_data(rows)
+    return 0
+
+
+def command_download(args):
+    """Descarga las imágenes pendientes de los pathrows, de un usuario o de la cola de trabajo compartida."""
+    import download_ids_pg as ids
+    from planet_session import configure_session, session_size
+    ids.prepare_db()
+    # Cada hilo de descarga abre DOWNLOAD_PARTS rangos; en modo directo basta con uno por hilo
+    parts = 1 if args.destino == 'directo' else ids.DOWNLOAD_PARTS
+    configure_session(session_size(download_workers=args.hilos_descarga, parts=parts))
+    pathrows = args.pathrow
+    if args.usuario:
+        if args.usuario not in ids.USER_PATHROWS:
+            print('El usuario {} no existe ({})'.format(args.usuario, '/'.join(ids.USER_PATHROWS)))
+            return 1
+        pathrows = ids.USER_PATHROWS[args.usuario]
+
+    if args.cola:
+        processed, failed = ids.download_leased(args.destino, pathrows, batch=args.lote or ids.LEASE_BATCH,
+                                                png_max_size=args.max_size or ids.PNG_MAX_SIZE,
+                                                download_workers=args.hilos_descarga, render_workers=args.procesos,
+                                                transfer_workers=args.hilos_transferencia)
+        print('Imagenes procesadas: {}, con error: {}'.format(processed, failed))
+        return 1 if failed else 0
+    if not pathrows:
+        print('Indique --pathrow, --usuario o --cola')
+        return 1
+
+    pathrows = ids.check_pathrow_not_download(pathrows)
+    ids_planet = ids.select_db_not_download('pathrow', pathrows)
+    print('Estan disponibles para descarga {} imagenes de los pathrows {}'.format(len(ids_planet), pathrows))
+    if not ids_planet:
+        return 0
+    processed, failed = ids.download_images(args.destino, pathrows, ids_planet, download_workers=args.hilos_descarga,
+                                            render_workers=args.procesos, transfer_workers=args.hilos_transferencia,
+                                            png_max_size=args.max_size or ids.PNG_MAX_SIZE)
+    return 1 if failed else 0
+
+
+def base_paths(paths):
+    """Rutas sin extensión (como las usa download_ids_pg) de una lista de archivos, sin repetir."""
+    return list(dict.fromkeys(os.path.splitext(path)[0] for path in paths))
+
+
+def render_one(path, max_size):
+    """Genera el PNG de una imagen y devuelve los segundos que tardó (se ejecuta en un proceso del pool)."""
+    import download_ids_pg as ids
+    start = time.perf_counter()
+    with profiled('png', os.path.basename(path)):
+        ids.create_png(path, max_size or ids.PNG_MAX_SIZE)
+    return time.perf_counter() - start
+
+
+def command_render(args):
+    """Genera los PNG georreferenciados de los GeoTIFF indicados, en paralelo por procesos."""
+    paths = base_paths(args.tif)
+    failures = 0
+    with process_pool(max(1, args.procesos)) as pool:
+        futures = {pool.submit(render_one, path, args.max_size): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                get_metrics().observe('procesamiento_segundos', future.result())
+                print('PNG generado: {}.png'.format(futures[future]))
+            except Exception as e:
+                failures += 1
+                get_metrics().count('errores_procesamiento')
+                print('No se pudo generar el PNG de {}: {}'.format(futures[future], e))
+    print('Se generaron {} de {} PNG'.format(len(paths) - failures, len(paths)))
+    return 1 if failures else 0
+
+
+def command_transfer(args):
+    """Mueve los archivos (.tif, .png...) de cada imagen a planet_images/<pathrow> o al servidor."""
+    import download_ids_pg as ids
+    for path in base_paths(args.archivo):
+        # Los archivos se llaman <id de Planet>_<id_mex>
+        image_id = os.path.basename(path).rsplit('_', 1)[0]
+        ids.transfer_image(args.destino, (image_id, path), args.pathrow)
+    return 0
+
+
+def command_jobs(args):
+    """Ejecuta los comandos del archivo de trabajos en este mismo proceso (los módulos se importan una vez)."""
+    parser = build_parser()
+    with open(args.archivo) as f:
+        lines = [line.strip() for line in f]
+    jobs = [line for line in lines if line and not line.startswith('#')]
+    failures = 0
+    for number, line in enumerate(jobs, start=1):
+        print('[{}/{}] {}'.format(number, len(jobs), line))
+        try:
+            job = parser.parse_args(shlex.split(line))
+            if job.command is command_jobs:
+                raise ValueError('un archivo de trabajos no puede ejecutar otro')
+            status = job.command(job)
+        except SystemExit as e:
+            # argparse termina con SystemExit si el comando es inválido
+            status = e.code
+        except Exception as e:
+            print('Error en el trabajo {}: {}'.format(number, e))
+            status = 1
+        if status:
+            failures += 1
+            if args.detener:
+                break
+    print('Trabajos terminados: {}, con error: {}'.format(len(jobs), failures))
+    return 1 if failures else 0
+
+
+def build_parser():
+    """Construye el parser con un subparser por comando."""
+    parser = argparse.ArgumentParser(
+        description='Descarga de imágenes de Planet sin menús interactivos.',
+        epilog='--profile[=DIR] antes del subcomando guarda perfiles de CPU y memoria (ver profiling.py).')
+    commands = parser.add_subparsers(dest='subcomando', required=True)
+
+    search = commands.add_parser('search', aliases=['buscar'], help='busca imágenes por malla o coordenada')
+    area = search.add_mutually_exclusive_group(required=True)
+    area.add_argument('--malla', help='shapefile o GeoPackage de cuadrantes')
+    area.add_argument('--coordenadas', nargs=2, type=float, metavar=('LAT', 'LON'))
+    search.add_argument('--visibilidad', type=float, default=90.0, help='porcentaje mínimo de visibilidad')
+    search.add_argument('--nubosidad', type=float, default=10.0, help='porcentaje máximo de nubes')
+    search.add_argument('--anio-inicio', type=int, required=True)
+    search.add_argument('--anio-fin', type=int, required=True)
+    search.add_argument('--temporadas', action='store_true', help='busca por temporada de lluvias y secas')
+    search.add_argument('--politica', default='primera', help='criterio para elegir la imagen (ver planet_search.POLICIES)')
+    search.add_argument('--lotes', action='store_true', help='una búsqueda por lote de cuadrantes vecinos')
+    search.add_argument('--hilos', type=int, default=4, help='búsquedas en paralelo')
+    search.add_argument('--lista', help='archivo JSON lines con las imágenes elegidas (por defecto la salida estándar)')
+    search.add_argument('--descargar', action='store_true', help='activa y descarga las imágenes elegidas')
+    search.add_argument('--salida', default=OUTPUT_DIR, help='directorio de descarga con --descargar')
+    search.set_defaults(command=command_search, report='region')
+
+    ingest = commands.add_parser('ingest', aliases=['cargar'], help='carga CSV de ids en la base de datos')
+    ingest.add_argument('csv', nargs='+')
+    ingest.set_defaults(command=command_ingest, report=None)
+
+    query = commands.add_parser('query', aliases=['consultar'], help='consulta la base de datos')
+    condition = query.add_mutually_exclusive_group(required=True)
+    condition.add_argument('--pathrow')
+    condition.add_argument('--fecha', help='imágenes desde esta fecha (AAAA-MM-DD)')
+    condition.add_argument('--descargada', choices=('true', 'false'))
+    query.add_argument('--csv', help='guarda las filas en este archivo en lugar de imprimirlas')
+    query.set_defaults(command=command_query, report=None)
+
+    download = commands.add_parser('download', aliases=['descargar'], help='descarga las imágenes pendientes')
+    download.add_argument('--pathrow', nargs='+', help='pathrows a descargar (con --cola, filtro de la cola)')
+    download.add_argument('--usuario', help='pathrows asignados al usuario (download_ids_pg.USER_PATHROWS)')
+    download.add_argument('--cola', action='store_true', help='usa la cola de trabajo compartida entre equipos')
+    download.add_argument('--lote', type=int, default=None, help='imágenes arrendadas por lote con --cola '
+                                                                 '(por defecto download_ids_pg.LEASE_BATCH)')
+    download.add_argument('--destino', choices=DESTINATIONS, default='local')
+    download.add_argument('--hilos-descarga', type=int, default=DOWNLOAD_WORKERS)
+    download.add_argument('--procesos', type=int, default=RENDER_WORKERS, help='procesos que generan los PNG')
+    download.add_argument('--hilos-transferencia', type=int, default=TRANSFER_WORKERS)
+    download.add_argument('--max-size', type=int, default=None,
+                          help='lado mayor de los PNG de vista previa (por defecto PL_PNG_MAX_SIZE o resolución completa)')
+    download.set_defaults(command=command_download, report='ids_pg')
+
+    render = commands.add_parser('render', aliases=['png'], help='genera los PNG de GeoTIFF descargados')
+    render.add_argument('tif', nargs='+')
+    render.add_argument('--max-size', type=int, default=None,
+                        help='lado mayor del PNG (por defecto PL_PNG_MAX_SIZE o resolución completa)')
+    render.add_argument('--procesos', type=int, default=RENDER_WORKERS)
+    render.set_defaults(command=command_render, report='render')
+
+    transfer = commands.add_parser('transfer', aliases=['transferir'], help='mueve imágenes a planet_images o al servidor')
+    transfer.add_argument('archivo', nargs='+', help='archivos de ./tmp (.tif, .png...) o rutas sin extensión')
+    transfer.add_argument('--destino', choices=DESTINATIONS[:2], default='servidor')
+    transfer.add_argument('--pathrow', help='pathrow de destino (por defecto se consulta en la base de datos)')
+    transfer.set_defaults(command=command_transfer, report='transferencia')
+
+    jobs = commands.add_parser('jobs', aliases=['trabajos'], help='ejecuta un archivo de trabajos')
+    jobs.add_argument('archivo', help='un comando de planet_cli.py por línea; las líneas con # se ignoran')
+    jobs.add_argument('--detener', action='store_true', help='se detiene en el primer trabajo con error')
+    jobs.set_defaults(command=command_jobs, report='trabajos')
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    # --profile acepta un directorio opcional solo como --profile=DIR para no confundirlo con el subcomando
+    if enable_from_argv(argv):
+        print('Perfilado activado, los perfiles se guardan en {}'.format(profile_dir()))
+    argv = [arg for arg in argv if arg != '--profile' and not arg.startswith('--profile=')]
+    args = build_parser().parse_args(argv)
+    try:
+        status = args.command(args)
+    finally:
+        # Solo se cierran los pools si el subcomando importó download_ids_pg
+        ids = sys.modules.get('download_ids_pg')
+        if ids is not None:
+            ids.close_db_pool()
+            ids.close_sftp_pool()
+        if args.report:
+            get_metrics().write_report(args.report)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
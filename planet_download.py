@@ -0,0 +1,305 @@
+'''
+Descarga reanudable de los GeoTIFF de Planet con peticiones HTTP Range.
+
+La imagen se escribe primero en un archivo .part junto con un archivo de estado
+.part.json que registra el avance de cada segmento. Si la conexión se cae, la
+descarga continúa desde el último byte escrito. Los archivos grandes se pueden
+dividir en varios rangos descargados en paralelo. El archivo solo se renombra a
+su nombre final cuando todos los segmentos están completos y el tamaño (y el md5 que
+reporta Planet, si existe) coinciden. El .part se reserva con su tamaño final, así que
+para las descargas por rangos el tamaño no basta: sin md5, lo que garantiza que no
+quedan huecos en ceros es el estado de los segmentos.
+'''
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import ChunkedEncodingError
+from planet_session import call_with_retries, get_session
+from metrics import get_metrics
+
+# Tamaño de los bloques leídos de la respuesta. La memoria por descarga queda acotada a
+# un bloque por rango, sin importar el tamaño de la escena (PL_CHUNK_SIZE en bytes)
+CHUNK_SIZE = int(os.getenv('PL_CHUNK_SIZE', 4 * 1024 * 1024))
+# Número de rangos en paralelo por archivo y tamaño mínimo de cada rango
+DOWNLOAD_PARTS = 4
+MIN_PART_SIZE = 64 * 1024 * 1024
+# Cada cuántos bytes escritos se guarda el estado de la descarga
+STATE_SAVE_INTERVAL = 32 * 1024 * 1024
+
+
+class DownloadError(Exception):
+    """La descarga terminó pero el archivo no pasó la verificación de tamaño o md5."""
+
+
+def probe(url):
+    """Consulta el tamaño total del archivo y si el servidor acepta peticiones Range.
+
+    Se usa un GET del primer byte en lugar de HEAD porque las URL firmadas de descarga
+    solo son válidas para GET."""
+    with get_session().get(url, stream=True, headers={'Range': 'bytes=0-0'}) as response:
+        response.raise_for_status()
+        if response.status_code == 206:
+            total = int(response.headers['Content-Range'].rsplit('/', 1)[-1])
+            return total, True
+        return int(response.headers.get('Content-Length', 0)) or None, False
+
+
+def split_ranges(total, parts, min_part_size=MIN_PART_SIZE):
+    """Divide [0, total) en a lo más parts rangos [inicio, fin] de al menos min_part_size bytes."""
+    parts = max(1, min(parts, total // min_part_size if min_part_size else parts))
+    size = -(-total // parts)
+    return [[start, min(start + size, total) - 1] for start in range(0, total, size)]
+
+
+def md5sum(path, chunk_size=CHUNK_SIZE):
+    """Calcula el md5 de un archivo leyéndolo por bloques."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_stream(response, f, chunk_size, on_chunk=None):
+    """Escribe el cuerpo de la respuesta en el archivo abierto, bloque por bloque.
+
+    La respuesta debe pedirse con stream=True; nunca se accede a response.content, así que
+    solo hay un bloque de chunk_size bytes en memoria a la vez."""
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if chunk:
+            f.write(chunk)
+            if on_chunk is not None:
+                # El avance solo se registra cuando el bloque ya salió del buffer de Python
+                f.flush()
+                on_chunk(len(chunk))
+
+
+class _State:
+    """Avance de cada segmento de una descarga, persistido en el archivo .part.json."""
+
+    def __init__(self, path, url, total, ranges):
+        self.path = path
+        self.data = {'url': url, 'total': total, 'ranges': ranges}
+        self.lock = threading.Lock()
+        self.unsaved = 0
+
+    @classmethod
+    def load(cls, path, url, total):
+        """Carga el estado si corresponde al mismo archivo; de lo contrario devuelve None."""
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('total') != total:
+            return None
+        return cls(path, url, total, data['ranges'])
+
+    def advance(self, index, nbytes):
+        with self.lock:
+            self.data['ranges'][index][0] += nbytes
+            self.unsaved += nbytes
+            if self.unsaved >= STATE_SAVE_INTERVAL:
+                self._save()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
+        self.unsaved = 0
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _fetch_range(url, part_path, state, index, chunk_size):
+    """Descarga lo que falta del segmento index y lo escribe en su posición del archivo .part."""
+    start, end = state.data['ranges'][index]
+    if start > end:
+        return
+    # Los bytes solo se cuentan como escritos cuando ya están en el archivo, así un
+    # reintento continúa desde el punto correcto
+    with get_session().get(url, stream=True, headers={'Range': f'bytes={start}-{end}'}) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise DownloadError(f"El servidor no respetó el rango {start}-{end} ({response.status_code})")
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            _write_stream(response, f, chunk_size, lambda n: state.advance(index, n))
+    # Si el servidor cerró el flujo antes del final del rango se reintenta desde el último byte escrito
+    if state.data['ranges'][index][0] <= end:
+        raise ChunkedEncodingError(f"El rango {start}-{end} terminó en el byte {state.data['ranges'][index][0]}")
+
+
+def _fetch_whole(url, part_path, chunk_size):
+    """Descarga el archivo completo en un solo flujo, para servidores sin soporte de Range."""
+    with get_session().get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(part_path, 'wb') as f:
+            _write_stream(response, f, chunk_size)
+
+
+def record_download(nbytes, elapsed):
+    """Registra el tiempo, los bytes y la velocidad de una descarga terminada."""
+    metrics = get_metrics()
+    metrics.observe('descarga_segundos', elapsed)
+    metrics.count('descarga_bytes', nbytes)
+    if elapsed > 0:
+        metrics.observe('descarga_mb_por_segundo', nbytes / elapsed / 1e6)
+
+
+def download_file(url, path, parts=1, expected_md5=None, chunk_size=CHUNK_SIZE, min_part_size=MIN_PART_SIZE):
+    """Descarga url en path de forma reanudable y verificada.
+
+    Con parts > 1 los archivos de más de min_part_size bytes se dividen en rangos que se
+    descargan en paralelo. Lanza DownloadError si el archivo final no coincide con el tamaño
+    o el md5 esperado; en ese caso se eliminan los archivos parciales."""
+    start = time.perf_counter()
+    try:
+        received = _download_file(url, path, parts, expected_md5, chunk_size, min_part_size)
+    except Exception:
+        get_metrics().count('errores_descarga')
+        raise
+    # La velocidad se calcula con los bytes recibidos en esta llamada: al reanudar, lo descargado
+    # en sesiones anteriores no cuenta
+    record_download(received, time.perf_counter() - start)
+    return path
+
+
+def _download_file(url, path, parts, expected_md5, chunk_size, min_part_size):
+    """Cuerpo de download_file, sin las métricas. Devuelve los bytes recibidos en esta llamada."""
+    part_path = path + '.part'
+    state_path = part_path + '.json'
+    total, accepts_ranges = call_with_retries(probe, url)
+
+    if not accepts_ranges or not total:
+        # Sin Range no se puede reanudar ni dividir: se descarga de nuevo completo
+        call_with_retries(_fetch_whole, url, part_path, chunk_size)
+        state = None
+        received = os.path.getsize(part_path)
+    else:
+        state = None
+        if os.path.exists(part_path) and os.path.getsize(part_path) == total:
+            state = _State.load(state_path, url, total)
+            if state is not None:
+                print(f"Reanudando la descarga de {os.path.basename(path)}...")
+        if state is None:
+            # Se reserva el archivo completo para que cada segmento escriba en su posición
+            with open(part_path, 'wb') as f:
+                f.truncate(total)
+            state = _State(state_path, url, total, split_ranges(total, parts, min_part_size))
+            state.save()
+
+        ranges = state.data['ranges']
+        # Los segmentos solo avanzan con bytes escritos, así que lo pendiente ahora es lo que se recibirá
+        received = sum(end - start + 1 for start, end in ranges if start <= end)
+        try:
+            if len(ranges) == 1:
+                call_with_retries(_fetch_range, url, part_path, state, 0, chunk_size)
+            else:
+                with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                    futures = [executor.submit(call_with_retries, _fetch_range, url, part_path, state, i, chunk_size)
+                               for i in range(len(ranges))]
+                    for future in futures:
+                        future.result()
+        finally:
+            # Se guarda el avance para poder reanudar aunque la descarga falle
+            state.save()
+
+        # El tamaño del .part siempre es el total: se comprueba que ningún segmento quedó a medias
+        missing = sum(end - start + 1 for start, end in state.data['ranges'] if start <= end)
+        if missing:
+            # Se conservan el .part y su estado para reanudar en el siguiente intento
+            raise DownloadError(f"Faltan {missing} bytes de {os.path.basename(path)}")
+
+    verify_file(part_path, total, expected_md5, chunk_size)
+    os.replace(part_path, path)
+    if state is not None:
+        state.remove()
+    return received
+
+
+def verify_file(part_path, total=None, expected_md5=None, chunk_size=CHUNK_SIZE):
+    """Verifica el tamaño y el md5 del archivo descargado; elimina los parciales si no coinciden."""
+    problem = None
+    size = os.path.getsize(part_path)
+    if total and size != total:
+        problem = f"tamaño {size} distinto al esperado {total}"
+    elif expected_md5 and md5sum(part_path, chunk_size) != expected_md5:
+        problem = "md5 distinto al reportado por Planet"
+
+    if problem is not None:
+        os.remove(part_path)
+        if os.path.exists(part_path + '.json'):
+            os.remove(part_path + '.json')
+        raise DownloadError(f"La descarga de {part_path} no es válida: {problem}")
+
+
+def tee_download(url, sinks, chunk_size=CHUNK_SIZE, queue_size=4):
+    """Descarga url en un solo flujo y escribe cada bloque en todos los sinks (objetos con write).
+
+    Cada sink se atiende en su propio hilo con una cola de a lo más queue_size bloques, así un
+    destino lento frena la descarga en lugar de acumular memoria. Devuelve (bytes, md5) calculados
+    sobre el flujo, sin volver a leer los archivos. Lanza DownloadError si el tamaño no coincide
+    con el Content-Length."""
+    errors = []
+    fin = object()
+
+    def consume(sink, cola):
+        while True:
+            chunk = cola.get()
+            if chunk is fin:
+                return
+            if errors:
+                # Se sigue vaciando la cola para no bloquear la descarga
+                continue
+            try:
+                sink.write(chunk)
+            except Exception as e:
+                errors.append(e)
+
+    colas = [queue.Queue(maxsize=queue_size) for _ in sinks]
+    hilos = [threading.Thread(target=consume, args=(sink, cola), daemon=True) for sink, cola in zip(sinks, colas)]
+    for hilo in hilos:
+        hilo.start()
+
+    digest = hashlib.md5()
+    total = 0
+    start = time.perf_counter()
+    try:
+        with get_session().get(url, stream=True) as response:
+            response.raise_for_status()
+            expected = int(response.headers.get('Content-Length', 0)) or None
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if errors:
+                    break
+                if not chunk:
+                    continue
+                digest.update(chunk)
+                total += len(chunk)
+                for cola in colas:
+                    cola.put(chunk)
+    finally:
+        for cola in colas:
+            cola.put(fin)
+        for hilo in hilos:
+            hilo.join()
+
+    if errors:
+        get_metrics().count('errores_descarga')
+        raise errors[0]
+    if expected is not None and total != expected:
+        get_metrics().count('errores_descarga')
+        raise DownloadError(f"Se recibieron {total} bytes de {url}, se esperaban {expected}")
+    record_download(total, time.perf_counter() - start)
+    return total, digest.hexdigest()
@@ -0,0 +1,201 @@
+'''
+Búsqueda paginada en quick-search con selección de la mejor escena.
+
+iter_search sigue los enlaces _links._next de forma perezosa, página por página, y
+select_feature recorre esas escenas con una política de selección (menor nubosidad,
+mayor visibilidad o más reciente), deteniéndose en cuanto la política se cumple sin
+necesidad de traer el resto de las páginas. Para mallas con muchos cuadrantes,
+group_quadrants agrupa cuadrantes vecinos en lotes que se buscan con una sola
+geometría y assign_features reparte las escenas de cada lote entre sus cuadrantes
+con un índice espacial STRtree. La política 'cobertura' elige, en lugar de una
+sola escena, el conjunto mínimo de escenas que cubre el cuadrante (cover_quadrant).
+'''
+import heapq
+from statistics import median
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from shapely.strtree import STRtree
+from planet_session import PLANET_API_URL, get_session
+from metrics import get_metrics
+
+# Escenas por página (máximo permitido por la API)
+PAGE_SIZE = 250
+# Cuadrantes por lado de cada lote de búsqueda (hasta BATCH_SIDE × BATCH_SIDE cuadrantes por lote)
+BATCH_SIDE = 4
+# Política 'cobertura': fracción del cuadrante a cubrir; fracción mínima de su propia huella que una
+# escena debe agregar como área nueva para descargarla (descarta escenas que apenas tocan el
+# cuadrante o que caen sobre lo ya cubierto); máximo de escenas por cuadrante (None sin límite)
+COVERAGE_TARGET = 0.95
+MIN_USEFUL_FRACTION = 0.1
+MAX_SCENES = None
+
+# Políticas de selección:
+#   sort: orden que se pide a la API (_sort), si la política lo permite
+#   key: función a minimizar sobre las propiedades de la escena
+#   ideal: función que indica que ya no puede haber una escena mejor
+#   cover: la política elige un conjunto de escenas con cover_quadrant
+POLICIES = {
+    # Primera escena de la primera página, como se hacía originalmente
+    'primera': {'sort': None, 'key': None, 'ideal': None},
+    # Menor cobertura de nubes
+    'nubes': {'sort': None, 'key': lambda p: p.get('cloud_cover', 1.0), 'ideal': lambda p: p.get('cloud_cover', 1.0) <= 0},
+    # Mayor porcentaje de píxeles despejados
+    'visibilidad': {'sort': None, 'key': lambda p: -p.get('clear_percent', 0), 'ideal': lambda p: p.get('clear_percent', 0) >= 100},
+    # Adquisición más reciente: la API la ordena, basta con la primera escena
+    'reciente': {'sort': 'acquired desc', 'key': None, 'ideal': None},
+    # Conjunto mínimo de escenas que cubre el cuadrante (ver cover_quadrant)
+    'cobertura': {'sort': None, 'key': None, 'ideal': None, 'cover': True},
+}
+
+
+def iter_search(search_request, sort=None, page_size=PAGE_SIZE):
+    """Genera las escenas de una búsqueda, pidiendo la siguiente página solo cuando se necesita.
+
+    Lanza requests.HTTPError si alguna página responde con error."""
+    session = get_session()
+    metrics = get_metrics()
+    params = {'_page_size': page_size}
+    if sort:
+        params['_sort'] = sort
+    with metrics.timer('busqueda_segundos'):
+        response = session.post(f'{PLANET_API_URL}/quick-search', json=search_request, params=params)
+    while True:
+        response.raise_for_status()
+        page = response.json()
+        features = page.get('features', [])
+        yield from features
+        next_url = page.get('_links', {}).get('_next')
+        if not features or not next_url:
+            return
+        with metrics.timer('busqueda_segundos'):
+            response = session.get(next_url)
+
+
+def choose_feature(features, policy='primera'):
+    """Devuelve (escena elegida, escenas revisadas) de un iterable de escenas según la política.
+
+    Si features es perezoso (p. ej. iter_search) se deja de consumir en cuanto la política se cumple."""
+    config = POLICIES[policy]
+    best = None
+    best_key = None
+    seen = 0
+    for feature in features:
+        seen += 1
+        properties = feature.get('properties', {})
+        if config['key'] is None:
+            return feature, seen
+        key = config['key'](properties)
+        if best is None or key < best_key:
+            best, best_key = feature, key
+            # Si la escena es ideal no se revisan (ni se piden) más escenas
+            if config['ideal'](properties):
+                break
+    return best, seen
+
+
+def select_feature(search_request, policy='primera', page_size=PAGE_SIZE):
+    """Devuelve (escena elegida, escenas revisadas) según la política; la escena es None si no hubo resultados."""
+    return choose_feature(iter_search(search_request, POLICIES[policy]['sort'], page_size), policy)
+
+
+def scene_weight(properties):
+    """Peso de una escena para la cobertura: fracción sin nubes por fracción despejada (clear_percent de 0 a 100)."""
+    return (1.0 - properties.get('cloud_cover', 0.0)) * properties.get('clear_percent', 100) / 100.0
+
+
+def cover_quadrant(quadrant, features, target=COVERAGE_TARGET, min_useful=MIN_USEFUL_FRACTION, max_scenes=MAX_SCENES):
+    """Elige con un algoritmo voraz (set cover) las escenas que cubren el cuadrante (GeoJSON).
+
+    En cada paso se elige la escena con mayor área nueva sobre la parte aún descubierta, ponderada
+    por scene_weight. Las intersecciones y áreas iniciales se calculan para todas las candidatas a
+    la vez; como el área nueva de una escena solo puede disminuir, después basta con recalcular la
+    de la mejor candidata (evaluación perezosa con un heap). Se detiene al llegar a target o con
+    max_scenes escenas, y descarta las escenas cuya área nueva es menor a min_useful de su huella.
+    Las áreas se calculan en grados: solo se comparan fracciones de un mismo cuadrante.
+    Devuelve (escenas elegidas, fracción cubierta)."""
+    area = shape(quadrant)
+    total = area.area
+    if not features or not total:
+        return [], 0.0
+    shapely.prepare(area)
+    footprints = np.array([shape(feature['geometry']) for feature in features], dtype=object)
+    hits = shapely.intersects(area, footprints)
+    candidates = [feature for feature, hit in zip(features, hits) if hit]
+    if not candidates:
+        return [], 0.0
+    parts = shapely.intersection(footprints[hits], area)
+    footprint_areas = shapely.area(footprints[hits])
+    weights = np.array([scene_weight(feature.get('properties', {})) for feature in candidates])
+    gains = shapely.area(parts)
+    heap = [(-gain * weight, i) for i, (gain, weight) in enumerate(zip(gains, weights)) if weight > 0]
+    heapq.heapify(heap)
+
+    chosen = []
+    uncovered = area
+    covered = 0.0
+    while heap and covered < target and (max_scenes is None or len(chosen) < max_scenes):
+        _, i = heapq.heappop(heap)
+        gain = shapely.area(shapely.intersection(parts[i], uncovered)) if chosen else gains[i]
+        if gain < min_useful * footprint_areas[i]:
+            # El área nueva solo disminuye, la escena ya no puede volverse útil
+            continue
+        score = gain * weights[i]
+        if heap and score < -heap[0][0]:
+            # Otra candidata podría ser mejor: se vuelve a formar con su puntuación actualizada
+            heapq.heappush(heap, (-score, i))
+            continue
+        chosen.append(candidates[i])
+        uncovered = shapely.difference(uncovered, parts[i])
+        covered = 1.0 - uncovered.area / total
+    return chosen, covered
+
+
+def select_features(features, quadrant, policy='primera'):
+    """Devuelve (escenas elegidas, escenas revisadas) para un cuadrante según la política.
+
+    Con 'cobertura' se revisan todas las escenas y se eligen con cover_quadrant; con las demás
+    políticas la lista tiene a lo más una escena (ver choose_feature)."""
+    if POLICIES[policy].get('cover'):
+        features = list(features)
+        chosen, covered = cover_quadrant(quadrant, features)
+        if chosen:
+            print(f"Cobertura del cuadrante: {covered:.1%} con {len(chosen)} de {len(features)} escenas.")
+        return chosen, len(features)
+    best, seen = choose_feature(features, policy)
+    return ([best] if best is not None else []), seen
+
+
+def group_quadrants(quadrants, side=BATCH_SIDE):
+    """Agrupa cuadrantes vecinos (GeoJSON) en lotes de a lo más side × side cuadrantes.
+
+    Los lotes son las celdas de una malla gruesa cuyo tamaño es side veces el tamaño típico de
+    un cuadrante; cada cuadrante va al lote que contiene su centroide. Devuelve listas de índices
+    de quadrants, ordenadas de norte a sur y de oeste a este."""
+    geoms = [shape(quadrant) for quadrant in quadrants]
+    bounds = [geom.bounds for geom in geoms]
+    min_x = min(b[0] for b in bounds)
+    max_y = max(b[3] for b in bounds)
+    # La mediana evita que un cuadrante recortado o muy grande deforme la malla
+    width = median(b[2] - b[0] for b in bounds) * side or 1.0
+    height = median(b[3] - b[1] for b in bounds) * side or 1.0
+
+    groups = {}
+    for i, geom in enumerate(geoms):
+        centroid = geom.centroid
+        key = (int((max_y - centroid.y) // height), int((centroid.x - min_x) // width))
+        groups.setdefault(key, []).append(i)
+    return [groups[key] for key in sorted(groups)]
+
+
+def assign_features(features, quadrants):
+    """Asigna las escenas a los cuadrantes (GeoJSON) que intersectan su huella.
+
+    Devuelve una lista por cuadrante con sus escenas en el orden recibido, así las políticas
+    que dependen del orden de la API ('primera', 'reciente') se siguen cumpliendo."""
+    tree = STRtree([shape(quadrant) for quadrant in quadrants])
+    assigned = [[] for _ in quadrants]
+    for feature in features:
+        for i in sorted(tree.query(shape(feature['geometry']), predicate='intersects')):
+            assigned[i].append(feature)
+    return assigned
@@ -0,0 +1,150 @@
+'''
+Sesión HTTP compartida para todas las llamadas a la API de Planet.
+
+Mantiene un único requests.Session con conexiones keep-alive, reintentos con
+espera exponencial ante errores 5xx y timeouts por petición, para no pagar un
+handshake TLS en cada llamada ni perder imágenes por errores transitorios. Cada
+petición pasa por el limitador compartido de rate_limit.py y las respuestas 429
+se reintentan después de la pausa que indica Planet.
+'''
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+from urllib3.util.retry import Retry
+from rate_limit import endpoint_kind, get_limiter
+
+# Si la variable API está en el sistema operativo, se usa, de lo contrario, se usa la API_KEY
+API_KEY = os.getenv('PL_API_KEY', '')
+
+PLANET_API_URL = 'https://api.planet.com/data/v1'
+
+# Timeout por petición en segundos: (conexión, lectura)
+DEFAULT_TIMEOUT = (10, 120)
+# Número de reintentos y factor de espera exponencial (1, 2, 4, 8... segundos)
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 1.0
+# Códigos de estado que se reintentan automáticamente
+RETRY_STATUS = (500, 502, 503, 504)
+# Errores de red que se reintentan al leer el cuerpo de la respuesta
+TRANSIENT_ERRORS = (ChunkedEncodingError, ConnectionError, Timeout)
+# Reintentos de una petición que recibe 429; la espera la decide el limitador (Retry-After)
+RATE_LIMIT_RETRIES = 10
+# Conexiones para las llamadas que corren junto a las descargas (assets, activación y su consulta)
+CONTROL_CONNECTIONS = 2
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class RateLimitRetry(Retry):
+    """Política de reintentos de urllib3 que no reintenta los 429 por su cuenta.
+
+    urllib3 reintenta los 429 con Retry-After durmiendo en el hilo que recibió la respuesta; así
+    los demás hilos seguirían enviando peticiones. Con esta política el 429 llega al adaptador,
+    que pausa la cubeta compartida."""
+    RETRY_AFTER_STATUS_CODES = Retry.RETRY_AFTER_STATUS_CODES - {429}
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """Adaptador HTTP que aplica un timeout por defecto a las peticiones que no lo indican.
+
+    Si recibe un limitador, toma un token de la cubeta del endpoint antes de cada envío y, ante
+    un 429, pausa la cubeta (para todos los hilos) y reintenta la misma petición."""
+
+    def __init__(self, *args, timeout=DEFAULT_TIMEOUT, limiter=None, rate_limit_retries=RATE_LIMIT_RETRIES, **kwargs):
+        self.timeout = timeout
+        self.limiter = limiter
+        self.rate_limit_retries = rate_limit_retries
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if self.limiter is None:
+            return super().send(request, **kwargs)
+
+        for attempt in range(self.rate_limit_retries + 1):
+            self.limiter.acquire(request.url)
+            response = super().send(request, **kwargs)
+            if response.status_code != 429:
+                self.limiter.succeed(request.url)
+                return response
+            if attempt == self.rate_limit_retries:
+                break
+            delay = self.limiter.penalize(request.url, response.headers.get('Retry-After'))
+            print(f"Límite de peticiones de Planet ({endpoint_kind(request.url)}). Reintentando en {delay:.1f} segundos ({attempt + 1}/{self.rate_limit_retries})...")
+            response.close()
+        return response
+
+
+def create_session(workers=4, api_key=None, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT, rate_limit=True):
+    """Crea una sesión autenticada con un pool de conexiones del tamaño del número de workers.
+
+    Con rate_limit=True todas las sesiones del proceso comparten el limitador de rate_limit.py."""
+    retry = (RateLimitRetry if rate_limit else Retry)(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=frozenset(['GET', 'POST', 'HEAD']),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = TimeoutHTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=retry, timeout=timeout,
+                                 limiter=get_limiter() if rate_limit else None)
+
+    session = requests.Session()
+    session.auth = HTTPBasicAuth(API_KEY if api_key is None else api_key, '')
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session_size(search_workers=1, download_workers=0, parts=1):
+    """Tamaño del pool para que no se descarte ninguna conexión en uso al mismo tiempo.
+
+    Cada descarga abre hasta parts conexiones (una por rango); las búsquedas y las descargas no
+    corren a la vez, las llamadas de control sí, por eso se suman aparte."""
+    return max(search_workers, download_workers * parts) + CONTROL_CONNECTIONS
+
+
+def configure_session(workers=4, **kwargs):
+    """Reemplaza la sesión compartida por una nueva con el tamaño de pool indicado."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = create_session(workers, **kwargs)
+        return _session
+
+
+def get_session():
+    """Devuelve la sesión compartida, creándola con los valores por defecto si aún no existe."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def call_with_retries(func, *args, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, **kwargs):
+    """Ejecuta func reintentando con espera exponencial si falla la lectura del cuerpo de la respuesta.
+
+    Los reintentos de urllib3 solo cubren el envío de la petición y los códigos de estado; un
+    ChunkedEncodingError aparece mientras se consume el cuerpo, por lo que se reintenta aquí toda la
+    operación (petición y lectura)."""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            if attempt == retries:
+                raise
+            wait = backoff * (2 ** attempt)
+            print(f"Error de conexión: {e}. Reintentando en {wait:.0f} segundos ({attempt + 1}/{retries})...")
+            time.sleep(wait)
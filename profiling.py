@@ -0,0 +1,203 @@
+'''
+Perfilado opcional (--profile) de CPU y memoria por imagen.
+
+Con el perfilado activado, cada bloque marcado con profiled() guarda en el directorio
+de perfiles un archivo .pstats de cProfile, las líneas que más memoria asignaron
+según tracemalloc y una línea en perfiles.jsonl con la duración, el RSS al inicio,
+el pico de RSS muestreado durante el bloque, el pico de tracemalloc y los datos de
+la escena (tamaño, bandas...). Sin --profile los bloques no hacen nada.
+
+El directorio se comunica por la variable PL_PROFILE, así también lo ven los procesos
+del pool que generan los PNG. El pico de tracemalloc de cada bloque es el máximo de memoria
+trazada mientras duró, aunque haya bloques anidados o simultáneos; la memoria trazada y el RSS
+son de todo el proceso, así que con varios hilos trabajando a la vez incluyen lo que hacen los demás.
+'''
+import cProfile
+import json
+import os
+import re
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# Directorio de perfiles por defecto con --profile
+PROFILE_DIR = './perfiles'
+# Intervalo de muestreo del RSS (segundos) y líneas de tracemalloc que se guardan
+RSS_INTERVAL = 0.01
+TOP_ALLOCATIONS = 25
+# Marcos de pila que guarda tracemalloc por asignación
+TRACEMALLOC_FRAMES = 5
+
+# Solo puede haber un cProfile activo por proceso (en Python 3.12+ un segundo enable() lanza ValueError)
+_cpu_lock = threading.Lock()
+_cpu_active = False
+_trace_lock = threading.Lock()
+# Bloques que miden memoria en este momento, cada uno con su pico acumulado
+_trace_blocks = []
+
+
+def enable(directory=PROFILE_DIR):
+    """Activa el perfilado para este proceso y los procesos hijos."""
+    os.makedirs(directory, exist_ok=True)
+    os.environ['PL_PROFILE'] = directory
+    return directory
+
+
+def enable_from_argv(argv, directory=PROFILE_DIR):
+    """Activa el perfilado si argv contiene --profile o --profile=DIR; devuelve el directorio o None."""
+    for arg in argv:
+        if arg == '--profile':
+            return enable(directory)
+        if arg.startswith('--profile='):
+            return enable(arg.split('=', 1)[1])
+    return None
+
+
+def profile_dir():
+    """Directorio de perfiles, o None si el perfilado no está activado."""
+    return os.getenv('PL_PROFILE') or None
+
+
+def current_rss():
+    """RSS actual del proceso en bytes (de /proc en Linux; si no existe, el máximo de getrusage)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss está en kB en Linux y en bytes en macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+
+class _RSSSampler(threading.Thread):
+    """Hilo que registra el RSS máximo mientras dura un bloque perfilado."""
+
+    def __init__(self, interval=RSS_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+def _fold_peak():
+    """Suma el pico global desde el último reinicio al pico de cada bloque activo y lo reinicia.
+
+    tracemalloc solo tiene un pico por proceso; así cada bloque conserva el suyo aunque otro
+    bloque empiece o termine mientras tanto. Se llama con _trace_lock tomado."""
+    _, peak = tracemalloc.get_traced_memory()
+    for block in _trace_blocks:
+        block['peak'] = max(block['peak'], peak)
+    tracemalloc.reset_peak()
+
+
+def _start_cpu():
+    """Devuelve un cProfile ya activado, o None si otro bloque del proceso ya perfila la CPU."""
+    global _cpu_active
+    with _cpu_lock:
+        if _cpu_active:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Hay otro perfilador activo fuera de este módulo
+            return None
+        _cpu_active = True
+        return profiler
+
+
+def _stop_cpu(profiler):
+    global _cpu_active
+    with _cpu_lock:
+        profiler.disable()
+        _cpu_active = False
+
+
+def _start_tracemalloc():
+    with _trace_lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        _fold_peak()
+        block = {'peak': tracemalloc.get_traced_memory()[0]}
+        _trace_blocks.append(block)
+    return block
+
+
+def _stop_tracemalloc(block):
+    with _trace_lock:
+        _fold_peak()
+        snapshot = tracemalloc.take_snapshot()
+        # Por identidad: dos bloques pueden tener el mismo pico y list.remove compara por igualdad
+        _trace_blocks[:] = [other for other in _trace_blocks if other is not block]
+        if not _trace_blocks:
+            tracemalloc.stop()
+    return snapshot, block['peak']
+
+
+@contextmanager
+def profiled(stage, label, cpu=True):
+    """Perfila el bloque como la etapa stage de la imagen label.
+
+    Entrega un diccionario en el que el bloque puede anotar datos de la escena (alto, ancho,
+    bandas, bytes...) que se guardan junto con las cifras. Con cpu=False, o si otro bloque del
+    proceso ya tiene el cProfile (un bloque anidado o una descarga en otro hilo), solo se mide la
+    memoria."""
+    directory = profile_dir()
+    info = {}
+    if directory is None:
+        yield info
+        return
+
+    sampler = _RSSSampler()
+    rss_start = sampler.peak
+    sampler.start()
+    trace = _start_tracemalloc()
+    start = time.perf_counter()
+    profiler = _start_cpu() if cpu else None
+    try:
+        yield info
+    finally:
+        if profiler is not None:
+            _stop_cpu(profiler)
+        elapsed = time.perf_counter() - start
+        snapshot, traced_peak = _stop_tracemalloc(trace)
+        rss_peak = sampler.stop()
+
+        name = re.sub(r'[^\w.-]+', '_', f'{stage}_{label}')
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(directory, name + '.pstats'))
+        with open(os.path.join(directory, name + '_memoria.txt'), 'w') as f:
+            f.write(f'# {stage} {label}: pico tracemalloc {traced_peak / 1e6:.1f} MB, '
+                    f'RSS inicio {rss_start / 1e6:.1f} MB, pico {rss_peak / 1e6:.1f} MB\n')
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                f.write(f'{stat}\n')
+
+        record = {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'pid': os.getpid(),
+            'etapa': stage,
+            'imagen': label,
+            'segundos': round(elapsed, 4),
+            'rss_inicio_mb': round(rss_start / 1e6, 1),
+            'rss_pico_mb': round(rss_peak / 1e6, 1),
+            'rss_fin_mb': round(current_rss() / 1e6, 1),
+            'tracemalloc_pico_mb': round(traced_peak / 1e6, 1),
+            'cpu': profiler is not None,
+        }
+        record.update(info)
+        # Una línea por bloque; las escrituras con O_APPEND de una sola línea no se intercalan entre procesos
+        with open(os.path.join(directory, 'perfiles.jsonl'), 'a') as f:
+            f.write(json.dumps(record) + '\n')
@@ -0,0 +1,166 @@
+'''
+Limitador de peticiones compartido para los endpoints de la API de Planet.
+
+Cada tipo de endpoint (búsqueda, activación, descarga y el resto) tiene su propia
+cubeta de tokens con la cuota de Planet. Todos los hilos toman tokens de la misma
+cubeta antes de enviar una petición; cuando Planet responde 429 se pausa toda la
+cubeta durante el tiempo indicado en Retry-After y su tasa se reduce, para después
+recuperarse poco a poco hasta un poco menos de la tasa que provocó el 429. Las esperas se calculan bajo un candado y
+se duermen fuera de él, así que la misma cubeta sirve desde hilos (acquire) y desde
+corrutinas de asyncio (acquire_async).
+'''
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Peticiones por segundo permitidas por Planet para cada tipo de endpoint (PL_RATE_<TIPO> para cambiarlas)
+RATES = {
+    'busqueda': float(os.getenv('PL_RATE_BUSQUEDA', 10)),
+    'activacion': float(os.getenv('PL_RATE_ACTIVACION', 5)),
+    'descarga': float(os.getenv('PL_RATE_DESCARGA', 15)),
+    'general': float(os.getenv('PL_RATE_GENERAL', 10)),
+}
+# Tokens acumulables, en segundos de cuota. Sin ráfagas (mínimo un token) las peticiones salen
+# espaciadas, porque una ráfaga seguida de la tasa completa excede una cuota por ventana de 1 s
+BURST_SECONDS = 0.0
+# Después de un 429: factor de reducción de la tasa, nueva tasa máxima (fracción de la tasa que
+# provocó el 429), tasa mínima (fracción de la cuota) y fracción de la tasa máxima que se
+# recupera por cada petición exitosa
+BACKOFF_FACTOR = 0.5
+CEILING_FACTOR = 0.9
+MIN_RATE_FRACTION = 0.1
+RECOVERY_FRACTION = 0.02
+# Espera cuando la respuesta 429 no trae Retry-After (segundos)
+DEFAULT_RETRY_AFTER = 1.0
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def endpoint_kind(url):
+    """Clasifica una URL de Planet en uno de los tipos de RATES según su ruta."""
+    path = url.split('?', 1)[0]
+    if path.endswith('/quick-search') or '/searches' in path:
+        return 'busqueda'
+    if '/activate' in path:
+        return 'activacion'
+    if '/download' in path:
+        return 'descarga'
+    return 'general'
+
+
+def parse_retry_after(value, default=DEFAULT_RETRY_AFTER):
+    """Convierte el encabezado Retry-After (segundos o fecha HTTP) en segundos de espera."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class TokenBucket:
+    """Cubeta de tokens segura para hilos y asyncio con pausa y reducción de tasa ante 429."""
+
+    def __init__(self, rate, burst_seconds=BURST_SECONDS):
+        self.max_rate = rate
+        # Tasa máxima aprendida: baja si Planet responde 429 por debajo de la cuota configurada
+        self.ceiling = rate
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst_seconds)
+        self.tokens = self.capacity
+        # Instante hasta el que ya se contaron los tokens; después de un 429 queda en el futuro
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens=1):
+        """Reserva tokens y devuelve cuántos segundos hay que esperar para usarlos.
+
+        Los tokens pueden quedar en negativo: cada llamada reserva su turno, así las peticiones
+        se atienden en orden y sin que varios hilos despierten a la vez por el mismo token."""
+        with self._lock:
+            now = time.monotonic()
+            if now > self.updated:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            self.tokens -= tokens
+            # Durante una pausa los turnos se escalonan a partir de su final, no todos a la vez
+            wait = self.updated - now
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+            return wait
+
+    def acquire(self, tokens=1):
+        """Espera (bloqueando el hilo) hasta poder enviar una petición."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        """Igual que acquire, pero cede el control al ciclo de eventos mientras espera."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def penalize(self, delay):
+        """Pausa la cubeta delay segundos y reduce la tasa tras una respuesta 429."""
+        with self._lock:
+            now = time.monotonic()
+            if self.updated <= now:
+                # Los 429 de peticiones enviadas antes de la pausa no vuelven a reducir la tasa
+                floor = self.max_rate * MIN_RATE_FRACTION
+                self.ceiling = max(floor, min(self.ceiling, self.rate * CEILING_FACTOR))
+                self.rate = max(floor, self.rate * BACKOFF_FACTOR)
+            self.updated = max(self.updated, now + delay)
+            # Se descartan los tokens acumulados para no enviar una ráfaga al reanudar
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeed(self):
+        """Recupera la tasa poco a poco hasta la tasa máxima aprendida después de una petición exitosa."""
+        if self.rate < self.ceiling:
+            with self._lock:
+                self.rate = min(self.ceiling, self.rate + self.ceiling * RECOVERY_FRACTION)
+
+
+class RateLimiter:
+    """Conjunto de cubetas, una por tipo de endpoint."""
+
+    def __init__(self, rates=None):
+        self.buckets = {kind: TokenBucket(rate) for kind, rate in (rates or RATES).items()}
+
+    def bucket(self, url):
+        return self.buckets[endpoint_kind(url)]
+
+    def acquire(self, url):
+        self.bucket(url).acquire()
+
+    async def acquire_async(self, url):
+        await self.bucket(url).acquire_async()
+
+    def penalize(self, url, retry_after=None):
+        """Registra una respuesta 429 y devuelve los segundos de pausa aplicados."""
+        delay = parse_retry_after(retry_after)
+        self.bucket(url).penalize(delay)
+        return delay
+
+    def succeed(self, url):
+        self.bucket(url).succeed()
+
+
+def get_limiter():
+    """Devuelve el limitador compartido por todos los hilos del proceso, creándolo la primera vez."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
@@ -0,0 +1,112 @@
+'''
+Caché local en SQLite de las respuestas de quick-search de Planet.
+
+La llave es un hash del cuerpo de la búsqueda en forma canónica, así la misma
+combinación de cuadrante, periodo y filtros no se vuelve a consultar a la API.
+Los periodos cerrados (años pasados) no expiran; el periodo actual expira pronto
+porque Planet sigue publicando escenas. El tamaño se limita descartando las
+entradas usadas hace más tiempo (LRU).
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+CACHE_PATH = os.getenv('PL_SEARCH_CACHE', './cache/busquedas.sqlite')
+# Vigencia de las búsquedas de periodos abiertos, en segundos
+CURRENT_TTL = 6 * 3600
+# Días después del fin de un periodo a partir de los cuales se considera cerrado; Planet
+# puede publicar escenas con algunos días de retraso
+CLOSED_AFTER_DAYS = 30
+# Número máximo de respuestas guardadas
+MAX_ENTRIES = 20000
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def request_key(search_request):
+    """Devuelve el hash sha256 de la forma canónica (llaves ordenadas, sin espacios) de la búsqueda."""
+    canonical = json.dumps(search_request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def period_ttl(end_date, current_ttl=CURRENT_TTL, closed_after_days=CLOSED_AFTER_DAYS):
+    """Devuelve la vigencia para un periodo que termina en end_date (ISO 8601): None si ya cerró."""
+    end = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    if end + timedelta(days=closed_after_days) < datetime.now(timezone.utc):
+        return None
+    return current_ttl
+
+
+class SearchCache:
+    """Caché persistente de respuestas, segura para usarse desde varios hilos."""
+
+    def __init__(self, path=CACHE_PATH, max_entries=MAX_ENTRIES):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS busquedas
+                              (llave TEXT PRIMARY KEY,
+                              respuesta TEXT,
+                              expira REAL,
+                              usada REAL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS busquedas_usada_idx ON busquedas (usada)')
+        self._conn.commit()
+
+    def get(self, search_request):
+        """Devuelve la respuesta guardada para la búsqueda, o None si no existe o ya expiró."""
+        key = request_key(search_request)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT respuesta, expira FROM busquedas WHERE llave = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < now:
+                self._conn.execute('DELETE FROM busquedas WHERE llave = ?', (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute('UPDATE busquedas SET usada = ? WHERE llave = ?', (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, search_request, response, ttl=None):
+        """Guarda la respuesta de la búsqueda; ttl en segundos o None para que no expire."""
+        key = request_key(search_request)
+        now = time.time()
+        expira = None if ttl is None else now + ttl
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO busquedas (llave, respuesta, expira, usada) VALUES (?, ?, ?, ?)',
+                               (key, json.dumps(response), expira, now))
+            # Descarta las entradas menos usadas recientemente si se pasa del límite
+            self._conn.execute('''DELETE FROM busquedas WHERE llave IN
+                                  (SELECT llave FROM busquedas ORDER BY usada DESC LIMIT -1 OFFSET ?)''',
+                               (self.max_entries,))
+            self._conn.commit()
+
+    def clear(self):
+        """Elimina todas las respuestas guardadas."""
+        with self._lock:
+            self._conn.execute('DELETE FROM busquedas')
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_cache():
+    """Devuelve la caché compartida, creándola la primera vez."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SearchCache()
+        return _cache
@@ -0,0 +1,185 @@
+'''
+Pool de sesiones SFTP persistentes para enviar las imágenes al servidor de almacenamiento.
+
+Las conexiones SSH se abren una sola vez y se reutilizan entre imágenes, con ventanas
+y paquetes más grandes que los de paramiko por defecto y escrituras en pipeline. Cada
+archivo se sube con un nombre temporal, se verifica su tamaño remoto y solo entonces
+se renombra y se elimina la copia local.
+'''
+import os
+import queue
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import paramiko
+from metrics import get_metrics
+
+# Número de conexiones (canales de transferencia) simultáneas
+SFTP_CONNECTIONS = 4
+# Ventana SSH y tamaño máximo de paquete; la ventana por defecto (2 MB) limita el ancho de banda con latencia alta
+WINDOW_SIZE = 64 * 1024 * 1024
+MAX_PACKET_SIZE = 32 * 1024
+# Bloques leídos del archivo local; paramiko los divide en paquetes y los envía en pipeline
+BLOCK_SIZE = 1024 * 1024
+# Intervalo de keepalive para que el servidor no cierre las conexiones inactivas
+KEEPALIVE = 30
+
+
+class SFTPPool:
+    """Pool de conexiones SFTP reutilizables y seguras para usarse desde varios hilos."""
+
+    def __init__(self, host, username, password=None, port=22, size=SFTP_CONNECTIONS,
+                 window_size=WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE, block_size=BLOCK_SIZE):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.block_size = block_size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._dirs = set()
+        self._dirs_lock = threading.Lock()
+
+    def _connect(self):
+        """Abre una conexión SSH con ventana ampliada y su sesión SFTP.
+
+        Como antes con SSHClient, se acepta la llave del host y se autentica con la contraseña,
+        el agente SSH o las llaves de ~/.ssh."""
+        print(f"Conectando por SFTP a {self.host}...")
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(self.host, port=self.port, username=self.username, password=self.password)
+        transport = client.get_transport()
+        # Los canales que se abran en esta conexión usan la ventana y el paquete ampliados
+        transport.default_window_size = self.window_size
+        transport.default_max_packet_size = self.max_packet_size
+        transport.set_keepalive(KEEPALIVE)
+        sftp = paramiko.SFTPClient.from_transport(transport, window_size=self.window_size,
+                                                  max_packet_size=self.max_packet_size)
+        return client, sftp
+
+    @contextmanager
+    def session(self):
+        """Presta una sesión SFTP del pool, reconectando si la conexión se cayó."""
+        with self._slots:
+            try:
+                client, sftp = self._idle.get_nowait()
+                transport = client.get_transport()
+                if transport is None or not transport.is_active():
+                    client.close()
+                    client, sftp = self._connect()
+            except queue.Empty:
+                client, sftp = self._connect()
+            try:
+                yield sftp
+            except BaseException:
+                # Con cualquier error (de red, de verificación o una interrupción) la conexión puede haber
+                # quedado a medio escribir: se cierra en lugar de devolverla al pool
+                client.close()
+                raise
+            else:
+                self._idle.put((client, sftp))
+
+    def makedirs(self, sftp, remote_dir):
+        """Crea el directorio remoto (y sus padres) si no existe."""
+        if not remote_dir:
+            return
+        with self._dirs_lock:
+            if remote_dir in self._dirs:
+                return
+        partial = ''
+        for part in remote_dir.strip('/').split('/'):
+            partial = f"{partial}/{part}" if partial or remote_dir.startswith('/') else part
+            try:
+                if not stat.S_ISDIR(sftp.stat(partial).st_mode):
+                    raise IOError(f"{partial} existe en el servidor y no es un directorio")
+            except FileNotFoundError:
+                try:
+                    sftp.mkdir(partial)
+                except IOError:
+                    # Otro hilo pudo crearlo al mismo tiempo
+                    sftp.stat(partial)
+        with self._dirs_lock:
+            self._dirs.add(remote_dir)
+
+    def put(self, local_path, remote_path, remove=False):
+        """Sube un archivo y verifica su tamaño remoto antes de darlo por transferido.
+
+        Se escribe primero en remote_path + '.part' y se renombra al final, así el servidor nunca
+        tiene archivos incompletos con el nombre definitivo. Con remove=True se elimina el archivo
+        local solo después de la verificación."""
+        local_size = os.path.getsize(local_path)
+        tmp_path = remote_path + '.part'
+        start = time.perf_counter()
+        with self.session() as sftp:
+            self.makedirs(sftp, os.path.dirname(remote_path))
+            with open(local_path, 'rb') as local, sftp.open(tmp_path, 'wb', bufsize=self.block_size) as remote:
+                # En pipeline no se espera la confirmación de cada paquete antes de enviar el siguiente
+                remote.set_pipelined(True)
+                for block in iter(lambda: local.read(self.block_size), b''):
+                    remote.write(block)
+            remote_size = sftp.stat(tmp_path).st_size
+            if remote_size != local_size:
+                sftp.remove(tmp_path)
+                raise IOError(f"Tamaño remoto de {remote_path} ({remote_size}) distinto al local ({local_size})")
+            sftp.posix_rename(tmp_path, remote_path)
+        self._record(local_size, time.perf_counter() - start)
+        if remove:
+            os.remove(local_path)
+        return local_size
+
+    @contextmanager
+    def writer(self, remote_path):
+        """Abre un archivo remoto para escritura en pipeline y lo verifica al cerrarlo.
+
+        Igual que put, se escribe en remote_path + '.part' y solo se renombra si el tamaño remoto
+        coincide con lo escrito. Si ocurre un error se elimina el archivo parcial."""
+        tmp_path = remote_path + '.part'
+        start = time.perf_counter()
+        with self.session() as sftp:
+            self.makedirs(sftp, os.path.dirname(remote_path))
+            try:
+                with sftp.open(tmp_path, 'wb', bufsize=self.block_size) as remote:
+                    remote.set_pipelined(True)
+                    yield remote
+                    # tell() no cuenta lo que sigue en el búfer de escritura hasta enviarlo
+                    remote.flush()
+                    written = remote.tell()
+                remote_size = sftp.stat(tmp_path).st_size
+                if remote_size != written:
+                    raise IOError(f"Tamaño remoto de {remote_path} ({remote_size}) distinto al enviado ({written})")
+            except BaseException:
+                try:
+                    sftp.remove(tmp_path)
+                except IOError:
+                    pass
+                raise
+            sftp.posix_rename(tmp_path, remote_path)
+        self._record(written, time.perf_counter() - start)
+
+    def _record(self, nbytes, elapsed):
+        metrics = get_metrics()
+        metrics.observe('sftp_segundos', elapsed)
+        metrics.count('sftp_bytes', nbytes)
+
+    def put_many(self, files, remote_dir, remove=False):
+        """Sube varios archivos en paralelo usando los canales del pool."""
+        with ThreadPoolExecutor(max_workers=min(self.size, max(1, len(files)))) as executor:
+            futures = [executor.submit(self.put, file, remote_dir.rstrip('/') + '/' + os.path.basename(file), remove)
+                       for file in files]
+            return [future.result() for future in futures]
+
+    def close(self):
+        """Cierra todas las conexiones inactivas del pool."""
+        while True:
+            try:
+                client, sftp = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            sftp.close()
+            client.close()
@@ -0,0 +1,21 @@
+'''
+Pruebas de wait_for_activation (planet_activation.py).
+'''
+import planet_activation
+from planet_activation import wait_for_activation
+
+
+def test_all_activations_requested_before_first_active_asset(monkeypatch):
+    activated = []
+    monkeypatch.setattr(planet_activation, 'activate_asset', lambda asset: activated.append(asset['id']))
+    monkeypatch.setattr(planet_activation, 'poll_asset', lambda asset: dict(asset, status='active', location='url'))
+    jobs = [
+        ('a', {'id': 'a', 'status': 'active', 'location': 'url'}),
+        ('b', {'id': 'b', 'status': 'inactive'}),
+        ('c', {'id': 'c', 'status': 'inactive'}),
+    ]
+    results = wait_for_activation(jobs, poll_interval=0)
+    # Al entregar el primer asset (ya activo) ya se pidió la activación de los demás
+    assert next(results)[0] == 'a'
+    assert activated == ['b', 'c']
+    assert [key for key, _ in results] == ['b', 'c']
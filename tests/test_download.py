@@ -0,0 +1,82 @@
+'''
+Pruebas de download_file (planet_download.py) contra un servidor HTTP local.
+'''
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import metrics
+from planet_download import DownloadError, download_file
+
+DATA = os.urandom(300 * 1024)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Número de respuestas de rango que se cortan a la mitad, con un Content-Length que coincide
+    truncate = 0
+
+    def do_GET(self):
+        start, end = 0, len(DATA) - 1
+        if 'Range' in self.headers:
+            first, last = self.headers['Range'].split('=', 1)[1].split('-')
+            start, end = int(first), int(last)
+        body = DATA[start:end + 1]
+        if start > 0 and _Handler.truncate > 0:
+            _Handler.truncate -= 1
+            body = body[:len(body) // 2]
+        self.send_response(206 if 'Range' in self.headers else 200)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(DATA)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/escena.tif'
+    httpd.shutdown()
+
+
+def test_truncated_range_is_resumed_without_md5(server, tmp_path):
+    # Sin md5 el tamaño del .part reservado siempre coincide; el rango cortado debe completarse
+    _Handler.truncate = 2
+    path = str(tmp_path / 'escena.tif')
+    download_file(server, path, parts=3, min_part_size=64 * 1024)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_md5_mismatch_is_rejected(server, tmp_path):
+    _Handler.truncate = 0
+    path = str(tmp_path / 'escena.tif')
+    with pytest.raises(DownloadError):
+        download_file(server, path, parts=2, min_part_size=64 * 1024, expected_md5=hashlib.md5(b'otro').hexdigest())
+    assert not os.path.exists(path)
+
+
+def test_resumed_download_counts_only_received_bytes(server, tmp_path):
+    _Handler.truncate = 0
+    path = str(tmp_path / 'escena.tif')
+    half = len(DATA) // 2
+    # Descarga interrumpida a la mitad: .part del tamaño total con la primera mitad escrita
+    with open(path + '.part', 'wb') as f:
+        f.write(DATA[:half])
+        f.truncate(len(DATA))
+    with open(path + '.part.json', 'w') as f:
+        json.dump({'url': server, 'total': len(DATA), 'ranges': [[half, len(DATA) - 1]]}, f)
+    registry = metrics.reset_metrics()
+    download_file(server, path)
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert registry.counters['descarga_bytes'] == len(DATA) - half
@@ -0,0 +1,53 @@
+'''
+Pruebas de run_pipeline (pipeline.py).
+'''
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from pipeline import run_pipeline
+
+
+def render(item):
+    # Se ejecuta en el pool de procesos: debe poder importarse desde este módulo
+    if item == 'malo':
+        raise ValueError('render fallido')
+
+
+def test_items_flow_through_every_stage():
+    transferred = []
+    errors = []
+    count = run_pipeline(['a', 'b', 'malo', 'c'], lambda job: job, render, transferred.append,
+                         download_workers=2, render_workers=2, on_error=lambda item, stage, e: errors.append(item))
+    assert count == 3
+    assert sorted(transferred) == ['a', 'b', 'c']
+    assert errors == ['malo']
+
+
+def test_failing_jobs_generator_stops_threads():
+    before = threading.active_count()
+
+    def jobs():
+        yield 'a'
+        raise RuntimeError('fallo en la activación')
+
+    with pytest.raises(RuntimeError):
+        run_pipeline(jobs(), lambda job: job, render, lambda item: None, render_workers=1)
+    assert threading.active_count() == before
+
+
+def render_crash(item):
+    # Simula un proceso de render que el sistema mata (p. ej. por falta de memoria)
+    if item == 'enorme':
+        os._exit(1)
+
+
+def test_dead_render_worker_raises_instead_of_hanging():
+    errors = []
+    jobs = ['a', 'enorme'] + ['x{}'.format(i) for i in range(20)]
+    with pytest.raises(BrokenProcessPool):
+        run_pipeline(jobs, lambda job: job, render_crash, lambda item: None, download_workers=2, render_workers=1,
+                     max_in_flight=2, on_error=lambda item, stage, e: errors.append(item))
+    assert 'enorme' in errors
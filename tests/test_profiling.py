@@ -0,0 +1,71 @@
+'''
+Pruebas de profiled (profiling.py).
+'''
+import json
+import os
+import threading
+
+import profiling
+from profiling import profiled
+
+
+def records(directory):
+    with open(os.path.join(directory, 'perfiles.jsonl')) as f:
+        return {r['etapa']: r for r in map(json.loads, f)}
+
+
+def test_disabled_does_nothing(tmp_path, monkeypatch):
+    monkeypatch.delenv('PL_PROFILE', raising=False)
+    with profiled('png', 'escena') as info:
+        info['bytes'] = 1
+    assert not os.listdir(tmp_path)
+
+
+def test_nested_blocks_keep_their_own_peak(tmp_path, monkeypatch):
+    monkeypatch.setenv('PL_PROFILE', str(tmp_path))
+    with profiled('externo', 'escena'):
+        grande = bytearray(40 * 1024 * 1024)
+        del grande
+        with profiled('interno', 'escena', cpu=False):
+            chico = bytearray(5 * 1024 * 1024)
+            del chico
+    data = records(tmp_path)
+    # El bloque interno no ve el pico anterior del externo, y el externo conserva el suyo
+    assert 5 <= data['interno']['tracemalloc_pico_mb'] < 20
+    assert data['externo']['tracemalloc_pico_mb'] >= 40
+    assert data['externo']['cpu'] and not data['interno']['cpu']
+    assert os.path.exists(tmp_path / 'externo_escena.pstats')
+    assert not profiling._trace_blocks
+
+
+def test_concurrent_blocks_share_one_cpu_profiler(tmp_path, monkeypatch):
+    monkeypatch.setenv('PL_PROFILE', str(tmp_path))
+    barrier = threading.Barrier(3)
+
+    def descarga(n):
+        with profiled('descarga{}'.format(n), 'escena'):
+            barrier.wait()
+
+    threads = [threading.Thread(target=descarga, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    data = records(tmp_path)
+    # Solo uno de los bloques simultáneos perfila la CPU, los demás miden solo la memoria
+    assert sum(r['cpu'] for r in data.values()) == 1
+    assert not profiling._cpu_active
+
+
+def test_falls_back_to_memory_when_another_profiler_is_active(tmp_path, monkeypatch):
+    monkeypatch.setenv('PL_PROFILE', str(tmp_path))
+
+    class Ocupado:
+        def enable(self):
+            # Lo que hace Python 3.12+ si ya hay otro perfilador activo
+            raise ValueError('Another profiling tool is already active')
+
+    monkeypatch.setattr(profiling.cProfile, 'Profile', Ocupado)
+    with profiled('descarga', 'escena'):
+        pass
+    assert not records(tmp_path)['descarga']['cpu']
@@ -0,0 +1,33 @@
+'''
+Pruebas de simplify_to_budget (download_planet_region.py).
+'''
+import numpy as np
+import shapely
+from shapely.geometry import MultiPolygon, Point, box
+
+from download_planet_region import simplify_to_budget
+
+
+def test_multipolygon_over_budget_terminates():
+    # 200 cuadros de 5 coordenadas: preserve_topology conserva los 200 anillos (1000 coordenadas)
+    multi = MultiPolygon([box(i * 2, 0, i * 2 + 1, 1) for i in range(200)])
+    with np.errstate(over='raise'):
+        result = simplify_to_budget([multi], max_vertices=500)
+    # No se puede llegar al límite: termina con la mayor simplificación y conserva todas las partes
+    assert shapely.get_num_coordinates(result[0]) > 500
+    assert len(result[0].geoms) == 200
+
+
+def test_dense_polygon_within_budget():
+    circle = Point(0, 0).buffer(1, quad_segs=2000)
+    result = simplify_to_budget([circle, box(0, 0, 1, 1)], max_vertices=500)
+    assert shapely.get_num_coordinates(result[0]) <= 500
+    assert result[0].symmetric_difference(circle).area < 0.01
+    assert result[1].equals(box(0, 0, 1, 1))
+
+
+def test_multipolygon_with_dense_parts_within_budget():
+    multi = MultiPolygon([Point(i * 3, 0).buffer(1, quad_segs=500) for i in range(4)])
+    result = simplify_to_budget([multi], max_vertices=500)
+    assert shapely.get_num_coordinates(result[0]) <= 500
+    assert len(result[0].geoms) == 4